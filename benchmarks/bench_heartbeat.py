@@ -0,0 +1,149 @@
+"""
+Heartbeat handling benchmark.
+
+1. Expiry: one monitor pass over N tracked nodes/clients, as the old full
+   scan of every entry vs liveness.TimingWheel.expire(), which only visits
+   the entries falling due.
+
+2. Simulated cluster: starts master.py (port 4000, so stop any running
+   master first) in a scratch directory with `nodes` simulated nodes, sends
+   it `rate` heartbeats/s for `seconds` seconds as JSON and then as compact
+   heartbeats, and reports the master's CPU per 1000 heartbeats/s (from its
+   /heartbeat_stats) and what an idle cluster of that size costs at the
+   busy and backed-off node heartbeat intervals.
+
+    python benchmarks/bench_heartbeat.py [nodes] [rate] [seconds]
+"""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+
+import http_pool
+import liveness
+
+MASTER = "http://127.0.0.1:4000"
+TIMEOUT = 5
+FIRST_PORT = 20000
+
+
+def bench_expiry(n, passes=200):
+    rnd = random.Random(1)
+    now = 1000.0
+    last_seen = {str(i): now - rnd.uniform(0, 1) for i in range(n)}
+    wheel = liveness.TimingWheel(0.5, 64)
+    for key, t in last_seen.items():
+        wheel.schedule(key, t + TIMEOUT)
+
+    t0 = time.perf_counter()
+    for i in range(passes):
+        [k for k, t in last_seen.items() if now + i * 0.01 - t > TIMEOUT]
+    scan_us = (time.perf_counter() - t0) / passes * 1e6
+
+    t0 = time.perf_counter()
+    for i in range(passes):
+        wheel.expire(now + i * 0.01)
+    wheel_us = (time.perf_counter() - t0) / passes * 1e6
+    print(f"expiry   {n:6d} entries  scan {scan_us:9.1f} us/pass  wheel {wheel_us:7.1f} us/pass")
+
+
+def _send(ports, rate, seconds, compact, sent):
+    # Each sender paces its own share of the rate over its ports
+    interval = len(ports) / rate
+    load = {"free_bytes": 10 ** 11, "used_bytes": 10 ** 9, "blocks": 1000, "active_transfers": 0}
+    deadline = time.time() + seconds
+    next_at = time.time()
+    count = 0
+    while time.time() < deadline:
+        for port in ports:
+            if compact:
+                http_pool.post(
+                    MASTER + "/heartbeat",
+                    data=liveness.encode_heartbeat(port, 1, load),
+                    headers={"Content-Type": liveness.HEARTBEAT_TYPE},
+                    timeout=5,
+                )
+            else:
+                http_pool.post(
+                    MASTER + "/heartbeat",
+                    json={"port": port, "added": [], "removed": [], "load": load},
+                    timeout=5,
+                )
+            count += 1
+        next_at += interval
+        time.sleep(max(0.0, next_at - time.time()))
+    sent.append(count)
+
+
+def bench_cluster(num_nodes, rate, seconds, senders=8):
+    ports = [str(FIRST_PORT + i) for i in range(num_nodes)]
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(os.path.join(d, "config"))
+        with open(os.path.join(d, "config", "config.json"), "w") as f:
+            json.dump({"nodes": [{"port": int(p)} for p in ports]}, f)
+        env = dict(os.environ, PYTHONPATH=REPO)
+        master = subprocess.Popen(
+            [sys.executable, os.path.join(REPO, "master.py")],
+            cwd=d, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(100):
+                try:
+                    http_pool.get(MASTER + "/status", timeout=1)
+                    break
+                except Exception:
+                    time.sleep(0.1)
+            for port in ports:
+                http_pool.post(MASTER + "/block_report", json={"port": port, "blocks": []})
+
+            for compact in (False, True):
+                before = http_pool.get(MASTER + "/heartbeat_stats").json()["cpu_seconds"]
+                sent = []
+                threads = [
+                    threading.Thread(
+                        target=_send,
+                        args=(ports[i::senders], rate / senders, seconds, compact, sent),
+                    )
+                    for i in range(senders)
+                ]
+                t0 = time.time()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.time() - t0
+                cpu = http_pool.get(MASTER + "/heartbeat_stats").json()["cpu_seconds"] - before
+                total = sum(sent)
+                per_hb = cpu / total
+                print(
+                    f"cluster  {num_nodes:6d} nodes  {'compact' if compact else 'json':7s} "
+                    f"{total / elapsed:7.0f} hb/s  master CPU {per_hb * 1000:6.3f} s "
+                    f"per 1000 hb ({per_hb * 1000 * 100:5.1f}% of a core per 1000 hb/s)"
+                )
+            # what the adaptive interval saves on an idle cluster of this size
+            for interval in (1, 3):
+                print(
+                    f"idle     {num_nodes:6d} nodes  every {interval}s "
+                    f"{num_nodes / interval:7.0f} hb/s  master CPU "
+                    f"{num_nodes / interval * per_hb * 100:5.1f}% of a core"
+                )
+        finally:
+            master.terminate()
+            master.wait()
+
+
+if __name__ == "__main__":
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    for n in (100, 1000, 10000, 100000):
+        bench_expiry(n)
+    bench_cluster(num_nodes, rate, seconds)
@@ -0,0 +1,105 @@
+"""
+Master lock contention benchmark: request throughput as client threads grow,
+on a mixed workload of /locate (namespace reads), empty /heartbeat (liveness
+only) and a few /upload calls (namespace writes that fsync the edit log).
+
+Runs the master's Flask app in-process through its test client, against a
+throwaway metadata directory; no nodes or network are involved.
+
+    python benchmarks/bench_master_locks.py [seconds] [threads...]
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+
+# Of every 100 requests: this many uploads, this many heartbeats, rest /locate
+UPLOAD_PCT = 2
+HEARTBEAT_PCT = 30
+
+PRELOAD_FILES = 500
+
+
+def _setup_workdir():
+    work = tempfile.mkdtemp(prefix="bench_master_")
+    os.makedirs(os.path.join(work, "config"))
+    with open(os.path.join(REPO, "config", "config.json"), "r") as f:
+        cfg = json.load(f)
+    cfg["metadata_dir"] = os.path.join(work, "metadata")
+    cfg["checkpoint_interval"] = 3600
+    with open(os.path.join(work, "config", "config.json"), "w") as f:
+        json.dump(cfg, f)
+    os.chdir(work)
+    return work
+
+
+def _run(app, ports, files, threads, seconds):
+    stop = time.time() + seconds
+    counts = [0] * threads
+
+    def worker(k):
+        c = app.test_client()
+        rnd = random.Random(k)
+        n = 0
+        while time.time() < stop:
+            roll = rnd.randrange(100)
+            if roll < UPLOAD_PCT:
+                name = f"bench_t{k}_{n}.bin"
+                c.post("/upload", json={
+                    "filename": name, "replication_factor": 2,
+                    "num_blocks": 4, "size": 4 * 65536,
+                })
+            elif roll < UPLOAD_PCT + HEARTBEAT_PCT:
+                c.post("/heartbeat", json={"port": rnd.choice(ports), "added": [], "removed": []})
+            else:
+                c.post("/locate", json={"filename": rnd.choice(files)})
+            n += 1
+        counts[k] = n
+
+    ts = [threading.Thread(target=worker, args=(k,)) for k in range(threads)]
+    t0 = time.time()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.time() - t0
+    total = sum(counts)
+    print(f"threads={threads:3d}  {total / elapsed:9.0f} req/s  ({total} requests)")
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    thread_counts = [int(a) for a in sys.argv[2:]] or [1, 2, 4, 8, 16]
+
+    work = _setup_workdir()
+    try:
+        import master
+
+        c = master.app.test_client()
+        ports = sorted(master.nodes)
+        for p in ports:
+            c.post("/heartbeat", json={"port": p, "added": [], "removed": []})
+            c.post("/block_report", json={"port": p, "blocks": []})
+
+        files = []
+        for i in range(PRELOAD_FILES):
+            name = f"preload_{i}.bin"
+            c.post("/upload", json={
+                "filename": name, "replication_factor": 2,
+                "num_blocks": 16, "size": 16 * 65536,
+            })
+            files.append(name)
+
+        for t in thread_counts:
+            _run(master.app, ports, files, t, seconds)
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(work, ignore_errors=True)
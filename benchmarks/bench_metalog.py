@@ -0,0 +1,80 @@
+"""
+Edit log benchmark: group-commit write throughput and restart (replay) time.
+
+    python benchmarks/bench_metalog.py [records] [threads...]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import metalog
+
+
+def _record(i):
+    return {
+        "op": "upload",
+        "filename": f"file{i}",
+        "meta": {
+            "replication_factor": 2,
+            "size": 65536,
+            "block_size": 65536,
+            "blocks": [{"id": f"file{i}__blk0", "replicas": ["5001", "5002"]}],
+        },
+    }
+
+
+def bench_writes(records, threads):
+    with tempfile.TemporaryDirectory() as d:
+        log = metalog.EditLog(d)
+        log.load()
+        per_thread = records // threads
+
+        def worker(base):
+            for i in range(base, base + per_thread):
+                log.wait(log.append(_record(i)))
+
+        t0 = time.time()
+        ts = [threading.Thread(target=worker, args=(k * per_thread,)) for k in range(threads)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        elapsed = time.time() - t0
+
+        st = log.get_stats()
+        print(
+            f"threads={threads:3d}  {per_thread * threads / elapsed:10.0f} edits/s  "
+            f"fsyncs={st['fsyncs']:6d}  avg_batch={st['avg_batch']:6.1f}  "
+            f"avg_fsync={st['avg_fsync_ms']:.2f}ms"
+        )
+
+
+def bench_restart(records):
+    with tempfile.TemporaryDirectory() as d:
+        log = metalog.EditLog(d)
+        log.load()
+        for i in range(records):
+            seq = log.append(_record(i))
+        log.wait(seq)
+
+        t0 = time.time()
+        _, replayed = metalog.EditLog(d).load()
+        print(f"replay of {len(replayed)} edits: {time.time() - t0:.3f}s")
+
+        log.write_snapshot(log.roll(), "{}")
+        t0 = time.time()
+        _, replayed = metalog.EditLog(d).load()
+        print(f"load after snapshot ({len(replayed)} edits in tail): {time.time() - t0:.3f}s")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    thread_counts = [int(a) for a in sys.argv[2:]] or [1, 4, 16, 64]
+    for t in thread_counts:
+        bench_writes(n, t)
+    bench_restart(n)
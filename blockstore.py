@@ -0,0 +1,497 @@
+"""
+Block storage engines for a node.
+
+FileStore keeps one <block_id>.blk file per block: BLOCK_MAGIC + CRC32 of
+the data + the data. Simple, but every store is a create/write/rename and
+millions of small blocks mean millions of inodes in one directory. Ids are
+percent-encoded in file names ("%" and "/") so list() gives them back
+exactly. Stores written before that replaced "/" with "_"; their files are
+renamed once with upgrade_names() and NAMES_MARKER records it.
+
+SegmentStore appends blocks to large segment files instead and keeps an
+in-memory index block_id -> (segment, offset, length, crc):
+
+- A record is RECORD_HEADER (magic, kind, id length, data length, CRC32)
+  followed by the block id and the data. Deletes append a tombstone record
+  so replaying the segments never brings a deleted block back.
+- The index is checkpointed to index.json now and then together with the
+  position the log had reached; on startup the checkpoint is loaded and
+  only records after that position are replayed. A torn record at the end
+  of the log (crash mid-append) is cut off.
+- Deleted and overwritten records leave dead bytes behind. A background
+  pass rewrites the live records of sealed segments that are mostly dead
+  to the end of the log and unlinks the old segment.
+- Reads are slices of an mmap of the segment file.
+
+Both raise CorruptBlock when a block's data doesn't match its checksum.
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from urllib.parse import unquote
+
+BLOCK_MAGIC = b"NFSB"
+HEADER_SIZE = 8
+
+RECORD_MAGIC = b"NFSR"
+RECORD_HEADER = struct.Struct(">4sBHII")
+PUT, DELETE = 1, 2
+
+# A segment is sealed and a new one started once it reaches this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Sealed segments with at least this fraction of dead bytes get compacted
+COMPACT_RATIO = 0.5
+
+# Present in a FileStore root once its file names use encode_id()
+NAMES_MARKER = "names-v2"
+
+
+class CorruptBlock(Exception):
+    pass
+
+
+def encode_id(block_id):
+    return block_id.replace("%", "%25").replace("/", "%2F")
+
+
+def decode_id(name):
+    # every "%" in an encoded name starts "%25" or "%2F"
+    return unquote(name)
+
+
+class FileStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._marker = os.path.join(root, NAMES_MARKER)
+        if not os.path.exists(self._marker) and not self._blk_names():
+            open(self._marker, "w").close()
+
+    def _path(self, block_id):
+        return os.path.join(self.root, f"{encode_id(block_id)}.blk")
+
+    def _blk_names(self):
+        return [name[:-4] for name in os.listdir(self.root) if name.endswith(".blk")]
+
+    def legacy_names(self):
+        """File names (without .blk) still in the old naming, where an id's
+        "/" became "_"; empty once upgraded."""
+        if os.path.exists(self._marker):
+            return []
+        return self._blk_names()
+
+    def upgrade_names(self, real_ids):
+        """Rename legacy files to the current encoding. real_ids maps a
+        legacy name to the block id it was stored for, for ids that had a
+        "/"; any other name is the id itself."""
+        for name in self.legacy_names():
+            new = self._path(real_ids.get(name, name))
+            old = os.path.join(self.root, f"{name}.blk")
+            if new != old:
+                os.replace(old, new)
+        open(self._marker, "w").close()
+
+    def put(self, block_id, content):
+        """Store a block; returns the size of the data it replaced, or None."""
+        # Written to a temp file and renamed so a reader never sees data and
+        # checksum from different writes.
+        path = self._path(block_id)
+        old_size = self.size(block_id)
+        # Each write gets its own temp file: two puts of one block can race
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(BLOCK_MAGIC + struct.pack(">I", zlib.crc32(content)))
+                f.write(content)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        return old_size
+
+    def get(self, block_id):
+        """Return (data, crc), or None if the block isn't here. crc is None
+        for a legacy file without checksum."""
+        try:
+            f = open(self._path(block_id), "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            header = f.read(HEADER_SIZE)
+            if header[:4] != BLOCK_MAGIC:
+                return header + f.read(), None
+            data = f.read()
+        crc = struct.unpack(">I", header[4:])[0]
+        if zlib.crc32(data) != crc:
+            raise CorruptBlock(block_id)
+        return data, crc
+
+    def open_block(self, block_id):
+        """Return (file, length, crc) with the file positioned at the block's
+        data, for streaming it out unverified; None if the block isn't here
+        or has no checksum to send with it."""
+        try:
+            f = open(self._path(block_id), "rb")
+        except FileNotFoundError:
+            return None
+        header = f.read(HEADER_SIZE)
+        if header[:4] != BLOCK_MAGIC:
+            f.close()
+            return None
+        length = os.fstat(f.fileno()).st_size - HEADER_SIZE
+        return f, length, struct.unpack(">I", header[4:])[0]
+
+    def delete(self, block_id):
+        """Remove a block; returns its size, or None if it wasn't here."""
+        size = self.size(block_id)
+        if size is None:
+            return None
+        try:
+            os.remove(self._path(block_id))
+        except FileNotFoundError:
+            return None
+        return size
+
+    def size(self, block_id):
+        try:
+            size = os.path.getsize(self._path(block_id))
+        except FileNotFoundError:
+            return None
+        # legacy files have no header; off by HEADER_SIZE until scrubbed
+        return max(size - HEADER_SIZE, 0)
+
+    def list(self):
+        return [decode_id(name) for name in self._blk_names()]
+
+    def usage(self):
+        """(block count, data bytes) currently stored."""
+        blocks = self.list()
+        return len(blocks), sum(self.size(b) or 0 for b in blocks)
+
+    def maintain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SegmentStore:
+    def __init__(self, root, segment_size=None):
+        self.root = root
+        self.segment_size = segment_size or SEGMENT_SIZE
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._index = {}  # block_id -> (segment, offset, length, crc)
+        self._dead = {}  # segment -> dead bytes
+        self._maps = {}  # segment -> mmap
+        self._dirty = False
+        self._load()
+
+    def _seg_path(self, seg):
+        return os.path.join(self.root, f"seg_{seg:06d}.log")
+
+    def _segments(self):
+        return sorted(
+            int(name[4:-4]) for name in os.listdir(self.root)
+            if name.startswith("seg_") and name.endswith(".log")
+        )
+
+    def _load(self):
+        start_seg, start_off = 0, 0
+        ckpt = os.path.join(self.root, "index.json")
+        segs = self._segments()
+        try:
+            with open(ckpt, "r") as f:
+                state = json.load(f)
+            start_seg, start_off = state["segment"], state["offset"]
+            self._index = {b: tuple(loc) for b, loc in state["blocks"].items()}
+            self._dead = {int(s): n for s, n in state["dead"].items()}
+        except (OSError, ValueError, KeyError):
+            self._index, self._dead = {}, {}
+            start_seg, start_off = 0, 0
+
+        present = set(segs)
+        for b in [b for b, loc in self._index.items() if loc[0] not in present]:
+            del self._index[b]
+        for seg in segs:
+            if seg >= start_seg:
+                self._replay(seg, start_off if seg == start_seg else 0)
+
+        self._active = segs[-1] if segs else 1
+        self._fd = os.open(
+            self._seg_path(self._active), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+        )
+        self._tail = os.fstat(self._fd).st_size
+        self._dirty = start_seg != self._active or start_off != self._tail
+
+    def _replay(self, seg, offset):
+        path = self._seg_path(seg)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if not header:
+                    return
+                if len(header) < RECORD_HEADER.size:
+                    break
+                magic, kind, id_len, length, crc = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    break
+                block_id = f.read(id_len)
+                data_off = offset + RECORD_HEADER.size + id_len
+                body = f.read(length)
+                if len(block_id) < id_len or len(body) < length:
+                    break
+                block_id = block_id.decode()
+                self._forget(block_id)
+                if kind == PUT:
+                    self._index[block_id] = (seg, data_off, length, crc)
+                else:
+                    self._dead[seg] = self._dead.get(seg, 0) + RECORD_HEADER.size + id_len
+                offset = data_off + length
+        print(f"[BLOCKSTORE] Cutting torn record at {path}:{offset}")
+        os.truncate(path, offset)
+
+    def _forget(self, block_id):
+        # Marks the current record of block_id dead; caller holds _lock
+        loc = self._index.pop(block_id, None)
+        if loc is None:
+            return None
+        seg, _, length, _ = loc
+        self._dead[seg] = (
+            self._dead.get(seg, 0) + RECORD_HEADER.size + len(block_id.encode()) + length
+        )
+        return length
+
+    def _append(self, kind, block_id, data, crc):
+        # Caller holds _lock. Returns (segment, data offset).
+        if self._tail >= self.segment_size:
+            os.close(self._fd)
+            self._active += 1
+            self._fd = os.open(
+                self._seg_path(self._active), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+            )
+            self._tail = 0
+        raw_id = block_id.encode()
+        os.write(
+            self._fd,
+            RECORD_HEADER.pack(RECORD_MAGIC, kind, len(raw_id), len(data), crc) + raw_id + data,
+        )
+        data_off = self._tail + RECORD_HEADER.size + len(raw_id)
+        self._tail = data_off + len(data)
+        self._dirty = True
+        return self._active, data_off
+
+    def _map(self, seg, end):
+        # mmap of seg covering at least `end` bytes. The active segment grows,
+        # so its map is redone when a read goes past it; old maps are left to
+        # close once no reader holds them.
+        with self._lock:
+            mm = self._maps.get(seg)
+            if mm is not None and len(mm) >= end:
+                return mm
+            with open(self._seg_path(seg), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[seg] = mm
+            return mm
+
+    def put(self, block_id, content):
+        crc = zlib.crc32(content)
+        with self._lock:
+            old_size = self._forget(block_id)
+            seg, off = self._append(PUT, block_id, content, crc)
+            self._index[block_id] = (seg, off, len(content), crc)
+        return old_size
+
+    def get(self, block_id):
+        with self._lock:
+            loc = self._index.get(block_id)
+        if loc is None:
+            return None
+        seg, off, length, crc = loc
+        try:
+            data = self._map(seg, off + length)[off:off + length]
+        except FileNotFoundError:
+            # compacted away since the lookup: the index has the new place
+            with self._lock:
+                moved = self._index.get(block_id)
+            if moved is None or moved == loc:
+                return None
+            return self.get(block_id)
+        if zlib.crc32(data) != crc:
+            raise CorruptBlock(block_id)
+        return data, crc
+
+    def open_block(self, block_id):
+        with self._lock:
+            loc = self._index.get(block_id)
+        if loc is None:
+            return None
+        seg, off, length, crc = loc
+        try:
+            f = open(self._seg_path(seg), "rb")
+        except FileNotFoundError:
+            return None
+        f.seek(off)
+        return f, length, crc
+
+    def delete(self, block_id):
+        with self._lock:
+            size = self._forget(block_id)
+            if size is None:
+                return None
+            seg, _ = self._append(DELETE, block_id, b"", 0)
+            self._dead[seg] = self._dead.get(seg, 0) + RECORD_HEADER.size + len(block_id.encode())
+        return size
+
+    def size(self, block_id):
+        with self._lock:
+            loc = self._index.get(block_id)
+        return None if loc is None else loc[2]
+
+    def list(self):
+        with self._lock:
+            return list(self._index)
+
+    def usage(self):
+        with self._lock:
+            return len(self._index), sum(loc[2] for loc in self._index.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "segments": len(self._segments()),
+                "active_segment": self._active,
+                "blocks": len(self._index),
+                "dead_bytes": sum(self._dead.values()),
+            }
+
+    def checkpoint(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            state = {
+                "segment": self._active,
+                "offset": self._tail,
+                "blocks": self._index.copy(),
+                "dead": {str(s): n for s, n in self._dead.items()},
+            }
+            self._dirty = False
+        path = os.path.join(self.root, "index.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def compact(self):
+        """Rewrite the live records of mostly-dead sealed segments to the end
+        of the log and drop those segments. Returns the segments dropped."""
+        with self._compact_lock:
+            with self._lock:
+                victims = [
+                    seg for seg in self._segments()
+                    if seg != self._active
+                    and self._dead.get(seg, 0)
+                    >= COMPACT_RATIO * os.path.getsize(self._seg_path(seg))
+                ]
+                live = {seg: [] for seg in victims}
+                for block_id, loc in self._index.items():
+                    if loc[0] in live:
+                        live[loc[0]].append(block_id)
+            # A tombstone is only carried forward while a segment that stays
+            # still holds a put of its block: replaying that put would
+            # otherwise bring the block back
+            deleted = set()
+            for seg in victims:
+                deleted.update(self._record_ids(seg, DELETE))
+            held = set()
+            if deleted:
+                for seg in self._segments():
+                    if seg not in live:
+                        held.update(b for b in self._record_ids(seg, PUT) if b in deleted)
+            for seg in victims:
+                self._compact_segment(seg, live[seg], held)
+            if victims:
+                # the checkpoint must not point into the dropped segments
+                with self._lock:
+                    self._dirty = True
+                self.checkpoint()
+                for seg in victims:
+                    with self._lock:
+                        self._maps.pop(seg, None)
+                        self._dead.pop(seg, None)
+                    os.remove(self._seg_path(seg))
+                print(f"[BLOCKSTORE] Compacted {len(victims)} segment(s)")
+            return victims
+
+    def _record_ids(self, seg, kind):
+        # Block ids of the `kind` records in seg, up to its current end
+        with open(self._seg_path(seg), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset = 0
+                while offset + RECORD_HEADER.size <= size:
+                    magic, rkind, id_len, length, _ = RECORD_HEADER.unpack_from(mm, offset)
+                    start = offset + RECORD_HEADER.size
+                    if magic != RECORD_MAGIC or start + id_len + length > size:
+                        return
+                    if rkind == kind:
+                        yield mm[start:start + id_len].decode()
+                    offset = start + id_len + length
+
+    def _compact_segment(self, seg, block_ids, held):
+        # held: ids of deleted blocks that other segments still have puts of
+        size = os.path.getsize(self._seg_path(seg))
+        mm = self._map(seg, size)
+        for block_id in block_ids:
+            with self._lock:
+                loc = self._index.get(block_id)
+                if loc is None or loc[0] != seg:
+                    continue
+                _, off, length, crc = loc
+                data = mm[off:off + length]
+                new_seg, new_off = self._append(PUT, block_id, data, crc)
+                self._index[block_id] = (new_seg, new_off, length, crc)
+        # Tombstones only matter while another segment still holds a put for
+        # the same block, and not once the block has been stored again (a
+        # copy at the end of the log would delete it on replay)
+        if not held:
+            return
+        offset = 0
+        while offset < size:
+            magic, kind, id_len, length, crc = RECORD_HEADER.unpack_from(mm, offset)
+            if kind == DELETE:
+                block_id = mm[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + id_len]
+                block_id = block_id.decode()
+                with self._lock:
+                    if block_id in held and block_id not in self._index:
+                        new_seg, _ = self._append(DELETE, block_id, b"", 0)
+                        self._dead[new_seg] = (
+                            self._dead.get(new_seg, 0) + RECORD_HEADER.size + id_len
+                        )
+            offset += RECORD_HEADER.size + id_len + length
+
+    def maintain(self):
+        self.compact()
+        self.checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        with self._lock:
+            os.close(self._fd)
+
+
+ENGINES = {"file": FileStore, "segment": SegmentStore}
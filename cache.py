@@ -0,0 +1,169 @@
+"""
+Caches for repeat reads.
+
+LocateCache keeps /locate answers for a short TTL so a file read over and
+over doesn't go back to the master each time. Replica lists can go stale
+within the TTL (a node dies, a block is re-replicated); the client drops
+the entry and asks again when a read fails.
+
+BlockCache keeps block contents in an LRU bounded by a byte budget. Block
+ids never get reused for different contents (they carry the file's upload
+generation, or are the content hash for dedup blocks), so a cached block
+is valid for as long as it is cached. Nodes keep their hottest blocks in
+one as well.
+
+Sizes come from the optional "client_cache" section of config/config.json,
+e.g. {"locate_ttl": 5, "block_cache_mb": 64}, or configure().
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a /locate answer is reused
+LOCATE_TTL = 5.0
+
+# Byte budget of the block LRU; 0 disables it
+BLOCK_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def configure(locate_ttl=None, block_cache_mb=None):
+    global LOCATE_TTL, BLOCK_CACHE_BYTES
+    if locate_ttl is not None:
+        LOCATE_TTL = float(locate_ttl)
+    if block_cache_mb is not None:
+        BLOCK_CACHE_BYTES = int(float(block_cache_mb) * 1024 * 1024)
+
+
+def _load_config():
+    cfg_path = os.path.join("config", "config.json")
+    if not os.path.exists(cfg_path):
+        return
+    try:
+        with open(cfg_path, "r") as f:
+            cache_cfg = json.load(f).get("client_cache", {})
+    except (OSError, ValueError):
+        return
+    configure(cache_cfg.get("locate_ttl"), cache_cfg.get("block_cache_mb"))
+
+
+class LocateCache:
+    """/locate answers per file. `key` tells apart answers for different
+    ranges of the same file (None is the whole file); invalidating a file
+    drops all of them."""
+
+    def __init__(self, ttl=None):
+        self.ttl = LOCATE_TTL if ttl is None else ttl
+        self._entries = {}  # filename -> {key: (expires_at, meta)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, filename, key=None):
+        now = time.monotonic()
+        with self._lock:
+            per_file = self._entries.get(filename, {})
+            entry = per_file.get(key)
+            if entry is not None and entry[0] <= now:
+                del per_file[key]
+                if not per_file:
+                    del self._entries[filename]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, filename, meta, key=None):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            per_file = self._entries.setdefault(filename, {})
+            per_file[key] = (time.monotonic() + self.ttl, meta)
+
+    def invalidate(self, filename=None):
+        with self._lock:
+            if filename is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(filename, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": sum(len(e) for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "ttl": self.ttl,
+            }
+
+
+class BlockCache:
+    """LRU of block contents. Values are bytes unless put() is given their
+    size explicitly."""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = BLOCK_CACHE_BYTES if max_bytes is None else max_bytes
+        self._blocks = OrderedDict()  # block_id -> (value, size), least recent first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, block_id):
+        with self._lock:
+            entry = self._blocks.get(block_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(block_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, block_id, value, size=None):
+        size = len(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(block_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._blocks[block_id] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self._bytes -= evicted[1]
+                self.evictions += 1
+
+    def discard(self, block_id):
+        with self._lock:
+            old = self._blocks.pop(block_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._blocks),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            }
+
+
+_load_config()
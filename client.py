@@ -1,112 +1,1139 @@
-import requests, os
+import hashlib, os, random, threading, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import compression
+import erasure
+import framing
+import http_pool
 
 MASTER_URL = "http://127.0.0.1:4000"
 
 # Must match master.py BLOCK_SIZE
 BLOCK_SIZE = 64 * 1024
 
+# Max blocks read ahead / in flight during an upload
+UPLOAD_WINDOW = 8
+
+# Upload engine concurrency: replica pushes overall / per node, and how many
+# alternate nodes a failed replica push is retried on
+UPLOAD_WORKERS = 16
+PER_NODE_UPLOADS = 4
+UPLOAD_RETRIES = 2
+
+# Download engine concurrency: block fetches overall / per node
+DOWNLOAD_WORKERS = 16
+PER_NODE_DOWNLOADS = 4
+
+# Files registered / located per /upload_batch or /locate_batch call
+UPLOAD_BATCH_FILES = 256
+LOCATE_BATCH = 256
+
+# Blocks bound for (or read from) the same node are sent in batches of up to
+# this many per request (/block_store_batch, /block_fetch_batch); 1 sends
+# every block on its own. Capped at framing.MAX_BATCH
+UPLOAD_BATCH = 16
+DOWNLOAD_BATCH = 16
+
+# Shared by every download/read in this process unless an engine brings its
+# own block cache; sizes are in cache.py / config "client_cache"
+locate_cache = cache.LocateCache()
+block_cache = cache.BlockCache()
+
+# Must match node.py CHECKSUM_HEADER: CRC32 of a block body as 8 hex digits
+CHECKSUM_HEADER = "X-Checksum"
+
+# Must match node.py COMPRESS_HEADER
+COMPRESS_HEADER = "X-Compress"
+
 
-def _split_file_into_blocks(path):
+def _iter_file_blocks(path, size=None):
+    # Reads one block at a time so only the blocks currently in flight are
+    # held in memory, whatever the file size. With `size`, exactly that many
+    # bytes are read (the size the blocks were registered for); a file that
+    # has shrunk below it raises UploadError.
     with open(path, "rb") as f:
-        data = f.read()
-    size = len(data)
-    blocks = []
-    for i in range(0, size, BLOCK_SIZE):
-        chunk_bytes = data[i : i + BLOCK_SIZE]
-        chunk_str = chunk_bytes.decode("utf-8", errors="ignore")
-        blocks.append(chunk_str)
-    return size, blocks
+        left = size
+        while left is None or left > 0:
+            chunk = f.read(BLOCK_SIZE if left is None else min(BLOCK_SIZE, left))
+            if not chunk:
+                if left:
+                    raise UploadError(f"{path} shrank during the upload")
+                break
+            if left is not None:
+                left -= len(chunk)
+            yield chunk
+
+
+def _iter_file_shards(path, k, m):
+    # Erasure-coded layout: each stripe covers k blocks of the file and
+    # yields its k data shards followed by its m parity shards.
+    with open(path, "rb") as f:
+        while True:
+            stripe = f.read(k * BLOCK_SIZE)
+            if not stripe:
+                break
+            data_shards = erasure.split(stripe, k)
+            yield from data_shards
+            yield from erasure.encode(data_shards, m)
+
+
+def _iter_compressed(blocks, codec, stats):
+    # Frames each block with `codec`, appending its compression stats to
+    # `stats` in block order.
+    for data in blocks:
+        frame, st = compression.encode_block(codec, data)
+        stats.append(st)
+        yield frame
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadEngine:
+    """Pushes blocks to their replicas concurrently.
+
+    max_workers caps the concurrent replica pushes overall, per_node_limit the
+    concurrent pushes to any one node and window the number of blocks read
+    from disk but not yet finished. A replica push that fails is retried on up
+    to `retries` alternate alive nodes; the placement actually achieved is
+    reported back to the master.
+
+    With chain=True each block is sent once, to the first node of its
+    placement, which forwards it along the remaining replicas. For a
+    compressed file, compress_on_node=True leaves compressing to the node
+    receiving the block instead of the client.
+
+    Otherwise blocks are read `batch` at a time and each node gets the ones
+    placed on it in a single /block_store_batch request; blocks a batch
+    failed to store go through the per-block retry path.
+    """
+
+    def __init__(self, max_workers=UPLOAD_WORKERS, per_node_limit=PER_NODE_UPLOADS,
+                 window=UPLOAD_WINDOW, retries=UPLOAD_RETRIES, timeout=10,
+                 chain=False, on_block_done=None, compress_on_node=False,
+                 batch=UPLOAD_BATCH):
+        self.compress_on_node = compress_on_node
+        self.batch = min(batch, framing.MAX_BATCH)
+        self.max_workers = max_workers
+        self.per_node_limit = per_node_limit
+        self.window = window
+        self.retries = retries
+        self.timeout = timeout
+        self.chain = chain
+        self.on_block_done = on_block_done
+        self._node_slots = {}
+        self._lock = threading.Lock()
+
+    def _node_slot(self, port):
+        with self._lock:
+            slot = self._node_slots.get(port)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.per_node_limit)
+                self._node_slots[port] = slot
+            return slot
+
+    def _store(self, state, port, pipeline=None):
+        # Returns the ports that acknowledged the block.
+        block_id, block_data = state["id"], state["data"]
+        with state["lock"]:
+            state["sent"] += len(block_data)
+        headers = {
+            "Content-Type": "application/octet-stream",
+            CHECKSUM_HEADER: f"{zlib.crc32(block_data):08x}",
+        }
+        if pipeline is not None:
+            headers["X-Pipeline"] = ",".join(pipeline)
+        if state["codec"]:
+            headers[COMPRESS_HEADER] = state["codec"]
+        with self._node_slot(port):
+            try:
+                rr = http_pool.post(
+                    f"http://127.0.0.1:{port}/block_store_raw",
+                    params={"block_id": block_id},
+                    data=block_data,
+                    headers=headers,
+                    timeout=self.timeout * (1 + len(pipeline or ())),
+                )
+                if rr.status_code == 200:
+                    if state["codec"]:
+                        state["compression"] = rr.json().get("compression")
+                    if pipeline is None:
+                        return [port]
+                    ack = rr.json()
+                    for p in ack.get("failed", []):
+                        print(f"[WARN] Chain hop {p} failed for block {block_id}")
+                    return ack.get("stored", [])
+                print(f"[WARN] Node {port} failed for block {block_id}: {rr.text}")
+            except Exception as e:
+                print(f"[WARN] Error pushing block {block_id} to node {port}: {e}")
+        return []
+
+    def _store_batch(self, port, states):
+        # Returns the ids of the blocks the node acknowledged.
+        body = framing.pack((st["id"], st["data"]) for st in states)
+        for st in states:
+            with st["lock"]:
+                st["sent"] += len(st["data"])
+        with self._node_slot(port):
+            try:
+                rr = http_pool.post(
+                    f"http://127.0.0.1:{port}/block_store_batch",
+                    data=body,
+                    headers={"Content-Type": "application/octet-stream"},
+                    timeout=self.timeout * 2,
+                )
+                if rr.status_code == 200:
+                    ack = rr.json()
+                    for block_id, reason in ack.get("failed", {}).items():
+                        print(f"[WARN] Node {port} failed for block {block_id}: {reason}")
+                    return set(ack.get("stored", []))
+                print(f"[WARN] Node {port} failed a batch of {len(states)} blocks: {rr.text}")
+            except Exception as e:
+                print(f"[WARN] Error pushing {len(states)} blocks to node {port}: {e}")
+        return set()
 
+    def _push_batch(self, filename, port, states, results, window):
+        stored = self._store_batch(port, states)
+        for st in states:
+            got = [port] if st["id"] in stored else self._push_replica(st, port)
+            self._replica_done(filename, st, got, results, window)
 
-def upload_file(path, replication_factor):
+    def _submit_batches(self, pool, filename, states, results, window):
+        by_node = {}
+        for st in states:
+            for p in st["nodes"]:
+                by_node.setdefault(p, []).append(st)
+        for p, group in by_node.items():
+            pool.submit(self._push_batch, filename, p, group, results, window)
+
+    def _alternate(self, state):
+        # the engine lock: shards of one stripe share their "taken" set
+        with self._lock:
+            alternates = [p for p in state["alternates"] if p not in state["taken"]]
+            if not alternates:
+                return None
+            port = random.choice(alternates)
+            state["taken"].add(port)
+            return port
+
+    def _push_replica(self, state, port, pipeline=None):
+        attempts = 0
+        while True:
+            stored = self._store(state, port, pipeline)
+            if stored:
+                return stored
+            if attempts >= self.retries:
+                return []
+            port = self._alternate(state)
+            if port is None:
+                return []
+            attempts += 1
+
+    def _push_chain(self, state):
+        nodes = state["nodes"]
+        stored = self._push_replica(state, nodes[0], nodes[1:])
+        # replicas dropped by a broken hop are written directly
+        for _ in range(len(nodes) - len(stored)):
+            port = self._alternate(state)
+            if port is None:
+                break
+            stored += self._push_replica(state, port)
+        return stored
+
+    def _replica_done(self, filename, state, stored, results, window):
+        with state["lock"]:
+            state["stored"].extend(stored)
+            state["remaining"] -= 1
+            if state["remaining"]:
+                return
+
+        stored = state["stored"]
+        result = {
+            "index": state["index"],
+            "id": state["id"],
+            "size": len(state["data"]),
+            "sent": state["sent"],
+            "nodes": stored,
+            "wanted": len(state["nodes"]),
+            "failed": [p for p in state["nodes"] if p not in stored],
+        }
+        if state.get("compression"):
+            result["compression"] = state["compression"]
+        if state["filename"] is not None:
+            result["filename"] = state["filename"]
+        if sorted(stored) != sorted(state["nodes"]):
+            _report_block_replicas(state["filename"] or filename, state["id"], stored)
+
+        state["data"] = None
+        with self._lock:
+            results.append(result)
+        try:
+            if self.on_block_done:
+                self.on_block_done(result)
+        finally:
+            window.release()
+
+    def upload(self, filename, blocks, block_metas, alive_nodes=(), node_codec=None,
+               stripe_width=None):
+        """Upload `blocks` (an iterable of bytes) to the placement in
+        `block_metas` and return a report with per-block results and the
+        aggregate throughput. node_codec asks the receiving nodes to
+        compress the blocks with that codec. A block meta with a "filename"
+        belongs to that file rather than `filename`, so blocks of many files
+        can go through one call.
+
+        With stripe_width, every stripe_width consecutive blocks are the
+        shards of one erasure-coded stripe: a failed shard is only retried
+        on a node holding no other shard of its stripe, or fails."""
+        results = []
+        batching = self.batch > 1 and not self.chain and not node_codec
+        # room for the next batch to be read while one is in flight
+        window = threading.BoundedSemaphore(
+            max(self.window, 2 * self.batch) if batching else self.window
+        )
+        pending = []
+        stripes = {}  # stripe -> nodes its shards are placed or retried on
+        started = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for index, (block_data, bmeta) in enumerate(zip(blocks, block_metas)):
+                window.acquire()
+                nodes = list(bmeta["nodes"])
+                if stripe_width:
+                    first = index - index % stripe_width
+                    taken = stripes.get(first)
+                    if taken is None:
+                        taken = stripes[first] = {
+                            p for b in block_metas[first:first + stripe_width] for p in b["nodes"]
+                        }
+                else:
+                    taken = set(nodes)
+                state = {
+                    "index": index,
+                    "id": bmeta["id"],
+                    "filename": bmeta.get("filename"),
+                    "data": block_data,
+                    "nodes": nodes,
+                    "alternates": [p for p in alive_nodes if p not in taken],
+                    "taken": taken,
+                    "stored": [],
+                    "sent": 0,
+                    "remaining": 1 if self.chain else len(nodes),
+                    "codec": node_codec,
+                    "lock": threading.Lock(),
+                }
+                if batching:
+                    pending.append(state)
+                    if len(pending) >= self.batch:
+                        self._submit_batches(pool, filename, pending, results, window)
+                        pending = []
+                    continue
+                if self.chain:
+                    futures = [pool.submit(self._push_chain, state)]
+                else:
+                    futures = [pool.submit(self._push_replica, state, p) for p in nodes]
+                for fut in futures:
+                    fut.add_done_callback(
+                        lambda f, st=state: self._replica_done(
+                            filename, st, f.result(), results, window
+                        )
+                    )
+            if pending:
+                self._submit_batches(pool, filename, pending, results, window)
+
+        elapsed = max(time.time() - started, 1e-6)
+        results.sort(key=lambda r: r["index"])
+        total_bytes = sum(r["size"] for r in results)
+        return {
+            "filename": filename,
+            "blocks": results,
+            "complete": sum(1 for r in results if len(r["nodes"]) >= r["wanted"]),
+            "degraded": sum(1 for r in results if 0 < len(r["nodes"]) < r["wanted"]),
+            "failed": sum(1 for r in results if not r["nodes"]),
+            "bytes": total_bytes,
+            "wire_bytes": sum(r["sent"] for r in results),
+            "seconds": elapsed,
+            "throughput_mb_s": total_bytes / elapsed / 1e6,
+        }
+
+
+def _report_block_replicas(filename, block_id, replicas):
+    try:
+        http_pool.post(
+            MASTER_URL + "/block_replicas",
+            json={"filename": filename, "block_id": block_id, "replicas": replicas},
+            timeout=5,
+        )
+    except Exception as e:
+        print(f"[WARN] Could not report placement of {block_id}: {e}")
+
+
+def _iter_new_blocks(blocks, block_metas):
+    for data, bmeta in zip(blocks, block_metas):
+        if not bmeta.get("exists"):
+            yield data
+
+
+def upload_path(path, replication_factor, engine=None, ec=None, dedup=False,
+                compression_codec=None):
+    """Register `path` with the master and upload its blocks.
+
+    With ec=(k, m) the file is erasure coded instead of replicated: every k
+    blocks form a stripe stored as k data + m parity shards, and
+    replication_factor is ignored.
+
+    With dedup=True blocks are content addressed: the file is hashed first
+    and only blocks the master doesn't already store are sent. The report
+    then also counts the blocks and bytes that were skipped.
+
+    With compression_codec (e.g. "zlib") every block is stored compressed,
+    or raw if it doesn't compress; the report gets a "compression" summary
+    with the ratio and CPU time per block, and its throughput counts
+    uncompressed bytes.
+
+    Returns the UploadEngine report; raises UploadError if the master rejects
+    the upload.
+    """
     filename = os.path.basename(path)
     if not os.path.exists(path):
-        return f"Path not found: {path}"
+        raise UploadError(f"Path not found: {path}")
 
-    size, blocks = _split_file_into_blocks(path)
-    num_blocks = len(blocks)
+    engine = engine or UploadEngine()
+    codec = compression_codec
+    if codec:
+        try:
+            compression.check_codec(codec)
+        except ValueError as e:
+            raise UploadError(str(e))
+        if ec:
+            raise UploadError("compression and ec can't be combined")
+    # dedup ids hash the stored (framed) bytes, so the client frames itself
+    node_codec = codec if codec and engine.chain and engine.compress_on_node and not dedup else None
+    comp_stats = []
 
-    r = requests.post(
-        MASTER_URL + "/upload",
-        json={
-            "filename": filename,
-            "replication_factor": replication_factor,
-            "num_blocks": num_blocks,
-            "size": size,
-        },
-    )
+    def file_blocks(block_metas=None):
+        # block_metas: skip the blocks the master reported as already stored
+        blocks = _iter_file_blocks(path)
+        if block_metas is not None:
+            blocks = _iter_new_blocks(blocks, block_metas)
+        if codec and not node_codec:
+            blocks = _iter_compressed(blocks, codec, comp_stats)
+        return blocks
+
+    size = os.stat(path).st_size
+    req = {
+        "filename": filename,
+        "replication_factor": replication_factor,
+        "size": size,
+    }
+    if codec:
+        req["compression"] = codec
+    if ec:
+        k, m = ec
+        try:
+            erasure.check_params(k, m)
+            erasure.require_numpy()
+        except (ValueError, RuntimeError) as e:
+            raise UploadError(str(e))
+        req["ec"] = {"k": k, "m": m}
+        req["num_blocks"] = (size + k * BLOCK_SIZE - 1) // (k * BLOCK_SIZE)
+        expected = req["num_blocks"] * (k + m)
+        blocks = _iter_file_shards(path, k, m)
+    elif dedup:
+        req["dedup"] = True
+        req["hashes"] = [hashlib.sha256(b).hexdigest() for b in file_blocks()]
+        req["num_blocks"] = expected = len(req["hashes"])
+        comp_stats.clear()
+    else:
+        req["num_blocks"] = expected = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        blocks = file_blocks()
+
+    locate_cache.invalidate(filename)
+    r = http_pool.post(MASTER_URL + "/upload", json=req)
     if r.status_code != 200:
-        return f"Master upload error: {r.text}"
+        raise UploadError(f"Master upload error: {r.text}")
 
     meta = r.json()
     block_metas = meta.get("blocks", [])
-    if len(block_metas) != num_blocks:
-        return "Master returned inconsistent block mapping"
+    if len(block_metas) != expected:
+        raise UploadError("Master returned inconsistent block mapping")
+
+    alive_nodes = meta.get("alive_nodes", [])
+    if dedup and not ec:
+        new_metas = [b for b in block_metas if not b.get("exists")]
+        report = engine.upload(filename, file_blocks(block_metas), new_metas, alive_nodes)
+        skipped = [i for i, b in enumerate(block_metas) if b.get("exists")]
+        report["deduplicated"] = len(skipped)
+        report["deduplicated_bytes"] = sum(min(BLOCK_SIZE, size - i * BLOCK_SIZE) for i in skipped)
+    elif ec:
+        report = engine.upload(filename, blocks, block_metas, alive_nodes, stripe_width=k + m)
+    else:
+        report = engine.upload(filename, blocks, block_metas, alive_nodes, node_codec)
+
+    if codec:
+        if node_codec:
+            comp_stats = [r["compression"] for r in report["blocks"] if r.get("compression")]
+        report["compression"] = compression.summarize(codec, comp_stats)
+        # throughput of file data, not of the smaller frames sent
+        report["throughput_mb_s"] = (
+            report["compression"]["raw_bytes"] / report["seconds"] / 1e6
+        )
+    return report
+
+
+def upload_directory(path, replication_factor, prefix=None, engine=None, compression_codec=None):
+    """Upload every file under the directory `path` as <prefix>/<relative
+    path> (prefix defaults to the directory's name).
+
+    Files are registered with the master UPLOAD_BATCH_FILES at a time
+    through /upload_batch, and the blocks of each such group go through a
+    single UploadEngine.upload call, so small files share both the master
+    round trip and the per-node block batches. Empty files are skipped (the
+    master stores no zero-block files). Returns a report with per-file
+    outcomes and the aggregate throughput.
+
+    Each file is uploaded at the size it had when registered: bytes
+    appended later are left out, and a file that shrinks in the meantime
+    aborts the upload with UploadError.
+    """
+    if not os.path.isdir(path):
+        raise UploadError(f"Not a directory: {path}")
+    if prefix is None:
+        prefix = os.path.basename(os.path.abspath(path))
+    if compression_codec:
+        try:
+            compression.check_codec(compression_codec)
+        except ValueError as e:
+            raise UploadError(str(e))
+
+    files, skipped = [], []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            local = os.path.join(root, name)
+            remote = os.path.relpath(local, path).replace(os.sep, "/")
+            if prefix:
+                remote = prefix.strip("/") + "/" + remote
+            size = os.stat(local).st_size
+            if size:
+                files.append((local, remote, size))
+            else:
+                skipped.append(remote)
+
+    engine = engine or UploadEngine()
+    uploaded, failed = [], {}
+    total_bytes = 0
+    started = time.time()
+    for n in range(0, len(files), UPLOAD_BATCH_FILES):
+        group = files[n:n + UPLOAD_BATCH_FILES]
+        reqs = []
+        for _, remote, size in group:
+            req = {
+                "filename": remote,
+                "replication_factor": replication_factor,
+                "size": size,
+                "num_blocks": (size + BLOCK_SIZE - 1) // BLOCK_SIZE,
+            }
+            if compression_codec:
+                req["compression"] = compression_codec
+            reqs.append(req)
+            locate_cache.invalidate(remote)
+        r = http_pool.post(MASTER_URL + "/upload_batch", json={"files": reqs})
+        if r.status_code != 200:
+            raise UploadError(f"Master upload error: {r.text}")
+        reply = r.json()
+
+        block_metas, sources = [], []
+        for (local, remote, size), meta in zip(group, reply["files"]):
+            if "error" in meta:
+                failed[remote] = meta["error"]
+                continue
+            block_metas.extend(dict(b, filename=remote) for b in meta["blocks"])
+            sources.append((local, size))
+
+        def blocks(sources=sources):
+            # blocks of all files go through one zip with block_metas: each
+            # file has to yield exactly the blocks registered for it
+            for local, size in sources:
+                data = _iter_file_blocks(local, size)
+                if compression_codec:
+                    data = _iter_compressed(data, compression_codec, [])
+                yield from data
+
+        report = engine.upload(
+            prefix, blocks(), block_metas, alive_nodes=reply.get("alive_nodes", [])
+        )
+        for res in report["blocks"]:
+            if not res["nodes"]:
+                failed.setdefault(res["filename"], f"block {res['id']} not stored")
+        uploaded.extend(
+            remote for _, remote, _ in group
+            if remote not in failed
+        )
+        total_bytes += sum(size for _, remote, size in group if remote not in failed)
+
+    elapsed = max(time.time() - started, 1e-6)
+    return {
+        "prefix": prefix,
+        "files": len(uploaded),
+        "uploaded": uploaded,
+        "failed": failed,
+        "skipped": skipped,
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "files_per_sec": len(uploaded) / elapsed,
+        "throughput_mb_s": total_bytes / elapsed / 1e6,
+    }
+
+
+def upload_file(path, replication_factor, chain=False, ec=None, dedup=False,
+                compression_codec=None):
+    try:
+        report = upload_path(
+            path, replication_factor, UploadEngine(chain=chain), ec, dedup, compression_codec
+        )
+    except UploadError as e:
+        return str(e)
+
+    scheme = f"EC {ec[0]}+{ec[1]}" if ec else f"RF={replication_factor}"
+    msg = (
+        f"Uploaded {report['filename']} as {len(report['blocks'])} blocks, "
+        f"{scheme} ({report['throughput_mb_s']:.2f} MB/s)"
+    )
+    if report.get("compression"):
+        c = report["compression"]
+        msg += f", {c['codec']} ratio {c['ratio']:.2f} ({c['cpu_seconds']:.3f}s CPU)"
+    if report.get("deduplicated"):
+        msg += f", {report['deduplicated']} already stored"
+    if report["degraded"] or report["failed"]:
+        msg += f", {report['degraded']} degraded, {report['failed']} failed"
+    return msg
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadEngine:
+    """Fetches blocks concurrently and writes each one straight to its offset
+    in a preallocated output file.
+
+    Only max_workers blocks are in memory at once. Each block is read from
+    its alive replicas in a rotating order so consecutive blocks are spread
+    over different nodes; a failed fetch falls back to the next replica.
+
+    With a block_cache (cache.BlockCache) whole stored blocks are kept and
+    served from it on later reads, ranged or not.
+
+    Whole-file downloads of replicated files fetch the blocks that would be
+    read from the same node `batch` at a time with /block_fetch_batch; a
+    block missing from a batch reply is fetched on its own.
+    """
+
+    def __init__(self, max_workers=DOWNLOAD_WORKERS, per_node_limit=PER_NODE_DOWNLOADS,
+                 timeout=8, on_block_done=None, block_cache=None, batch=DOWNLOAD_BATCH):
+        self.block_cache = block_cache
+        self.batch = min(batch, framing.MAX_BATCH)
+        self.max_workers = max_workers
+        self.per_node_limit = per_node_limit
+        self.timeout = timeout
+        self.on_block_done = on_block_done
+        self._node_slots = {}
+        self._lock = threading.Lock()
+
+    def _node_slot(self, port):
+        with self._lock:
+            slot = self._node_slots.get(port)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.per_node_limit)
+                self._node_slots[port] = slot
+            return slot
+
+    def _fetch(self, index, block, byte_range=None):
+        # byte_range=(offset, length) asks the node for just those bytes of
+        # the stored block, unless the block cache has the whole block; only
+        # whole blocks go into the cache.
+        if self.block_cache is None:
+            return self._fetch_from_nodes(index, block, byte_range)
+        data = self.block_cache.get(block["id"])
+        if data is not None:
+            if byte_range is not None:
+                data = data[byte_range[0]:byte_range[0] + byte_range[1]]
+            return data
+        data = self._fetch_from_nodes(index, block, byte_range)
+        if data is not None and byte_range is None:
+            self.block_cache.put(block["id"], data)
+        return data
+
+    def _report_mismatch(self, port, block_id):
+        # Nodes stream blocks without checking them; have this one verify its
+        # copy so a corrupt replica is dropped and re-replicated
+        try:
+            http_pool.post(
+                f"http://127.0.0.1:{port}/check_block", json={"block_id": block_id}, timeout=2
+            )
+        except Exception:
+            pass
+
+    def _fetch_from_nodes(self, index, block, byte_range):
+        params = {"block_id": block["id"]}
+        if byte_range is not None:
+            params["offset"], params["length"] = byte_range
+        nodes = block["nodes"]
+        alive = block.get("alive", len(nodes))
+        if alive:
+            k = index % alive
+            nodes = nodes[k:alive] + nodes[:k] + nodes[alive:]
 
-    for idx, (block_data, bmeta) in enumerate(zip(blocks, block_metas)):
-        block_id = bmeta["id"]
-        nodes = bmeta["nodes"]
         for p in nodes:
+            with self._node_slot(p):
+                try:
+                    rr = http_pool.get(
+                        f"http://127.0.0.1:{p}/block_fetch_raw",
+                        params=params,
+                        timeout=self.timeout,
+                    )
+                    if rr.status_code != 200:
+                        continue
+                    expected = rr.headers.get(CHECKSUM_HEADER)
+                    if expected is not None and int(expected, 16) != zlib.crc32(rr.content):
+                        print(f"[WARN] Checksum mismatch for block {block['id']} from node {p}")
+                        self._report_mismatch(p, block["id"])
+                        continue
+                    return rr.content
+                except Exception:
+                    continue
+        return None
+
+    def _fetch_and_write(self, fd, write_lock, index, block, block_size, codec, stats):
+        data = self._fetch(index, block)
+        return self._write_data(fd, write_lock, index, block, data, block_size, codec, stats)
+
+    def _fetch_batch(self, port, items):
+        # {block_id: data} for the blocks `port` returned intact
+        got = {}
+        with self._node_slot(port):
             try:
-                rr = requests.post(
-                    f"http://127.0.0.1:{p}/block_store",
-                    json={"block_id": block_id, "data": block_data},
-                    timeout=10,
+                rr = http_pool.post(
+                    f"http://127.0.0.1:{port}/block_fetch_batch",
+                    json={"block_ids": [b["id"] for _, b in items]},
+                    timeout=self.timeout * 2,
                 )
                 if rr.status_code != 200:
-                    print(f"[WARN] Node {p} failed for block {block_id}: {rr.text}")
-            except Exception as e:
-                print(f"[WARN] Error pushing block {block_id} to node {p}: {e}")
+                    return got
+                for block_id, status, data, crc in framing.unpack(rr.content):
+                    if status != framing.OK:
+                        continue
+                    if zlib.crc32(data) != crc:
+                        print(f"[WARN] Checksum mismatch for block {block_id} from node {port}")
+                        self._report_mismatch(port, block_id)
+                        continue
+                    got[block_id] = data
+            except Exception:
+                pass
+        return got
 
-    return f"Uploaded {filename} as {num_blocks} blocks, RF={replication_factor}"
+    def _fetch_batch_and_write(self, fd, write_lock, port, items, block_size, codec, stats):
+        # items: (index, block) pairs whose first choice of replica is `port`
+        got = {}
+        wanted = items
+        if self.block_cache is not None:
+            for _, b in items:
+                data = self.block_cache.get(b["id"])
+                if data is not None:
+                    got[b["id"]] = data
+            wanted = [(i, b) for i, b in items if b["id"] not in got]
+        if wanted and port is not None:
+            fetched = self._fetch_batch(port, wanted)
+            if self.block_cache is not None:
+                for block_id, data in fetched.items():
+                    self.block_cache.put(block_id, data)
+            got.update(fetched)
 
+        total = 0
+        for index, block in items:
+            data = got.pop(block["id"], None)
+            if data is None:
+                data = self._fetch(index, block)
+            total += self._write_data(fd, write_lock, index, block, data, block_size, codec, stats)
+        return total
 
-def download_file(filename):
-    r = requests.post(MASTER_URL + "/locate", json={"filename": filename})
-    if r.status_code != 200:
-        return "File not found"
+    def _write_data(self, fd, write_lock, index, block, data, block_size, codec, stats):
+        if data is None:
+            raise DownloadError(f"Failed to download block {block['id']} from all replicas")
+        if codec:
+            started = time.thread_time()
+            stored = len(data)
+            data = compression.decode_block(data)
+            with write_lock:
+                stats["stored_bytes"] += stored
+                stats["cpu_seconds"] += time.thread_time() - started
 
-    meta = r.json()
-    blocks = meta.get("blocks", [])
+        offset = index * block_size
+        if hasattr(os, "pwrite"):
+            os.pwrite(fd, data, offset)
+        else:
+            with write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
 
-    assembled = []
-    for b in blocks:
-        block_id = b["id"]
-        nodes = b["nodes"]
-        block_data = None
+        if self.on_block_done:
+            self.on_block_done(index, block["id"])
+        return len(data)
 
-        for p in nodes:
+    def _read_stripe(self, stripe, shards, ec):
+        # Reads the data shards; each one that fails is replaced by the next
+        # parity shard, and the stripe is decoded only if any data was lost
+        # (degraded read). Returns the k data shards joined, still padded.
+        k, m = ec["k"], ec["m"]
+        first = stripe * (k + m)
+        got = {}
+        for j in range(k + m):
+            if len(got) == k:
+                break
+            if j >= k and len(got) + (k + m - j) < k:
+                break
+            data = self._fetch(first + j, shards[j])
+            if data is not None:
+                got[j] = data
+                if self.on_block_done:
+                    self.on_block_done(first + j, shards[j]["id"])
+        if len(got) < k:
+            raise DownloadError(f"Stripe {stripe}: only {len(got)} of {k} shards readable")
+
+        data_shards = erasure.reconstruct(got, k, m, range(k))
+        return b"".join(data_shards[j] for j in range(k))
+
+    def _fetch_stripe(self, fd, write_lock, stripe, shards, ec, block_size, size):
+        offset = stripe * ec["k"] * block_size
+        data = self._read_stripe(stripe, shards, ec)[:max(size - offset, 0)]
+        if hasattr(os, "pwrite"):
+            os.pwrite(fd, data, offset)
+        else:
+            with write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+        return len(data)
+
+    def _read_block_range(self, out, start, index, block, block_size, size, codec, lo, hi):
+        # Copies file bytes [lo, hi) held by block `index` into out. Plain
+        # blocks are sliced by the node unless the range is the whole block;
+        # compressed ones have to come whole to be decoded.
+        base = index * block_size
+        if codec:
+            data = self._fetch(index, block)
+            if data is not None:
+                data = compression.decode_block(data)[lo - base:hi - base]
+        elif lo == base and hi == min(base + block_size, size):
+            data = self._fetch(index, block)
+        else:
+            data = self._fetch(index, block, (lo - base, hi - lo))
+        if data is None or len(data) != hi - lo:
+            raise DownloadError(f"Failed to read block {block['id']} from all replicas")
+        out[lo - start:hi - start] = data
+        return len(data)
+
+    def _read_stripe_range(self, out, start, stripe, shards, ec, block_size, size, lo, hi):
+        # Same for the bytes of one stripe: only the data shards overlapping
+        # the range are asked for, and only those bytes of them. If any of
+        # them can't be read the whole stripe is read and decoded instead.
+        k = ec["k"]
+        base = stripe * k * block_size
+        shard_len = -(-min(k * block_size, size - base) // k)
+        parts = []
+        for j in range((lo - base) // shard_len, (hi - 1 - base) // shard_len + 1):
+            a = max(lo, base + j * shard_len)
+            b = min(hi, base + (j + 1) * shard_len)
+            data = self._fetch(
+                stripe * (k + ec["m"]) + j, shards[j],
+                (a - base - j * shard_len, b - a),
+            )
+            if data is None or len(data) != b - a:
+                erasure.require_numpy()
+                whole = self._read_stripe(stripe, shards, ec)
+                out[lo - start:hi - start] = whole[lo - base:hi - base]
+                return hi - lo
+            parts.append(data)
+        out[lo - start:hi - start] = b"".join(parts)
+        return hi - lo
+
+    def read(self, meta, offset, length=None):
+        """Return `length` bytes of the file from `offset` (to the end if
+        length is None), given a /locate response that covers that range.
+        Only the blocks holding the range are touched."""
+        size = meta.get("size", 0)
+        end = size if length is None else min(size, offset + length)
+        if offset >= end:
+            return b""
+        blocks = meta.get("blocks", [])
+        block_size = meta.get("block_size", BLOCK_SIZE)
+        ec = meta.get("ec")
+        codec = meta.get("compression")
+        out = bytearray(end - offset)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = []
+            if ec:
+                width = ec["k"] + ec["m"]
+                stripe_bytes = ec["k"] * block_size
+                for i in range(0, len(blocks), width):
+                    stripe = blocks[i]["index"] // width
+                    lo = max(offset, stripe * stripe_bytes)
+                    hi = min(end, (stripe + 1) * stripe_bytes)
+                    if lo < hi:
+                        futures.append(pool.submit(
+                            self._read_stripe_range, out, offset, stripe,
+                            blocks[i:i + width], ec, block_size, size, lo, hi,
+                        ))
+            else:
+                for b in blocks:
+                    lo = max(offset, b["index"] * block_size)
+                    hi = min(end, (b["index"] + 1) * block_size)
+                    if lo < hi:
+                        futures.append(pool.submit(
+                            self._read_block_range, out, offset, b["index"], b,
+                            block_size, size, codec, lo, hi,
+                        ))
             try:
-                rr = requests.post(
-                    f"http://127.0.0.1:{p}/block_fetch",
-                    json={"block_id": block_id},
-                    timeout=8,
-                )
-                if rr.status_code == 200:
-                    block_data = rr.json().get("data", "")
-                    break
-            except Exception:
-                continue
+                total = sum(fut.result() for fut in futures)
+            except DownloadError:
+                for fut in futures:
+                    fut.cancel()
+                raise
+        if total != len(out):
+            raise DownloadError(f"Read {total} of {len(out)} bytes")
+        return bytes(out)
+
+    def download(self, meta, out_path):
+        """Download the file described by a /locate response to out_path and
+        return a report with the byte count and throughput."""
+        blocks = meta.get("blocks", [])
+        block_size = meta.get("block_size", BLOCK_SIZE)
+        ec = meta.get("ec")
+        codec = meta.get("compression")
+        comp_stats = {"stored_bytes": 0, "cpu_seconds": 0.0}
+        started = time.time()
+
+        with open(out_path, "wb") as f:
+            f.truncate(meta.get("size", 0))
+            write_lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                if ec:
+                    erasure.require_numpy()
+                    width = ec["k"] + ec["m"]
+                    futures = [
+                        pool.submit(
+                            self._fetch_stripe, f.fileno(), write_lock, s,
+                            blocks[s * width:(s + 1) * width], ec, block_size,
+                            meta.get("size", 0),
+                        )
+                        for s in range(len(blocks) // width)
+                    ]
+                elif self.batch > 1:
+                    # group by the replica _fetch would try first
+                    by_node = {}
+                    for i, b in enumerate(blocks):
+                        alive = b.get("alive", len(b["nodes"]))
+                        port = b["nodes"][i % alive] if alive else None
+                        by_node.setdefault(port, []).append((i, b))
+                    futures = [
+                        pool.submit(
+                            self._fetch_batch_and_write, f.fileno(), write_lock, port,
+                            items[n:n + self.batch], block_size, codec, comp_stats,
+                        )
+                        for port, items in by_node.items()
+                        for n in range(0, len(items), self.batch)
+                    ]
+                else:
+                    futures = [
+                        pool.submit(
+                            self._fetch_and_write, f.fileno(), write_lock, i, b, block_size,
+                            codec, comp_stats,
+                        )
+                        for i, b in enumerate(blocks)
+                    ]
+                try:
+                    total = sum(fut.result() for fut in futures)
+                except DownloadError:
+                    for fut in futures:
+                        fut.cancel()
+                    raise
+
+        elapsed = max(time.time() - started, 1e-6)
+        report = {
+            "filename": meta.get("filename"),
+            "path": out_path,
+            "blocks": len(blocks),
+            "bytes": total,
+            "seconds": elapsed,
+            "throughput_mb_s": total / elapsed / 1e6,
+        }
+        if codec:
+            stored = comp_stats["stored_bytes"]
+            report["compression"] = dict(
+                comp_stats, codec=codec, ratio=total / stored if stored else 1.0
+            )
+        return report
+
+
+def _locate(filename):
+    # Whole-file /locate through locate_cache; ranged reads pick their
+    # blocks from it with _covering(), so any range of a cached file is
+    # served without asking the master
+    meta = locate_cache.get(filename)
+    if meta is not None:
+        return meta, True
+
+    r = http_pool.post(MASTER_URL + "/locate", json={"filename": filename})
+    if r.status_code != 200:
+        raise DownloadError("File not found" if r.status_code == 404 else r.text)
+    meta = r.json()
+    locate_cache.put(filename, meta)
+    return meta, False
+
+
+def _covering(meta, offset, length):
+    # The locate response cut down to the blocks holding the range, as the
+    # master's ranged /locate would answer (EC files on whole stripes)
+    size = meta.get("size", 0)
+    end = size if length is None else min(size, offset + length)
+    if offset >= end:
+        return dict(meta, blocks=[])
+    block_size = meta.get("block_size", BLOCK_SIZE)
+    ec = meta.get("ec")
+    if ec:
+        stripe = ec["k"] * block_size
+        width = ec["k"] + ec["m"]
+        lo, hi = offset // stripe * width, ((end - 1) // stripe + 1) * width
+    else:
+        lo, hi = offset // block_size, (end - 1) // block_size + 1
+    return dict(meta, blocks=meta.get("blocks", [])[lo:hi])
+
+
+def download_path(filename, out_path=None, engine=None):
+    """Download `filename` to out_path (default downloads/<filename>).
+
+    Returns the DownloadEngine report; raises DownloadError if the file is
+    unknown or a block cannot be read from any replica.
+    """
+    if out_path is None:
+        # names stored before the master checked them may still climb out
+        parts = filename.replace("\\", "/").split("/")
+        if any(part in ("", ".", "..") for part in parts):
+            raise DownloadError(f"Can't save {filename!r} under downloads/")
+        out_path = os.path.join("downloads", *parts)
+
+    meta, cached = _locate(filename)
+    # names with "/" land in subdirectories
+    if os.path.dirname(out_path):
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    engine = engine or DownloadEngine(block_cache=block_cache)
+    try:
+        try:
+            return engine.download(meta, out_path)
+        except DownloadError:
+            if not cached:
+                raise
+            # the cached replica list may be stale: ask the master again
+            locate_cache.invalidate(filename)
+            return engine.download(_locate(filename)[0], out_path)
+    except DownloadError:
+        os.remove(out_path)
+        raise
+
+
+def locate_batch(filenames):
+    """/locate many files in one master round trip (per LOCATE_BATCH names),
+    going through locate_cache. Returns {filename: locate response}; unknown
+    files are left out."""
+    out, wanted = {}, []
+    for name in filenames:
+        meta = locate_cache.get(name)
+        if meta is not None:
+            out[name] = meta
+        else:
+            wanted.append(name)
+    for n in range(0, len(wanted), LOCATE_BATCH):
+        r = http_pool.post(
+            MASTER_URL + "/locate_batch", json={"files": wanted[n:n + LOCATE_BATCH]}
+        )
+        if r.status_code != 200:
+            raise DownloadError(r.text)
+        for meta in r.json()["files"]:
+            locate_cache.put(meta["filename"], meta)
+            out[meta["filename"]] = meta
+    return out
+
+
+def read(filename, offset=0, length=None, engine=None):
+    """Read `length` bytes of `filename` starting at `offset` (to the end of
+    the file if length is None) without downloading the rest of it.
+
+    The read is clipped to the file size. Raises DownloadError if the file
+    is unknown or a needed block cannot be read.
+    """
+    meta, cached = _locate(filename)
+
+    engine = engine or DownloadEngine(block_cache=block_cache)
+    try:
+        return engine.read(_covering(meta, offset, length), offset, length)
+    except DownloadError:
+        if not cached:
+            raise
+        locate_cache.invalidate(filename)
+        meta = _locate(filename)[0]
+        return engine.read(_covering(meta, offset, length), offset, length)
+
+
+def cache_stats():
+    """Hit/miss/eviction counters of the process-wide locate and block caches."""
+    return {"locate": locate_cache.stats(), "blocks": block_cache.stats()}
+
+
+def download_file(filename):
+    try:
+        report = download_path(filename)
+    except DownloadError as e:
+        return str(e)
+    return f"Downloaded to {report['path']}"
 
-        if block_data is None:
-            return f"Failed to download block {block_id} from all replicas"
 
-        assembled.append(block_data)
+def list_files(prefix="", cursor=None, limit=None, delimiter=None):
+    """One page of the master's /list: {"files": [summaries], "dirs": [...],
+    "next_cursor": ...}. Pass next_cursor back to get the following page."""
+    params = {"prefix": prefix}
+    if cursor is not None:
+        params["cursor"] = cursor
+    if limit is not None:
+        params["limit"] = limit
+    if delimiter:
+        params["delimiter"] = delimiter
+    return http_pool.get(MASTER_URL + "/list", params=params).json()
 
-    os.makedirs("downloads", exist_ok=True)
-    out_path = os.path.join("downloads", filename)
-    with open(out_path, "w", encoding="utf-8", errors="ignore") as f:
-        f.write("".join(assembled))
 
-    return f"Downloaded to {out_path}"
+def iter_files(prefix=""):
+    """Yield the summary of every file under prefix, a page at a time."""
+    cursor = None
+    while True:
+        page = list_files(prefix, cursor)
+        yield from page["files"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return
 
 
-def list_files():
-    return requests.get(MASTER_URL + "/list").json()
+def dir_stats(path=""):
+    """File count, total bytes and direct entries of a directory, or None."""
+    r = http_pool.get(MASTER_URL + "/dir_stats", params={"path": path})
+    return r.json() if r.status_code == 200 else None
 
 
 def delete_file(filename):
-    r = requests.post(MASTER_URL + "/delete", json={"filename": filename})
+    locate_cache.invalidate(filename)
+    r = http_pool.post(MASTER_URL + "/delete", json={"filename": filename})
     if r.status_code != 200:
         return "Delete failed: " + r.text
     return r.json()
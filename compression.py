@@ -0,0 +1,84 @@
+"""
+Per-block compression for files uploaded with a codec.
+
+Every stored block of such a file is framed: one marker byte saying how the
+rest is encoded (RAW or a codec) followed by the payload. Blocks that don't
+compress are kept raw, so each block decodes on its own and random data
+costs one byte per block instead of a useless compression pass.
+
+The codec is chosen per file at /upload and recorded in its metadata; files
+without one store plain, unframed blocks.
+"""
+
+import time
+import zlib
+
+RAW = 0
+
+# codec name -> marker byte
+MARKERS = {"zlib": 1}
+
+# zlib level 1: most of the ratio at a fraction of the CPU of the default
+ZLIB_LEVEL = 1
+
+# A block is stored compressed only if that saves at least this fraction
+MIN_SAVING = 0.1
+
+# Blocks larger than twice this are probed by compressing their first
+# PROBE_SIZE bytes; if the probe doesn't save MIN_SAVING the block is stored
+# raw without compressing the rest
+PROBE_SIZE = 4096
+
+_compress = {1: lambda data: zlib.compress(data, ZLIB_LEVEL)}
+_decompress = {1: zlib.decompress}
+
+
+def check_codec(codec):
+    if codec not in MARKERS:
+        raise ValueError(f"unknown codec {codec!r} (have {sorted(MARKERS)})")
+
+
+def encode_block(codec, data):
+    """Frame one block. Returns (frame, stats) where stats has the raw and
+    stored sizes, whether it was compressed and the CPU seconds spent."""
+    started = time.thread_time()
+    marker = MARKERS[codec]
+    packed = None
+    if len(data) <= 2 * PROBE_SIZE or (
+        len(_compress[marker](data[:PROBE_SIZE])) <= PROBE_SIZE * (1 - MIN_SAVING)
+    ):
+        packed = _compress[marker](data)
+        if len(packed) > len(data) * (1 - MIN_SAVING):
+            packed = None
+
+    if packed is None:
+        frame = bytes([RAW]) + data
+    else:
+        frame = bytes([marker]) + packed
+    return frame, {
+        "raw": len(data),
+        "stored": len(frame),
+        "compressed": packed is not None,
+        "cpu_seconds": time.thread_time() - started,
+    }
+
+
+def decode_block(frame):
+    body = memoryview(frame)[1:]
+    if frame[0] == RAW:
+        return bytes(body)
+    return _decompress[frame[0]](body)
+
+
+def summarize(codec, per_block):
+    raw = sum(s["raw"] for s in per_block)
+    stored = sum(s["stored"] for s in per_block)
+    return {
+        "codec": codec,
+        "raw_bytes": raw,
+        "stored_bytes": stored,
+        "ratio": raw / stored if stored else 1.0,
+        "skipped": sum(1 for s in per_block if not s["compressed"]),
+        "cpu_seconds": sum(s["cpu_seconds"] for s in per_block),
+        "per_block": per_block,
+    }
@@ -0,0 +1,154 @@
+"""
+Reed-Solomon erasure coding over GF(256) for erasure-coded files.
+
+A stripe is k data shards plus m parity shards, all the same length; any k of
+the k+m shards are enough to rebuild the others. The code is systematic (data
+shards are stored unchanged) and the parity rows form a Cauchy matrix, so
+every k x k submatrix of the encoding matrix is invertible.
+
+Shard arithmetic is vectorized with NumPy: multiplying a whole shard by a
+field constant is a single lookup into a 256x256 product table. NumPy is only
+needed by code that encodes or decodes; the master imports nothing from here.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# x^8 + x^4 + x^3 + x^2 + 1
+PRIMITIVE_POLY = 0x11D
+
+EXP = [0] * 512
+LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= PRIMITIVE_POLY
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+_mul_table = None
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("erasure coding needs numpy (pip install numpy)")
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+def _table():
+    global _mul_table
+    if _mul_table is None:
+        require_numpy()
+        log = np.array(LOG)
+        table = np.array(EXP, dtype=np.uint8)[log[:, None] + log[None, :]]
+        table[0, :] = 0
+        table[:, 0] = 0
+        _mul_table = table
+    return _mul_table
+
+
+def check_params(k, m):
+    if k < 1 or m < 1 or k + m > 256:
+        raise ValueError(f"invalid erasure code {k}+{m}: need k, m >= 1 and k + m <= 256")
+
+
+def encoding_row(k, m, index):
+    # Coefficients of shard `index` over the k data shards.
+    if index < k:
+        return [1 if j == index else 0 for j in range(k)]
+    # Cauchy row 1 / (x_i + y_j) with x_i = index >= k and y_j = j < k
+    return [gf_inv(index ^ j) for j in range(k)]
+
+
+def _combine(coeffs, shards):
+    mul = _table()
+    out = np.zeros(len(shards[0]), dtype=np.uint8)
+    for c, shard in zip(coeffs, shards):
+        if c == 1:
+            out ^= shard
+        elif c:
+            out ^= mul[c][shard]
+    return out
+
+
+def _invert(matrix):
+    # Gauss-Jordan elimination over GF(256) on a k x k list of lists.
+    k = len(matrix)
+    rows = [list(r) + [1 if i == j else 0 for j in range(k)] for i, r in enumerate(matrix)]
+    for col in range(k):
+        pivot = next((r for r in range(col, k) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("singular matrix")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(v, inv) for v in rows[col]]
+        for r in range(k):
+            f = rows[r][col]
+            if r != col and f:
+                rows[r] = [v ^ gf_mul(f, p) for v, p in zip(rows[r], rows[col])]
+    return [r[k:] for r in rows]
+
+
+def split(data, k):
+    """Cut one stripe's worth of data into k equal shards, zero padding the
+    tail. The original length has to be kept elsewhere to strip the padding."""
+    size = max(-(-len(data) // k), 1)
+    data = data.ljust(size * k, b"\0")
+    return [data[i * size:(i + 1) * size] for i in range(k)]
+
+
+def encode(data_shards, m):
+    """Return the m parity shards for k equal-length data shards."""
+    k = len(data_shards)
+    check_params(k, m)
+    require_numpy()
+    arrs = [np.frombuffer(s, dtype=np.uint8) for s in data_shards]
+    return [_combine(encoding_row(k, m, k + i), arrs).tobytes() for i in range(m)]
+
+
+def reconstruct(shards, k, m, wanted):
+    """Rebuild shards from any k available ones.
+
+    `shards` maps shard index (0..k+m-1) to its bytes; returns a dict with
+    the bytes of every index in `wanted`.
+    """
+    check_params(k, m)
+    have = sorted(shards)[:k]
+    if len(have) < k:
+        raise ValueError(f"need {k} shards to decode, have {len(have)}")
+
+    out = {w: shards[w] for w in wanted if w in shards}
+    missing = [w for w in wanted if w not in shards]
+    if not missing:
+        return out
+
+    require_numpy()
+    # data_j = sum_r inv[j][r] * shard_have[r]
+    inv = _invert([encoding_row(k, m, i) for i in have])
+    arrs = [np.frombuffer(shards[i], dtype=np.uint8) for i in have]
+    for w in missing:
+        row = encoding_row(k, m, w)
+        coeffs = []
+        for r in range(k):
+            c = 0
+            for j in range(k):
+                c ^= gf_mul(row[j], inv[j][r])
+            coeffs.append(c)
+        out[w] = _combine(coeffs, arrs).tobytes()
+    return out
@@ -0,0 +1,53 @@
+"""
+Length-prefixed record framing for batched block transfers.
+
+A batch body is a sequence of records, each RECORD_HEADER (block id length,
+status, data length, CRC32 of the data) followed by the block id (utf-8) and
+the data. Stores send status OK; fetch replies use it to say a block was
+missing or corrupt, with no data.
+
+Used by /block_store_batch, /block_fetch_batch and /replicate_batch on the
+nodes and by the client's upload/download engines.
+"""
+
+import struct
+import zlib
+
+RECORD_HEADER = struct.Struct(">HBII")
+
+OK = 0
+MISSING = 1
+CORRUPT = 2
+
+# Most blocks one batch request may carry; nodes reject larger batches
+MAX_BATCH = 64
+
+
+def pack_record(block_id, data=b"", status=OK, crc=None):
+    raw_id = block_id.encode()
+    if crc is None:
+        crc = zlib.crc32(data)
+    return RECORD_HEADER.pack(len(raw_id), status, len(data), crc) + raw_id + data
+
+
+def pack(records):
+    """Frame (block_id, data) pairs, or (block_id, data, status, crc)."""
+    return b"".join(pack_record(*r) for r in records)
+
+
+def unpack(body):
+    """Yield (block_id, status, data, crc) for each record in body. Raises
+    ValueError on a truncated body."""
+    view = memoryview(body)
+    offset = 0
+    while offset < len(view):
+        if offset + RECORD_HEADER.size > len(view):
+            raise ValueError("truncated record header")
+        id_len, status, length, crc = RECORD_HEADER.unpack_from(view, offset)
+        offset += RECORD_HEADER.size
+        end = offset + id_len + length
+        if end > len(view):
+            raise ValueError("truncated record")
+        block_id = bytes(view[offset:offset + id_len]).decode()
+        yield block_id, status, bytes(view[offset + id_len:end]), crc
+        offset = end
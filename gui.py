@@ -7,12 +7,18 @@ import tkinter as tk
 from tkinter import ttk, filedialog, simpledialog
 import subprocess
 import threading
-import requests
 import time
 import os
 import atexit
 
+import client
+import http_pool
+
 MASTER_URL = "http://127.0.0.1:4000"
+
+# Files per /list page: the list dialog shows the first page, the download
+# and delete dialogs load further pages on request
+LIST_PAGE = 500
 NODE_PORTS = ["5001", "5002", "5003", "5004", "5005"]
 BLOCK_SIZE = 64 * 1024
 POLL_INTERVAL = 1.0
@@ -277,7 +283,7 @@ class NeoFS_GUI:
     # ---------------- Master Control ----------------
     def start_master_if_needed(self):
         try:
-            requests.get(MASTER_URL + "/status", timeout=1)
+            http_pool.get(MASTER_URL + "/status", timeout=1)
         except:
             self.start_master()
 
@@ -295,7 +301,7 @@ class NeoFS_GUI:
             self.log("Master stopped.")
         else:
             try:
-                requests.post(MASTER_URL + "/shutdown", timeout=1)
+                http_pool.post(MASTER_URL + "/shutdown", timeout=1)
                 self.log("Master stop requested.")
             except:
                 pass
@@ -313,7 +319,7 @@ class NeoFS_GUI:
 
     def stop_node(self, port):
         try:
-            requests.post(f"http://127.0.0.1:{port}/shutdown", timeout=1)
+            http_pool.post(f"http://127.0.0.1:{port}/shutdown", timeout=1)
         except:
             pass
 
@@ -346,7 +352,7 @@ class NeoFS_GUI:
         """
         while self.polling:
             try:
-                resp = requests.get(MASTER_URL + "/status", timeout=2)
+                resp = http_pool.get(MASTER_URL + "/status", timeout=2)
 
                 if resp.status_code == 200:
                     data = resp.json()
@@ -399,21 +405,12 @@ class NeoFS_GUI:
     def _client_heartbeat_loop(self):
         while True:
             try:
-                requests.post(MASTER_URL + "/client_heartbeat",
+                http_pool.post(MASTER_URL + "/client_heartbeat",
                               json={"id": "gui"}, timeout=1)
             except:
                 pass
             time.sleep(3)
 
-    # ---------------- Upload Helpers ----------------
-    def _split_file_into_blocks(self, path):
-        with open(path, "rb") as f:
-            data = f.read()
-        return len(data), [
-            data[i:i+BLOCK_SIZE].decode("utf-8", errors="ignore")
-            for i in range(0, len(data), BLOCK_SIZE)
-        ]
-
     # ---------------- Upload ----------------
     def open_upload_dialog(self):
         path = filedialog.askopenfilename()
@@ -435,200 +432,152 @@ class NeoFS_GUI:
         self.log(f"Uploading {filename}...")
 
         try:
-            size, blocks = self._split_file_into_blocks(path)
-            num_blocks = len(blocks)
-
-            r = requests.post(
-                MASTER_URL + "/upload",
-                json={"filename": filename,
-                      "replication_factor": rep,
-                      "num_blocks": num_blocks,
-                      "size": size},
-                timeout=10
-            )
-            if r.status_code != 200:
-                GlassModal(self.root, "Upload Failed", r.text)
-                return
-
-            meta = r.json()
-            block_metas = meta.get("blocks", [])
-
-            total_steps = len(block_metas)
-            self.progress["maximum"] = total_steps
+            num_blocks = (os.stat(path).st_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+            self.progress["maximum"] = max(num_blocks, 1)
             self.progress["value"] = 0
 
-            step = 0
-            for block_data, bmeta in zip(blocks, block_metas):
-                block_id = bmeta["id"]
-                for p in bmeta["nodes"]:
-                    try:
-                        requests.post(
-                            f"http://127.0.0.1:{p}/block_store",
-                            json={"block_id": block_id, "data": block_data},
-                            timeout=8
-                        )
-                    except:
-                        self.log(f"Node {p} failed for block {block_id}")
-
-                step += 1
-                self.progress["value"] = step
+            engine = client.UploadEngine(on_block_done=self._on_block_uploaded)
+            report = client.upload_path(path, rep, engine)
 
-            GlassModal(self.root, "Upload Complete", f"{filename} uploaded.")
-            self.log(f"Uploaded {filename}")
+            if report["failed"]:
+                GlassModal(self.root, "Upload Incomplete",
+                           f"{filename}: {report['failed']} blocks could not be stored.")
+            else:
+                GlassModal(self.root, "Upload Complete", f"{filename} uploaded.")
+            self.log(f"Uploaded {filename} ({report['throughput_mb_s']:.2f} MB/s)")
 
+        except client.UploadError as e:
+            GlassModal(self.root, "Upload Failed", str(e))
         except Exception as e:
             GlassModal(self.root, "Upload Error", str(e))
 
+    def _on_block_uploaded(self, result):
+        for p in result["failed"]:
+            self.log(f"Node {p} failed for block {result['id']}")
+        self.progress["value"] += 1
+
     # ---------------- List Files ----------------
     def list_files(self):
         try:
-            r = requests.get(MASTER_URL + "/list", timeout=6)
+            r = http_pool.get(MASTER_URL + "/list", params={"limit": LIST_PAGE}, timeout=6)
             if r.status_code != 200:
                 GlassModal(self.root, "List Failed", r.text)
                 return
 
+            page = r.json()
             lines = []
-            for f, meta in r.json().items():
+            for meta in page["files"]:
                 lines.append(
-                    f"{f} → blocks={meta['num_blocks']}, RF={meta['replication_factor']}, size={meta['size']}"
+                    f"{meta['name']} → blocks={meta['num_blocks']}, RF={meta['replication_factor']}, size={meta['size']}"
                 )
+            if page["next_cursor"] is not None:
+                lines.append(f"... showing {len(page['files'])} of {page['dir']['files']} files")
 
             GlassModal(self.root, "Files", "\n".join(lines) or "(No files)")
 
         except Exception as e:
             GlassModal(self.root, "List Error", str(e))
 
-    # ---------------- Download Popup ----------------
-    def download_dialog(self):
-        try:
-            r = requests.get(MASTER_URL + "/list", timeout=6)
-            files = list(r.json().keys())
+    # ---------------- File Picker (Download / Delete) ----------------
+    def _list_page(self, cursor=None):
+        params = {"limit": LIST_PAGE}
+        if cursor is not None:
+            params["cursor"] = cursor
+        r = http_pool.get(MASTER_URL + "/list", params=params, timeout=6)
+        return r.json()
+
+    def _file_dialog(self, title, empty_message, action, action_bg, job):
+        page = self._list_page()
+        if not page["files"]:
+            GlassModal(self.root, "No Files", empty_message)
+            return
 
-            if not files:
-                GlassModal(self.root, "No Files", "No files available to download.")
-                return
+        dlg = tk.Toplevel(self.root)
+        dlg.title(title)
+        dlg.geometry("460x360")
+        dlg.configure(bg=THEME["CARD"])
 
-            dlg = tk.Toplevel(self.root)
-            dlg.title("Download File")
-            dlg.geometry("460x360")
-            dlg.configure(bg=THEME["CARD"])
+        tk.Label(dlg, text="Files available:", fg=THEME["TEXT"],
+                 bg=THEME["CARD"], font=("Segoe UI", 11, "bold")
+        ).pack(anchor="w", padx=12, pady=(10,6))
 
-            tk.Label(dlg, text="Files available:", fg=THEME["TEXT"],
-                     bg=THEME["CARD"], font=("Segoe UI", 11, "bold")
-            ).pack(anchor="w", padx=12, pady=(10,6))
+        more = tk.Button(dlg, text="Load more files", bg=THEME["ACCENT_ALT"], fg="white", bd=0, padx=10)
+        more.pack(side="bottom", pady=(0,10))
 
-            container = tk.Frame(dlg, bg=THEME["CARD"])
-            container.pack(fill="both", expand=True, padx=12, pady=(0,12))
+        container = tk.Frame(dlg, bg=THEME["CARD"])
+        container.pack(fill="both", expand=True, padx=12, pady=(0,12))
 
-            canvas = tk.Canvas(container, bg=THEME["CARD"], highlightthickness=0)
-            sbar = tk.Scrollbar(container, orient="vertical", command=canvas.yview)
-            inner = tk.Frame(canvas, bg=THEME["CARD"])
+        canvas = tk.Canvas(container, bg=THEME["CARD"], highlightthickness=0)
+        sbar = tk.Scrollbar(container, orient="vertical", command=canvas.yview)
+        inner = tk.Frame(canvas, bg=THEME["CARD"])
 
-            inner.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-            canvas.create_window((0,0), window=inner, anchor="nw")
-            canvas.configure(yscrollcommand=sbar.set)
+        inner.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
+        canvas.create_window((0,0), window=inner, anchor="nw")
+        canvas.configure(yscrollcommand=sbar.set)
+
+        canvas.pack(side="left", fill="both", expand=True)
+        sbar.pack(side="right", fill="y")
 
-            canvas.pack(side="left", fill="both", expand=True)
-            sbar.pack(side="right", fill="y")
+        cursor = None
 
-            for f in files:
+        def add_page(page):
+            nonlocal cursor
+            for f in (meta["name"] for meta in page["files"]):
                 row = tk.Frame(inner, bg=THEME["CARD"])
                 row.pack(fill="x", pady=6)
 
                 tk.Label(row, text=f, bg=THEME["CARD"], fg=THEME["TEXT"]).pack(side="left", padx=(6,4))
 
                 tk.Button(
-                    row, text="Download", bg=THEME["ACCENT"], fg="white", bd=0, padx=10,
-                    command=lambda fn=f, d=dlg: (d.destroy(), threading.Thread(target=self._download_job, args=(fn,), daemon=True).start())
+                    row, text=action, bg=action_bg, fg="white", bd=0, padx=10,
+                    command=lambda fn=f, d=dlg: (d.destroy(), threading.Thread(target=job, args=(fn,), daemon=True).start())
                 ).pack(side="right", padx=(4,8))
+            cursor = page["next_cursor"]
+            if cursor is None:
+                more.pack_forget()
+
+        def load_more():
+            try:
+                add_page(self._list_page(cursor))
+            except Exception as e:
+                GlassModal(self.root, "Error", str(e))
+
+        more.configure(command=load_more)
+        add_page(page)
 
+    # ---------------- Download Popup ----------------
+    def download_dialog(self):
+        try:
+            self._file_dialog("Download File", "No files available to download.",
+                              "Download", THEME["ACCENT"], self._download_job)
         except Exception as e:
             GlassModal(self.root, "Error", str(e))
 
     def _download_job(self, filename):
         try:
-            r = requests.post(MASTER_URL + "/locate",
-                              json={"filename": filename}, timeout=8)
-
-            if r.status_code != 200:
-                GlassModal(self.root, "Download Failed", r.text)
-                return
-
-            assembled = []
-            for blk in r.json().get("blocks", []):
-                block_id = blk["id"]
-                for p in blk["nodes"]:
-                    try:
-                        rr = requests.post(
-                            f"http://127.0.0.1:{p}/block_fetch",
-                            json={"block_id": block_id}, timeout=8)
-                        if rr.status_code == 200:
-                            assembled.append(rr.json()["data"])
-                            break
-                    except:
-                        continue
-
-            os.makedirs("downloads", exist_ok=True)
-            outpath = os.path.join("downloads", filename)
-            with open(outpath, "w", encoding="utf-8", errors="ignore") as f:
-                f.write("".join(assembled))
+            report = client.download_path(filename)
 
+            outpath = report["path"]
             GlassModal(self.root, "Download Complete", f"Saved to {outpath}")
-            self.log(f"Downloaded {filename} → {outpath}")
+            self.log(f"Downloaded {filename} → {outpath} ({report['throughput_mb_s']:.2f} MB/s)")
 
+        except client.DownloadError as e:
+            GlassModal(self.root, "Download Failed", str(e))
         except Exception as e:
             GlassModal(self.root, "Download Error", str(e))
 
     # ---------------- Delete Popup ----------------
     def delete_dialog(self):
         try:
-            r = requests.get(MASTER_URL + "/list", timeout=6)
-            files = list(r.json().keys())
-
-            if not files:
-                GlassModal(self.root, "No Files", "No files to delete.")
-                return
-
-            dlg = tk.Toplevel(self.root)
-            dlg.title("Delete File")
-            dlg.geometry("460x360")
-            dlg.configure(bg=THEME["CARD"])
-
-            tk.Label(dlg, text="Files available:", fg=THEME["TEXT"],
-                     bg=THEME["CARD"], font=("Segoe UI", 11, "bold")
-            ).pack(anchor="w", padx=12, pady=(10,6))
-
-            container = tk.Frame(dlg, bg=THEME["CARD"])
-            container.pack(fill="both", expand=True, padx=12, pady=(0,12))
-
-            canvas = tk.Canvas(container, bg=THEME["CARD"], highlightthickness=0)
-            sbar = tk.Scrollbar(container, orient="vertical", command=canvas.yview)
-            inner = tk.Frame(canvas, bg=THEME["CARD"])
-
-            inner.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-            canvas.create_window((0,0), window=inner, anchor="nw")
-            canvas.configure(yscrollcommand=sbar.set)
-
-            canvas.pack(side="left", fill="both", expand=True)
-            sbar.pack(side="right", fill="y")
-
-            for f in files:
-                row = tk.Frame(inner, bg=THEME["CARD"])
-                row.pack(fill="x", pady=6)
-
-                tk.Label(row, text=f, bg=THEME["CARD"], fg=THEME["TEXT"]).pack(side="left", padx=(6,4))
-
-                tk.Button(
-                    row, text="Delete", bg="#b23b3b", fg="white", bd=0, padx=10,
-                    command=lambda fn=f, d=dlg: (d.destroy(), threading.Thread(target=self._delete_job, args=(fn,), daemon=True).start())
-                ).pack(side="right", padx=(4,8))
-
+            self._file_dialog("Delete File", "No files to delete.",
+                              "Delete", "#b23b3b", self._delete_job)
         except Exception as e:
             GlassModal(self.root, "Error", str(e))
 
     def _delete_job(self, filename):
+        client.locate_cache.invalidate(filename)
         try:
-            r = requests.post(MASTER_URL + "/delete",
+            r = http_pool.post(MASTER_URL + "/delete",
                               json={"filename": filename}, timeout=6)
             if r.status_code == 200:
                 GlassModal(self.root, "Delete Success", f"Deleted {filename}")
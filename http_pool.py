@@ -0,0 +1,92 @@
+"""
+Shared pooled HTTP layer for the master, nodes, client and GUI.
+
+Every destination (scheme://host:port) gets one requests.Session whose
+connection pool is reused across calls and threads, so block transfers and
+heartbeats don't pay a TCP handshake per request.
+
+Pool size and default timeout come from the optional "http" section of
+config/config.json, e.g. {"pool_size": 16, "timeout": 10}, or configure().
+"""
+
+import json
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Max keep-alive connections kept per destination
+POOL_SIZE = 16
+
+# Timeout (seconds) for calls that don't pass their own
+DEFAULT_TIMEOUT = 10
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def configure(pool_size=None, timeout=None):
+    global POOL_SIZE, DEFAULT_TIMEOUT
+    with _lock:
+        if pool_size is not None:
+            POOL_SIZE = int(pool_size)
+        if timeout is not None:
+            DEFAULT_TIMEOUT = float(timeout)
+        # sessions created from now on pick up the new pool size
+        for s in _sessions.values():
+            s.close()
+        _sessions.clear()
+
+
+def _load_config():
+    cfg_path = os.path.join("config", "config.json")
+    if not os.path.exists(cfg_path):
+        return
+    try:
+        with open(cfg_path, "r") as f:
+            http_cfg = json.load(f).get("http", {})
+    except (OSError, ValueError):
+        return
+    configure(http_cfg.get("pool_size"), http_cfg.get("timeout"))
+
+
+def session_for(url):
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with _lock:
+        s = _sessions.get(key)
+        if s is None:
+            s = requests.Session()
+            s.mount(key, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+            _sessions[key] = s
+        return s
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    return session_for(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def serve(app, port):
+    # The Flask development server closes every connection after one
+    # response, which defeats the pools above. Use waitress when it is
+    # installed; fall back to app.run otherwise.
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        app.run(port=port, threaded=True)
+        return
+    waitress_serve(app, host="127.0.0.1", port=port, threads=max(POOL_SIZE, 8))
+
+
+_load_config()
@@ -0,0 +1,178 @@
+"""
+Heartbeat expiry and the compact heartbeat encoding.
+
+TimingWheel holds one deadline per key (node port, client id) in a hashed
+timing wheel: a ring of slots, each covering `tick` seconds, indexed by
+deadline. Rescheduling a key on a heartbeat moves it between two slots in
+O(1), and expire() only visits the slots whose time has come, so a monitor
+pass costs the entries that are actually due rather than a scan of every
+node and client. Deadlines further out than one turn of the wheel stay in
+their slot until the turn they fall in.
+
+Nodes send heartbeats as HEARTBEAT_TYPE bodies instead of JSON: a fixed
+HEADER with the port, the node's current heartbeat interval and its load
+figures, followed by the ids of the blocks added and removed since the last
+heartbeat. The master answers in kind with REPLY_HEADER and the ids of the
+orphaned blocks the node should delete.
+"""
+
+import struct
+
+# Content type of compact heartbeats and of the master's replies to them
+HEARTBEAT_TYPE = "application/x-neofs-heartbeat"
+
+VERSION = 1
+
+# version, port, interval (tenths of a second), free_bytes, used_bytes,
+# blocks, active_transfers, added count, removed count
+HEADER = struct.Struct(">BHHQQIHII")
+
+# flags, delete count
+REPLY_HEADER = struct.Struct(">BI")
+FULL_REPORT = 1
+
+ID_LEN = struct.Struct(">H")
+
+
+class TimingWheel:
+    """Deadlines by key. Not thread safe; callers hold their own lock.
+
+    The wheel spans tick * slots seconds; sizing it past the longest timeout
+    keeps every slot visit down to keys due in that tick."""
+
+    def __init__(self, tick=0.5, slots=64):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}  # key -> deadline
+        self._slot_of = {}  # key -> index into _slots
+        self._cursor = None  # tick expire() has processed up to
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def schedule(self, key, deadline):
+        """Set (or move) the deadline of key."""
+        t = int(deadline // self.tick)
+        if self._cursor is not None and t < self._cursor:
+            # already behind: picked up by the next expire()
+            t = self._cursor
+        slot = t % len(self._slots)
+        old = self._slot_of.get(key)
+        if old != slot:
+            if old is not None:
+                self._slots[old].discard(key)
+            self._slots[slot].add(key)
+            self._slot_of[key] = slot
+        self._deadlines[key] = deadline
+
+    def cancel(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            self._slots[slot].discard(key)
+            del self._deadlines[key]
+
+    def expire(self, now):
+        """Remove and return the keys whose deadline is <= now."""
+        current = int(now // self.tick)
+        first = current - len(self._slots) + 1
+        if self._cursor is not None:
+            first = max(first, self._cursor)
+
+        due = []
+        for t in range(first, current + 1):
+            slot = self._slots[t % len(self._slots)]
+            if not slot:
+                continue
+            for key in [k for k in slot if self._deadlines[k] <= now]:
+                slot.discard(key)
+                del self._slot_of[key]
+                del self._deadlines[key]
+                due.append(key)
+        # the current tick is looked at again next time: keys in it may not
+        # be due yet
+        self._cursor = current
+        return due
+
+
+def _pack_ids(ids):
+    out = []
+    for block_id in ids:
+        raw = block_id.encode()
+        out.append(ID_LEN.pack(len(raw)))
+        out.append(raw)
+    return out
+
+
+def _unpack_ids(view, offset, count):
+    ids = []
+    for _ in range(count):
+        if offset + ID_LEN.size > len(view):
+            raise ValueError("truncated heartbeat")
+        (n,) = ID_LEN.unpack_from(view, offset)
+        offset += ID_LEN.size
+        if offset + n > len(view):
+            raise ValueError("truncated heartbeat")
+        ids.append(bytes(view[offset:offset + n]).decode())
+        offset += n
+    return ids, offset
+
+
+def encode_heartbeat(port, interval, load, added=(), removed=()):
+    head = HEADER.pack(
+        VERSION,
+        int(port),
+        min(int(interval * 10), 0xFFFF),
+        int(load.get("free_bytes", 0)),
+        int(load.get("used_bytes", 0)),
+        int(load.get("blocks", 0)),
+        min(int(load.get("active_transfers", 0)), 0xFFFF),
+        len(added),
+        len(removed),
+    )
+    return b"".join([head] + _pack_ids(added) + _pack_ids(removed))
+
+
+def decode_heartbeat(body):
+    """Return the heartbeat as the dict a JSON heartbeat carries. Raises
+    ValueError on a malformed body."""
+    view = memoryview(body)
+    if len(view) < HEADER.size:
+        raise ValueError("truncated heartbeat")
+    (version, port, interval, free_bytes, used_bytes, blocks, active,
+     n_added, n_removed) = HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ValueError(f"unknown heartbeat version {version}")
+    added, offset = _unpack_ids(view, HEADER.size, n_added)
+    removed, offset = _unpack_ids(view, offset, n_removed)
+    return {
+        "port": str(port),
+        "interval": interval / 10,
+        "load": {
+            "free_bytes": free_bytes,
+            "used_bytes": used_bytes,
+            "blocks": blocks,
+            "active_transfers": active,
+        },
+        "added": added,
+        "removed": removed,
+    }
+
+
+def encode_reply(full_report, delete):
+    head = REPLY_HEADER.pack(FULL_REPORT if full_report else 0, len(delete))
+    return b"".join([head] + _pack_ids(delete))
+
+
+def decode_reply(body):
+    view = memoryview(body)
+    if len(view) < REPLY_HEADER.size:
+        raise ValueError("truncated heartbeat reply")
+    flags, count = REPLY_HEADER.unpack_from(view)
+    delete, _ = _unpack_ids(view, REPLY_HEADER.size, count)
+    return {"full_report": bool(flags & FULL_REPORT), "delete": delete}
@@ -1,5 +1,15 @@
-from flask import Flask, request, jsonify
-import threading, time, json, random, requests, os
+from flask import Flask, request, jsonify, Response
+import threading, time, json, os, heapq, itertools
+
+import compression
+import framing
+import http_pool
+import liveness
+import metalog
+import namespace
+import placement
+import replication
+import rwlock
 
 app = Flask(__name__)
 
@@ -14,110 +24,995 @@ HEARTBEAT_TIMEOUT = 5
 MONITOR_INTERVAL = 2
 CLIENT_TIMEOUT = 6
 
-# Node state: node_port -> { alive: bool, last_heartbeat: ts }
+# A node that backs its heartbeat interval off is declared DOWN after this
+# many missed heartbeats, if that is longer than HEARTBEAT_TIMEOUT
+HEARTBEAT_MISSES = 3
+
+# Deadline wheels for node and client expiry (see liveness.py); they span
+# WHEEL_TICK * WHEEL_SLOTS = 32s, past any timeout above
+WHEEL_TICK = 0.5
+WHEEL_SLOTS = 64
+
+# Node state: node_port -> { alive: bool, last_heartbeat: ts, load: dict,
+# capacity: bytes }. load holds the figures from the node's last heartbeat
+# (see placement.py); capacity is the optional "capacity_mb" of the node's
+# config entry and caps its free space, e.g. when nodes share one disk.
 nodes = {}
 for n in cfg["nodes"]:
     port = str(n["port"])
-    nodes[port] = {"alive": False, "last_heartbeat": 0}
+    capacity = n.get("capacity_mb")
+    nodes[port] = {
+        "alive": False,
+        "last_heartbeat": 0,
+        "load": None,
+        "capacity": capacity * 1024 * 1024 if capacity else None,
+    }
 
-# client_id -> last_heartbeat_ts
-clients = {}
+# Expiry deadlines of the alive nodes (under nodes_lock) and of the active
+# clients (under clients_lock, the client ids are its keys)
+node_expiry = liveness.TimingWheel(WHEEL_TICK, WHEEL_SLOTS)
+clients = liveness.TimingWheel(WHEEL_TICK, WHEEL_SLOTS)
+heartbeat_stats = {"json": 0, "compact": 0, "nodes_expired": 0, "clients_expired": 0}
 
 # filename -> metadata
 # {
 #   "replication_factor": int,
 #   "size": int,
 #   "block_size": int,
+#   "ec": {"k": int, "m": int},   (erasure-coded files only)
+#   "compression": codec,         (compressed files only, see compression.py)
+#   "generation": int,
 #   "blocks": [
-#       { "id": "filename__blk0", "replicas": ["5001", "5003"] },
+#       { "id": "filename__g<generation>__blk0", "replicas": ["5001", "5003"] },
 #       ...
 #   ]
 # }
+# An erasure-coded file is a sequence of stripes of k data + m parity shards
+# (see erasure.py). Every shard is stored as a block with a single replica
+# and carries "stripe" and "shard" (0..k+m-1) keys; blocks are ordered
+# stripe by stripe, and replication_factor is 1.
+# Files uploaded with dedup use content-addressed block ids,
+# CAS_PREFIX + sha256 of the block, shared by every file (and position) with
+# the same content; all of them point at one block dict in memory.
 file_index = {}
 
+CAS_PREFIX = "cas_"
+
+# Derived from file_index (rebuilt on load, kept in step by _apply_edit):
+# block_id -> a filename referencing it, block_id -> {filename: number of
+# references}, block_id -> its block dict inside file_index, and
+# node_port -> block ids placed on that node. A block is freed when its last
+# reference goes away.
+block_owner = {}
+block_refs = {}
+block_map = {}
+node_index = {}
+
+# Also derived: the file names in sorted, directory-aware form with
+# per-directory counts, for /list and /dir_stats (see namespace.py)
+name_index = namespace.Namespace()
+
+# From node block reports: node_port -> block ids the node says it holds,
+# and node_port -> reported block ids that no file references
+node_blocks = {}
+orphans = {}
+
+# Deletes of content-addressed blocks that a node may not have carried out
+# yet: block_id -> {port: time we stop waiting}. A cas_ id freed by /delete
+# or sent to a node as an orphan can come back with the next upload of the
+# same content; until the node has acted on the delete the id is not placed
+# or repaired there, or the late delete would remove the new copy. Entries
+# go when the node acknowledges the delete (the /block_delete reply, or the
+# next heartbeat after the one that carried it) or after
+# PENDING_DELETE_TIMEOUT seconds.
+pending_deletes = {}
+orphan_deletes_sent = {}  # node_port -> cas ids in its last heartbeat reply
+PENDING_DELETE_TIMEOUT = 60
+
 # Default block size (bytes)
 BLOCK_SIZE = 64 * 1024
 
-lock = threading.Lock()
+# /list page size when the caller gives no limit, and the most it may ask for
+LIST_LIMIT = 1000
+LIST_MAX = 10000
+
+# Most files one /upload_batch or /locate_batch call may name
+UPLOAD_BATCH_MAX = 1000
+LOCATE_BATCH_MAX = 1000
+
+# Locks, always taken in this order when nested:
+#   ns_lock       file_index and its derived indexes; readers (/locate, /list,
+#                 checkpoints) share it, edits take it exclusively
+#   reports_lock  node_blocks, orphans
+#   repl_lock     the re-replication queue structures below
+#   nodes_lock    nodes (liveness)
+#   clients_lock  clients (never nested)
+#   deletes_lock  pending_deletes, orphan_deletes_sent (innermost)
+ns_lock = rwlock.RWLock()
+reports_lock = threading.Lock()
+repl_lock = threading.Lock()
+nodes_lock = threading.Lock()
+clients_lock = threading.Lock()
+deletes_lock = threading.Lock()
+
+# Every change to file_index goes through the edit log and is periodically
+# folded into a snapshot, so a restart keeps the namespace (see metalog.py).
+METADATA_DIR = cfg.get("metadata_dir", "metadata")
+CHECKPOINT_INTERVAL = cfg.get("checkpoint_interval", 60)
+editlog = metalog.EditLog(METADATA_DIR)
+restart_seconds = 0.0
+
+
+def _index_file(filename, meta):
+    blocks = meta["blocks"]
+    for i, b in enumerate(blocks):
+        shared = block_map.get(b["id"])
+        if shared is not None:
+            # content-addressed block already referenced elsewhere; adopt the
+            # new placement only if the stored copy never made it to a node
+            if not shared["replicas"] and b["replicas"]:
+                shared["replicas"] = list(b["replicas"])
+                for p in shared["replicas"]:
+                    node_index.setdefault(p, set()).add(b["id"])
+            blocks[i] = shared
+        else:
+            block_owner[b["id"]] = filename
+            block_map[b["id"]] = b
+            for p in b["replicas"]:
+                node_index.setdefault(p, set()).add(b["id"])
+        refs = block_refs.setdefault(b["id"], {})
+        refs[filename] = refs.get(filename, 0) + 1
+
+
+def _unindex_file(filename, meta):
+    # Returns the ids of blocks that lost their last reference.
+    freed = []
+    for b in meta["blocks"]:
+        refs = block_refs.get(b["id"])
+        if not refs or filename not in refs:
+            continue
+        refs[filename] -= 1
+        if refs[filename]:
+            continue
+        del refs[filename]
+        if refs:
+            if block_owner.get(b["id"]) == filename:
+                block_owner[b["id"]] = next(iter(refs))
+            continue
+        del block_refs[b["id"]]
+        block_owner.pop(b["id"], None)
+        block_map.pop(b["id"], None)
+        for p in b["replicas"]:
+            node_index.get(p, set()).discard(b["id"])
+        freed.append(b["id"])
+    return freed
+
+
+def _block_rf(block_id):
+    # A shared block is kept at the highest RF of the files referencing it.
+    return max(file_index[f].get("replication_factor", 1) for f in block_refs[block_id])
+
+
+def _apply_edit(rec):
+    op = rec["op"]
+    if op == "upload":
+        old = file_index.get(rec["filename"])
+        if old:
+            _unindex_file(rec["filename"], old)
+        file_index[rec["filename"]] = rec["meta"]
+        _index_file(rec["filename"], rec["meta"])
+        name_index.add(rec["filename"], rec["meta"].get("size", 0))
+    elif op == "delete":
+        old = file_index.pop(rec["filename"], None)
+        if old:
+            _unindex_file(rec["filename"], old)
+        name_index.remove(rec["filename"])
+    elif op in ("set_replicas", "add_replica", "remove_replica"):
+        if rec["filename"] not in block_refs.get(rec["block_id"], ()):
+            return
+        block = block_map[rec["block_id"]]
+        block_id = block["id"]
+        if op == "set_replicas":
+            for p in block["replicas"]:
+                node_index.get(p, set()).discard(block_id)
+            block["replicas"] = list(rec["replicas"])
+            for p in block["replicas"]:
+                node_index.setdefault(p, set()).add(block_id)
+        elif op == "add_replica":
+            if rec["port"] not in block["replicas"]:
+                block["replicas"].append(rec["port"])
+            node_index.setdefault(rec["port"], set()).add(block_id)
+        elif rec["port"] in block["replicas"]:
+            block["replicas"].remove(rec["port"])
+            node_index.get(rec["port"], set()).discard(block_id)
+
+
+def _log_edit(rec):
+    # Call with ns_lock held for writing; pass the returned seq to
+    # editlog.wait() once it is released so concurrent edits share one fsync.
+    _apply_edit(rec)
+    return editlog.append(rec)
+
+
+def _load_metadata():
+    global restart_seconds
+    started = time.time()
+    state, records = editlog.load()
+    if state:
+        file_index.update(state["file_index"])
+        for filename, meta in file_index.items():
+            _index_file(filename, meta)
+        name_index.load((f, meta.get("size", 0)) for f, meta in file_index.items())
+    for rec in records:
+        _apply_edit(rec)
+    restart_seconds = time.time() - started
+    print(
+        f"[MASTER] Loaded {len(file_index)} files "
+        f"({len(records)} edits replayed) in {restart_seconds:.3f}s"
+    )
+
+
+def _checkpoint():
+    with ns_lock.read():
+        seq = editlog.roll()
+        state_json = json.dumps({"file_index": file_index})
+    editlog.write_snapshot(seq, state_json)
+
+
+_last_generation = 0
+
+
+def _new_generation():
+    # Call with ns_lock held for writing. Unique per upload so a block id is
+    # never reused: a stale replica of an overwritten or deleted file can't be
+    # mistaken for the new one when a node reports it.
+    global _last_generation
+    _last_generation = max(_last_generation + 1, time.time_ns() // 1000)
+    return _last_generation
+
+
+def _reconcile_added(port, block_id):
+    # Call with ns_lock held for writing and reports_lock held.
+    filename = block_owner.get(block_id)
+    if filename is None:
+        orphans.setdefault(port, set()).add(block_id)
+        return
+    orphans.get(port, set()).discard(block_id)
+    if block_id not in node_index.get(port, ()):
+        _log_edit(
+            {"op": "add_replica", "filename": filename, "block_id": block_id, "port": port}
+        )
+
+
+def _reconcile_removed(port, block_id):
+    # Call with ns_lock held for writing and reports_lock held.
+    orphans.get(port, set()).discard(block_id)
+    filename = block_owner.get(block_id)
+    if filename is not None and block_id in node_index.get(port, ()):
+        _log_edit(
+            {"op": "remove_replica", "filename": filename, "block_id": block_id, "port": port}
+        )
+        _enqueue_blocks([block_id])
+
+
+def _mark_deleting(block_ids, port_of):
+    # Call with ns_lock held, in the same critical section that left the
+    # blocks unreferenced. port_of(block_id) gives the nodes asked to delete.
+    until = time.time() + PENDING_DELETE_TIMEOUT
+    with deletes_lock:
+        for block_id in block_ids:
+            if block_id.startswith(CAS_PREFIX):
+                pending = pending_deletes.setdefault(block_id, {})
+                for p in port_of(block_id):
+                    pending[p] = until
+
+
+def _deleted(port, block_ids):
+    with deletes_lock:
+        for block_id in block_ids:
+            pending = pending_deletes.get(block_id)
+            if pending is not None:
+                pending.pop(port, None)
+                if not pending:
+                    del pending_deletes[block_id]
+
+
+def _deleting_on(block_id):
+    # Nodes where a delete of block_id may still be on its way
+    if not block_id.startswith(CAS_PREFIX):
+        return ()
+    now = time.time()
+    with deletes_lock:
+        pending = pending_deletes.get(block_id)
+        if not pending:
+            return ()
+        for p in [p for p, until in pending.items() if until <= now]:
+            del pending[p]
+        if not pending:
+            del pending_deletes[block_id]
+        return set(pending)
+
+
+# Under-replicated blocks, most at risk first: a heap of
+# (live_replicas, -deficit, seq, block_id). It is fed by the events that can
+# lose a replica (node DOWN, dropped replica, partial upload) instead of
+# rescanning file_index; entries are re-checked when popped, so stale ones
+# are harmless. Blocks that can't be repaired right now (no live source or no
+# free target) wait in repl_stalled until a node comes UP.
+repl_queue = []
+repl_queued = {}
+repl_stalled = set()
+_repl_seq = itertools.count()
+
+# block_id -> time after which a failed repair is queued again
+repl_retry = {}
+
+# Re-replication runs on its own worker pool (see replication.py)
+REPLICATION_CFG = cfg.get("replication", {})
+REPLICATION_RETRY_DELAY = REPLICATION_CFG.get("retry_delay", 10)
+
+# Max queue entries looked at per scheduling call when the best candidates'
+# source or target nodes are at their concurrency caps
+REPAIR_SCAN = 64
+
+# Replicated blocks with the same source and target are copied together, up
+# to this many per /replicate_batch call (at most framing.MAX_BATCH)
+REPAIR_BATCH = min(REPLICATION_CFG.get("batch", 32), framing.MAX_BATCH)
+
+
+# Replica placement (see placement.py). Nodes with less than min_free_mb
+# free get no new blocks, neither from uploads nor from re-replication.
+PLACEMENT_CFG = cfg.get("placement", {})
+placement_policy = placement.make_policy(PLACEMENT_CFG.get("policy", "p2c"))
+MIN_FREE_BYTES = PLACEMENT_CFG.get("min_free_mb", 64) * 1024 * 1024
+
+
+def _alive_nodes():
+    with nodes_lock:
+        return [p for p, info in nodes.items() if info["alive"]]
+
+
+def _placement_candidates():
+    # Returns (ports, loads): alive nodes with room for new blocks and a copy
+    # of their load figures that the caller may update while placing.
+    ports, loads = [], {}
+    with nodes_lock:
+        for p, info in nodes.items():
+            load = info.get("load")
+            if not info["alive"] or (load and load["free_bytes"] < MIN_FREE_BYTES):
+                continue
+            ports.append(p)
+            loads[p] = dict(load) if load else None
+    return ports, loads
+
+
+def _update_load(port, reported):
+    # Call with nodes_lock held.
+    info = nodes[port]
+    load = {
+        "free_bytes": int(reported.get("free_bytes", 0)),
+        "used_bytes": int(reported.get("used_bytes", 0)),
+        "blocks": int(reported.get("blocks", 0)),
+        "active_transfers": int(reported.get("active_transfers", 0)),
+        # placements made since this report aren't reflected in it yet
+        "pending": 0,
+    }
+    if info.get("capacity"):
+        load["free_bytes"] = min(load["free_bytes"], max(info["capacity"] - load["used_bytes"], 0))
+    info["load"] = load
+
+
+def _replication_need(block_id, alive):
+    # Call with ns_lock held. Returns (filename, rf, live replicas) for an
+    # under-replicated block, None otherwise.
+    filename = block_owner.get(block_id)
+    if filename is None:
+        return None
+    rf = _block_rf(block_id)
+    live = [p for p in block_map[block_id]["replicas"] if p in alive]
+    if len(live) >= rf:
+        return None
+    return filename, rf, live
+
+
+def _stripe_sources(meta, block, alive):
+    # Call with ns_lock held. For a lost shard of an erasure-coded file: the
+    # other shards of its stripe that still have a live replica, as
+    # {"index", "block_id", "port"} dicts, plus every node the stripe uses.
+    width = meta["ec"]["k"] + meta["ec"]["m"]
+    first = block["stripe"] * width
+    sources, used = [], set()
+    for b in meta["blocks"][first:first + width]:
+        used.update(b["replicas"])
+        if b is block:
+            continue
+        live = [p for p in b["replicas"] if p in alive]
+        if live:
+            sources.append({"index": b["shard"], "block_id": b["id"], "port": live[0]})
+    return sources, used
+
+
+def _enqueue_if_under_replicated(block_id, alive):
+    # Call with ns_lock and repl_lock held.
+    need = _replication_need(block_id, alive)
+    if need is None:
+        return False
+    _, rf, live = need
+    if repl_queued.get(block_id, rf + 1) <= len(live):
+        return False
+    repl_queued[block_id] = len(live)
+    repl_stalled.discard(block_id)
+    repl_retry.pop(block_id, None)
+    heapq.heappush(repl_queue, (len(live), len(live) - rf, next(_repl_seq), block_id))
+    return True
+
+
+def _enqueue_blocks(block_ids):
+    # Call with ns_lock held.
+    alive = set(_alive_nodes())
+    with repl_lock:
+        queued = sum(_enqueue_if_under_replicated(b, alive) for b in block_ids)
+    if queued:
+        replicator.wake()
+    return queued
+
+
+def _enqueue_all_under_replicated():
+    # One full pass, only used once after startup when liveness is first known.
+    with ns_lock.read():
+        queued = _enqueue_blocks(list(block_map))
+    if queued:
+        print(f"[MASTER] {queued} under-replicated blocks after startup")
+
+
+def _on_node_up(port):
+    with repl_lock:
+        stalled = list(repl_stalled)
+        repl_stalled.clear()
+    if stalled:
+        with ns_lock.read():
+            _enqueue_blocks(stalled)
+
+
+def _on_nodes_down(ports):
+    with ns_lock.read():
+        for port in ports:
+            _enqueue_blocks(list(node_index.get(port, ())))
 
 
 @app.route("/status", methods=["GET"])
 def status():
-    with lock:
+    with nodes_lock:
         node_report = {p: ("UP" if info["alive"] else "DOWN") for p, info in nodes.items()}
-        active_clients = len([c for c, t in clients.items() if time.time() - t <= CLIENT_TIMEOUT])
+    with clients_lock:
+        active_clients = len(clients)
     return jsonify({"nodes": node_report, "active_clients": active_clients})
 
 
+# Max orphaned blocks a node is told to drop per heartbeat
+ORPHAN_DELETE_BATCH = 100
+
+
+def _heartbeat_reply(compact, full_report, delete):
+    if compact:
+        return Response(
+            liveness.encode_reply(full_report, delete), mimetype=liveness.HEARTBEAT_TYPE
+        )
+    return jsonify({"full_report": full_report, "delete": delete})
+
+
 @app.route("/heartbeat", methods=["POST"])
 def heartbeat():
-    data = request.get_json(force=True)
+    # Nodes send compact heartbeats (liveness.py) and get a compact reply;
+    # JSON ones are still accepted.
+    compact = request.mimetype == liveness.HEARTBEAT_TYPE
+    if compact:
+        try:
+            data = liveness.decode_heartbeat(request.get_data())
+        except ValueError as e:
+            return str(e), 400
+    else:
+        data = request.get_json(force=True)
     port = str(data.get("port"))
-    with lock:
+    now = time.time()
+    timeout = max(HEARTBEAT_TIMEOUT, HEARTBEAT_MISSES * float(data.get("interval", 1)))
+    with nodes_lock:
+        heartbeat_stats["compact" if compact else "json"] += 1
         if port in nodes:
+            was_alive = nodes[port]["alive"]
             nodes[port]["alive"] = True
-            nodes[port]["last_heartbeat"] = time.time()
+            nodes[port]["last_heartbeat"] = now
         else:
             # allow unknown node to register (optional)
-            nodes[port] = {"alive": True, "last_heartbeat": time.time()}
+            was_alive = False
+            nodes[port] = {"alive": True, "last_heartbeat": now, "load": None}
+        node_expiry.schedule(port, now + timeout)
+        if "load" in data:
+            _update_load(port, data["load"])
+    if not was_alive:
+        _on_node_up(port)
+
+    # The node acts on a reply's deletes before sending its next heartbeat
+    with deletes_lock:
+        acked = orphan_deletes_sent.pop(port, ())
+    if acked:
+        _deleted(port, acked)
+
+    # Heartbeats carry the blocks added/removed since the last one that got
+    # through. Without a full report since we started they mean nothing, so
+    # ask for one instead.
+    with reports_lock:
+        if port not in node_blocks:
+            return _heartbeat_reply(compact, True, [])
+
+    added = data.get("added", [])
+    removed = data.get("removed", [])
+    if added or removed:
+        with ns_lock.write(), reports_lock:
+            held = node_blocks[port]
+            for block_id in added:
+                held.add(block_id)
+                _reconcile_added(port, block_id)
+            for block_id in removed:
+                held.discard(block_id)
+                _reconcile_removed(port, block_id)
+
+    with reports_lock:
+        to_delete = sorted(orphans.get(port, ()))[:ORPHAN_DELETE_BATCH]
+    cas_ids = [b for b in to_delete if b.startswith(CAS_PREFIX)]
+    if cas_ids:
+        # a cas_ orphan may have just been uploaded again: recheck under the
+        # namespace lock and hold the id off this node until the delete is done
+        with ns_lock.read(), reports_lock:
+            for b in to_delete:
+                if b in block_owner:
+                    orphans[port].discard(b)
+            to_delete = [b for b in to_delete if b not in block_owner]
+            cas_ids = [b for b in to_delete if b.startswith(CAS_PREFIX)]
+            _mark_deleting(cas_ids, lambda b: [port])
+            with deletes_lock:
+                orphan_deletes_sent[port] = cas_ids
+    return _heartbeat_reply(compact, False, to_delete)
+
+
+@app.route("/block_report", methods=["POST"])
+def block_report():
+    # Full report: everything the node holds. Replicas we placed there but the
+    # node doesn't have are dropped (re-replication then restores them),
+    # blocks of known files we didn't know about are added back, and the rest
+    # are orphans.
+    data = request.get_json(force=True)
+    port = str(data.get("port"))
+    reported = set(data.get("blocks", []))
+    with ns_lock.write(), reports_lock:
+        node_blocks[port] = reported
+        orphans[port] = set()
+        placed = set(node_index.get(port, ()))
+        for block_id in placed - reported:
+            _reconcile_removed(port, block_id)
+        for block_id in reported:
+            _reconcile_added(port, block_id)
+        missing = len(placed - reported)
+        num_orphans = len(orphans[port])
+
+    print(
+        f"[MASTER] Block report from {port}: {len(reported)} blocks, "
+        f"{missing} missing, {num_orphans} orphans"
+    )
+    return jsonify({"blocks": len(reported), "missing": missing, "orphans": num_orphans})
+
+
+@app.route("/legacy_block_ids", methods=["POST"])
+def legacy_block_ids():
+    # For a node renaming block files written before ids were encoded on
+    # disk: those files replaced an id's "/" with "_", so map such names
+    # back to the ids we know.
+    names = request.get_json(force=True).get("names", [])
+    with ns_lock.read():
+        known = {b.replace("/", "_"): b for b in block_map if "/" in b}
+    return jsonify({"ids": {n: known[n] for n in names if n in known}})
+
+
+# Replicas dropped by nodes because they failed their checksum
+bad_replicas = 0
+
+
+@app.route("/report_bad_block", methods=["POST"])
+def report_bad_block():
+    # Sent by a node that found a corrupt replica (scrubber or read path) and
+    # dropped it; the block is re-replicated from a good copy.
+    global bad_replicas
+    data = request.get_json(force=True)
+    port = str(data.get("port"))
+    block_id = data.get("block_id")
+    if not block_id:
+        return "missing block_id", 400
+
+    with ns_lock.write(), reports_lock:
+        node_blocks.get(port, set()).discard(block_id)
+        _reconcile_removed(port, block_id)
+        bad_replicas += 1
+    print(f"[MASTER] Node {port} reported corrupt replica of {block_id}")
     return "OK", 200
 
 
+@app.route("/orphans", methods=["GET"])
+def list_orphans():
+    with reports_lock:
+        return jsonify({p: sorted(ids) for p, ids in orphans.items() if ids})
+
+
+@app.route("/node_load", methods=["GET"])
+def node_load():
+    with nodes_lock:
+        out = {
+            p: dict(info["load"] or {}, alive=info["alive"])
+            for p, info in nodes.items()
+        }
+    return jsonify({"policy": placement_policy.name, "nodes": out})
+
+
+@app.route("/heartbeat_stats", methods=["GET"])
+def heartbeat_stats_view():
+    with nodes_lock:
+        out = dict(heartbeat_stats, nodes_tracked=len(node_expiry))
+    with clients_lock:
+        out["clients_tracked"] = len(clients)
+    out["cpu_seconds"] = time.process_time()
+    return jsonify(out)
+
+
 @app.route("/client_heartbeat", methods=["POST"])
 def client_heartbeat():
     data = request.get_json(force=True)
     cid = data.get("id")
     if not cid:
         return "missing id", 400
-    with lock:
-        clients[cid] = time.time()
+    with clients_lock:
+        clients.schedule(cid, time.time() + CLIENT_TIMEOUT)
     return "OK", 200
 
 
-@app.route("/upload", methods=["POST"])
-def upload():
-    data = request.get_json(force=True)
+def _parse_upload(data):
+    # Validates one upload request; returns (spec, None) or (None, error).
     filename = data.get("filename")
     if not filename:
-        return "missing filename", 400
+        return None, "missing filename"
+    # checked with "\\" as a separator too: clients on Windows save files
+    # under these names
+    if any(part in ("", ".", "..") for part in filename.replace("\\", "/").split("/")):
+        return None, "filename must be a relative path without empty, '.' or '..' parts"
 
     rep = int(data.get("replication_factor", 1))
     num_blocks = int(data.get("num_blocks", 1))
     size = int(data.get("size", 0))
 
+    # Content-addressed upload: the client sends the sha256 of every block and
+    # only pushes the blocks reported back without "exists"
+    hashes = data.get("hashes") if data.get("dedup") else None
+    if hashes is not None:
+        if data.get("ec"):
+            return None, "dedup and ec can't be combined"
+        num_blocks = len(hashes)
+
     if num_blocks <= 0:
-        return "num_blocks must be > 0", 400
+        return None, "num_blocks must be > 0"
+
+    # Per-file codec; the client (or first chain node) frames the blocks
+    codec = data.get("compression")
+    if codec:
+        try:
+            compression.check_codec(codec)
+        except ValueError as e:
+            return None, str(e)
+        if data.get("ec"):
+            return None, "compression and ec can't be combined"
+
+    # Erasure-coded upload: num_blocks counts stripes, and each stripe's k+m
+    # shards go to k+m distinct nodes
+    ec = data.get("ec")
+    if ec:
+        k, m = int(ec.get("k", 0)), int(ec.get("m", 0))
+        if k < 1 or m < 1 or k + m > 256:
+            return None, "ec needs k >= 1, m >= 1 and k + m <= 256"
+        ec = {"k": k, "m": m}
+        rep = 1
+        width = k + m
+    else:
+        width = rep
+
+    return {
+        "filename": filename,
+        "rep": rep,
+        "num_blocks": num_blocks,
+        "size": size,
+        "hashes": hashes,
+        "codec": codec,
+        "ec": ec,
+        "width": width,
+    }, None
+
+
+def _placer(alive_nodes, loads, placed):
+    # place(width, exclude) returns None if fewer than width nodes remain
+    # once `exclude` is left out
+    def place(width, exclude=()):
+        candidates = [p for p in alive_nodes if p not in exclude] if exclude else alive_nodes
+        if len(candidates) < width:
+            return None
+        chosen = placement_policy.choose(candidates, width, loads)
+        for p in chosen:
+            placed[p] = placed.get(p, 0) + 1
+            if loads[p]:
+                loads[p]["pending"] += 1
+        return chosen
+    return place
+
 
-    with lock:
-        alive_nodes = [p for p, info in nodes.items() if info["alive"]]
-        if not alive_nodes:
-            return "No alive nodes available", 500
+def _plan_blocks(spec, place):
+    # Placement of a non-dedup upload, chosen before taking the lock
+    placements = []
+    if spec["hashes"] is None:
+        for i in range(spec["num_blocks"]):
+            chosen = place(spec["width"])
+            if spec["ec"]:
+                placements.extend([p] for p in chosen)
+            else:
+                placements.append(chosen)
+    return placements
 
-        if rep > len(alive_nodes):
-            return f"Not enough alive nodes ({len(alive_nodes)} available)", 500
 
-        blocks_meta = []
-        for i in range(num_blocks):
-            chosen = random.sample(alive_nodes, rep)
-            block_id = f"{filename}__blk{i}"
+def _register_upload(spec, placements, place):
+    # Builds the file's metadata and logs it. Caller holds ns_lock for
+    # writing. Returns (seq, response), or (None, error) if a dedup block
+    # can't be placed yet.
+    filename, ec, hashes = spec["filename"], spec["ec"], spec["hashes"]
+    # positions whose block a node has confirmed storing (or that are sent
+    # earlier in this upload)
+    exists = []
+    generation = _new_generation()
+    blocks_meta = []
+    if hashes is not None:
+        new = {}
+        # replicas of already placed blocks that their nodes have reported
+        confirmed = {}
+        with reports_lock:
+            for block_id in {CAS_PREFIX + h for h in hashes}:
+                if block_id in block_map:
+                    confirmed[block_id] = [
+                        p for p in block_map[block_id]["replicas"]
+                        if block_id in node_blocks.get(p, ())
+                    ]
+        for h in hashes:
+            block_id = CAS_PREFIX + h
+            shared = block_map.get(block_id)
+            if confirmed.get(block_id):
+                chosen, known = confirmed[block_id], True
+            elif block_id in new:
+                chosen, known = new[block_id], True
+            elif shared is not None and shared["replicas"]:
+                # placed by another upload that no node has confirmed yet
+                # (it may still be in flight, or have failed): send it too
+                chosen, known = list(shared["replicas"]), False
+                new[block_id] = chosen
+            else:
+                chosen, known = place(spec["width"], _deleting_on(block_id)), False
+                if chosen is None:
+                    return None, (
+                        f"block {block_id} is still being deleted from its "
+                        "previous nodes; retry shortly"
+                    )
+                new[block_id] = chosen
+            exists.append(known)
             blocks_meta.append({"id": block_id, "replicas": chosen})
+    for i, chosen in enumerate(placements):
+        block_id = f"{filename}__g{generation}__blk{i}"
+        b = {"id": block_id, "replicas": chosen}
+        if ec:
+            b["stripe"], b["shard"] = divmod(i, spec["width"])
+        blocks_meta.append(b)
 
-        file_index[filename] = {
-            "replication_factor": rep,
-            "size": size,
-            "block_size": BLOCK_SIZE,
-            "blocks": blocks_meta,
-        }
+    meta = {
+        "replication_factor": spec["rep"],
+        "size": spec["size"],
+        "block_size": BLOCK_SIZE,
+        "generation": generation,
+        "blocks": blocks_meta,
+    }
+    if ec:
+        meta["ec"] = ec
+    if hashes is not None:
+        meta["dedup"] = True
+    if spec["codec"]:
+        meta["compression"] = spec["codec"]
+    response_blocks = [{"id": b["id"], "nodes": list(b["replicas"])} for b in blocks_meta]
+    seq = _log_edit({"op": "upload", "filename": filename, "meta": meta})
+    if hashes is not None:
+        # reused blocks may now be wanted at a higher RF
+        _enqueue_blocks([b["id"] for b, known in zip(blocks_meta, exists) if known])
 
-    response_blocks = [{"id": b["id"], "nodes": b["replicas"]} for b in blocks_meta]
-    return jsonify(
-        {
-            "filename": filename,
-            "replication_factor": rep,
-            "block_size": BLOCK_SIZE,
-            "blocks": response_blocks,
-        }
-    )
+    for rb, known in zip(response_blocks, exists):
+        if known:
+            rb["exists"] = True
+    return seq, {
+        "filename": filename,
+        "replication_factor": spec["rep"],
+        "block_size": BLOCK_SIZE,
+        "ec": ec,
+        "compression": spec["codec"],
+        "blocks": response_blocks,
+    }
+
+
+def _add_pending(placed):
+    with nodes_lock:
+        for p, count in placed.items():
+            if nodes[p].get("load"):
+                nodes[p]["load"]["pending"] += count
+
+
+@app.route("/upload", methods=["POST"])
+def upload():
+    spec, error = _parse_upload(request.get_json(force=True))
+    if error:
+        return error, 400
+
+    alive_nodes, loads = _placement_candidates()
+    if not alive_nodes:
+        return "No alive nodes with free space available", 500
+
+    if spec["width"] > len(alive_nodes):
+        return f"Not enough alive nodes with free space ({len(alive_nodes)} available)", 500
+
+    placed = {}
+    place = _placer(alive_nodes, loads, placed)
+    placements = _plan_blocks(spec, place)
+    with ns_lock.write():
+        seq, out = _register_upload(spec, placements, place)
+    if seq is None:
+        return out, 503
+    editlog.wait(seq)
+    _add_pending(placed)
+
+    out["alive_nodes"] = alive_nodes
+    return jsonify(out)
+
+
+@app.route("/upload_batch", methods=["POST"])
+def upload_batch():
+    # /upload for many files: every file is placed and logged under one
+    # namespace lock and the edits share one edit log flush. Files that fail
+    # validation get an "error" entry; the rest are registered.
+    reqs = request.get_json(force=True).get("files")
+    if not isinstance(reqs, list) or not reqs:
+        return "missing files", 400
+    if len(reqs) > UPLOAD_BATCH_MAX:
+        return f"at most {UPLOAD_BATCH_MAX} files per batch", 400
+
+    alive_nodes, loads = _placement_candidates()
+    if not alive_nodes:
+        return "No alive nodes with free space available", 500
+
+    placed = {}
+    place = _placer(alive_nodes, loads, placed)
+    results = []
+    planned = []
+    for data in reqs:
+        spec, error = _parse_upload(data)
+        if error is None and spec["width"] > len(alive_nodes):
+            error = f"Not enough alive nodes with free space ({len(alive_nodes)} available)"
+        if error:
+            results.append({"filename": data.get("filename"), "error": error})
+            continue
+        results.append(None)
+        planned.append((len(results) - 1, spec, _plan_blocks(spec, place)))
+
+    seq = None
+    with ns_lock.write():
+        for pos, spec, placements in planned:
+            file_seq, out = _register_upload(spec, placements, place)
+            if file_seq is None:
+                results[pos] = {"filename": spec["filename"], "error": out}
+                continue
+            seq, results[pos] = file_seq, out
+    if seq is not None:
+        editlog.wait(seq)
+    _add_pending(placed)
+
+    return jsonify({"files": results, "alive_nodes": alive_nodes})
+
+
+@app.route("/block_replicas", methods=["POST"])
+def block_replicas():
+    # Clients report the placement they actually achieved when a replica push
+    # failed or was retried on an alternate node.
+    data = request.get_json(force=True)
+    filename = data.get("filename")
+    block_id = data.get("block_id")
+    replicas = data.get("replicas")
+    if not filename or not block_id or replicas is None:
+        return "missing filename, block_id or replicas", 400
+
+    with ns_lock.write():
+        meta = file_index.get(filename)
+        if not meta:
+            return "File not found", 404
+        if filename not in block_refs.get(block_id, ()):
+            return "Block not found", 404
+        seq = _log_edit(
+            {
+                "op": "set_replicas",
+                "filename": filename,
+                "block_id": block_id,
+                "replicas": [str(p) for p in replicas],
+            }
+        )
+        _enqueue_blocks([block_id])
+    editlog.wait(seq)
+
+    return "OK", 200
+
+
+def _covering_blocks(meta, offset, length):
+    """Index range [lo, hi) of the stored blocks holding bytes
+    [offset, offset + length) of the file. EC files are cut on whole
+    stripes so a degraded read still has its parity shards."""
+    size = meta.get("size", 0)
+    end = size if length is None else min(size, offset + length)
+    if offset >= end:
+        return 0, 0
+    block_size = meta.get("block_size", BLOCK_SIZE)
+    ec = meta.get("ec")
+    if ec:
+        stripe = ec["k"] * block_size
+        width = ec["k"] + ec["m"]
+        return offset // stripe * width, ((end - 1) // stripe + 1) * width
+    return offset // block_size, (end - 1) // block_size + 1
+
+
+def _locate_range(data):
+    # Returns (offset, length, error) of a locate request; error is None if
+    # the range is valid
+    offset = data.get("offset")
+    length = data.get("length")
+    if offset is not None and (not isinstance(offset, int) or offset < 0):
+        return None, None, "offset must be a non-negative integer"
+    if length is not None and (not isinstance(length, int) or length < 0):
+        return None, None, "length must be a non-negative integer"
+    return offset, length, None
+
+
+def _locate_file(filename, meta, alive, offset=None, length=None):
+    # Caller holds ns_lock (read)
+    lo, hi = 0, len(meta["blocks"])
+    if offset is not None or length is not None:
+        lo, hi = _covering_blocks(meta, offset or 0, length)
+
+    blocks = []
+    for i in range(lo, hi):
+        b = meta["blocks"][i]
+        reps = b["replicas"]
+        alive_rep = [p for p in reps if p in alive]
+        dead_rep = [p for p in reps if p not in alive_rep]
+        blocks.append(
+            {
+                "id": b["id"],
+                "index": i,
+                "nodes": alive_rep + dead_rep,
+                "alive": len(alive_rep),
+            }
+        )
+
+    return {
+        "filename": filename,
+        "size": meta.get("size", 0),
+        "block_size": meta.get("block_size", BLOCK_SIZE),
+        "replication_factor": meta.get("replication_factor", 1),
+        "generation": meta.get("generation"),
+        "ec": meta.get("ec"),
+        "compression": meta.get("compression"),
+        "blocks": blocks,
+    }
 
 
 @app.route("/locate", methods=["POST"])
@@ -126,28 +1021,48 @@ def locate():
     filename = data.get("filename")
     if not filename:
         return "missing filename", 400
+    offset, length, error = _locate_range(data)
+    if error:
+        return error, 400
 
-    with lock:
+    alive = set(_alive_nodes())
+    with ns_lock.read():
         meta = file_index.get(filename)
         if not meta:
             return "File not found", 404
+        return jsonify(_locate_file(filename, meta, alive, offset, length))
 
-        blocks = []
-        for b in meta["blocks"]:
-            reps = b["replicas"]
-            alive_rep = [p for p in reps if nodes.get(p, {}).get("alive")]
-            dead_rep = [p for p in reps if p not in alive_rep]
-            blocks.append({"id": b["id"], "nodes": alive_rep + dead_rep})
 
-        return jsonify(
-            {
-                "filename": filename,
-                "size": meta.get("size", 0),
-                "block_size": meta.get("block_size", BLOCK_SIZE),
-                "replication_factor": meta.get("replication_factor", 1),
-                "blocks": blocks,
-            }
-        )
+@app.route("/locate_batch", methods=["POST"])
+def locate_batch():
+    # /locate for many files under one namespace lock. `files` entries are
+    # filenames or {"filename", "offset", "length"}; unknown files are listed
+    # under "missing".
+    reqs = request.get_json(force=True).get("files")
+    if not isinstance(reqs, list):
+        return "missing files", 400
+    if len(reqs) > LOCATE_BATCH_MAX:
+        return f"at most {LOCATE_BATCH_MAX} files per batch", 400
+    reqs = [r if isinstance(r, dict) else {"filename": r} for r in reqs]
+    for r in reqs:
+        if not r.get("filename"):
+            return "missing filename", 400
+        error = _locate_range(r)[2]
+        if error:
+            return f"{r['filename']}: {error}", 400
+
+    alive = set(_alive_nodes())
+    found, missing = [], []
+    with ns_lock.read():
+        for r in reqs:
+            meta = file_index.get(r["filename"])
+            if not meta:
+                missing.append(r["filename"])
+                continue
+            found.append(
+                _locate_file(r["filename"], meta, alive, r.get("offset"), r.get("length"))
+            )
+    return jsonify({"files": found, "missing": missing})
 
 
 @app.route("/delete", methods=["POST"])
@@ -157,129 +1072,338 @@ def delete():
     if not filename:
         return "missing filename", 400
 
-    with lock:
+    with ns_lock.write():
         meta = file_index.get(filename)
         if not meta:
             return "File not found", 404
         blocks = list(meta["blocks"])
-        del file_index[filename]
+        seq = _log_edit({"op": "delete", "filename": filename})
+        # blocks still referenced by other files stay on their nodes
+        freed = {b["id"]: list(b["replicas"]) for b in blocks if b["id"] not in block_map}
+        shared = len({b["id"] for b in blocks}) - len(freed)
+        _mark_deleting(freed, freed.get)
+    editlog.wait(seq)
 
     deleted_from = {}
-    for b in blocks:
-        block_id = b["id"]
-        for p in b["replicas"]:
+    for block_id, replicas in freed.items():
+        for p in replicas:
             try:
-                r = requests.post(
+                r = http_pool.post(
                     f"http://127.0.0.1:{p}/block_delete",
                     json={"block_id": block_id},
                     timeout=2,
                 )
                 deleted_from.setdefault(p, []).append(block_id)
+                _deleted(p, [block_id])
             except Exception:
-                # best-effort
+                # best-effort; a cas_ id stays off p until the timeout
                 pass
 
-    return jsonify({"filename": filename, "deleted_from": deleted_from})
+    return jsonify({"filename": filename, "deleted_from": deleted_from, "shared_blocks_kept": shared})
+
+
+@app.route("/metadata_stats", methods=["GET"])
+def metadata_stats():
+    stats = editlog.get_stats()
+    stats["restart_seconds"] = restart_seconds
+    stats["files"] = len(file_index)
+    with ns_lock.read():
+        stats["blocks"] = len(block_map)
+        stats["block_references"] = sum(sum(r.values()) for r in block_refs.values())
+    return jsonify(stats)
+
+
+def _file_summary(filename, meta):
+    return {
+        "name": filename,
+        "replication_factor": meta.get("replication_factor", 1),
+        "size": meta.get("size", 0),
+        "block_size": meta.get("block_size", BLOCK_SIZE),
+        "ec": meta.get("ec"),
+        "compression": meta.get("compression"),
+        "dedup": meta.get("dedup", False),
+        "generation": meta.get("generation"),
+        "num_blocks": len(meta.get("blocks", [])),
+    }
 
 
 @app.route("/list", methods=["GET"])
 def list_files():
-    with lock:
-        out = {}
-        for fname, meta in file_index.items():
-            out[fname] = {
-                "replication_factor": meta.get("replication_factor", 1),
-                "size": meta.get("size", 0),
-                "block_size": meta.get("block_size", BLOCK_SIZE),
-                "num_blocks": len(meta.get("blocks", [])),
-                "blocks": meta.get("blocks", []),
-            }
-        return jsonify(out)
+    # One page of file summaries (no block lists) under `prefix`, after
+    # `cursor`. With delimiter=/ only the prefix's direct entries are listed
+    # and each subdirectory comes back once, with its counts.
+    prefix = request.args.get("prefix", "")
+    cursor = request.args.get("cursor")
+    limit = request.args.get("limit", LIST_LIMIT, type=int)
+    delimiter = request.args.get("delimiter")
+    if delimiter not in (None, "", namespace.SEP):
+        return f"only {namespace.SEP!r} is supported as delimiter", 400
+    if limit <= 0:
+        return "limit must be > 0", 400
+    limit = min(limit, LIST_MAX)
 
+    with ns_lock.read():
+        entries, next_cursor = name_index.list(prefix, cursor, limit, dirs=bool(delimiter))
+        files, dirs = [], []
+        for kind, name in entries:
+            if kind == "dir":
+                dirs.append(dict(name_index.dir_stats(name), prefix=name))
+            else:
+                files.append(_file_summary(name, file_index[name]))
+        out = {"prefix": prefix, "files": files, "dirs": dirs, "next_cursor": next_cursor}
+        if not prefix or prefix.endswith(namespace.SEP):
+            out["dir"] = name_index.dir_stats(prefix)
+    return jsonify(out)
 
-def _snapshot_state_for_replication():
-    with lock:
-        alive_nodes = [p for p, info in nodes.items() if info["alive"]]
-        files_copy = json.loads(json.dumps(file_index))
-    return alive_nodes, files_copy
 
+@app.route("/dir_stats", methods=["GET"])
+def dir_stats():
+    path = request.args.get("path", "")
+    with ns_lock.read():
+        stats = name_index.dir_stats(path)
+    if stats is None:
+        return "No such directory", 404
+    return jsonify(dict(stats, path=namespace.dir_key(path)))
 
-def _perform_re_replication(alive_nodes, files_copy):
-    if not alive_nodes:
-        return
 
-    for filename, meta in files_copy.items():
-        rf = meta.get("replication_factor", 1)
-        for b in meta.get("blocks", []):
-            block_id = b["id"]
-            replicas = b["replicas"]
-            alive_reps = [p for p in replicas if p in alive_nodes]
+def _next_repair(pool):
+    # Pops the most urgent block that can be repaired now and claims a source
+    # and target slot for it. Blocks whose nodes are all at their caps are
+    # put back for a later call. A replicated block takes along further
+    # queued blocks that can be copied between the same two nodes.
+    deferred = []
+    job = None
+    alive_set = set(_alive_nodes())
+    targets, _ = _placement_candidates()
+    with ns_lock.read(), repl_lock:
+        while repl_queue and len(deferred) < REPAIR_SCAN:
+            entry = heapq.heappop(repl_queue)
+            block_id = entry[-1]
+            if block_id not in repl_queued:
+                continue
 
-            if len(alive_reps) >= rf:
+            need = _replication_need(block_id, alive_set)
+            if need is None:
+                del repl_queued[block_id]
+                continue
+            filename, _, live = need
+            meta = file_index[filename]
+            replicas = block_map[block_id]["replicas"]
+            deleting = _deleting_on(block_id)
+            candidates = [p for p in targets if p not in replicas and p not in deleting]
+            if meta.get("ec"):
+                # a lost shard is rebuilt from k others, preferably on a node
+                # that holds nothing else of the stripe
+                sources, used = _stripe_sources(meta, block_map[block_id], alive_set)
+                live = [] if len(sources) < meta["ec"]["k"] else [s["port"] for s in sources]
+                candidates = [p for p in candidates if p not in used] or candidates
+            if not live or not candidates:
+                del repl_queued[block_id]
+                repl_stalled.add(block_id)
                 continue
 
-            candidates = [p for p in alive_nodes if p not in replicas]
-            if not candidates or not alive_reps:
+            pair = pool.reserve(live, candidates)
+            if pair is None:
+                deferred.append(entry)
                 continue
+            del repl_queued[block_id]
+            job = (filename, block_id) + pair + ([],)
+            if not meta.get("ec"):
+                _batch_repairs(job, alive_set, deferred)
+            break
 
-            src = alive_reps[0]
-            dst = random.choice(candidates)
+        for entry in deferred:
+            heapq.heappush(repl_queue, entry)
+    return job
 
-            try:
-                rr = requests.post(
-                    f"http://127.0.0.1:{src}/block_fetch",
-                    json={"block_id": block_id},
-                    timeout=3,
-                )
-                if rr.status_code != 200:
-                    continue
-                data = rr.json().get("data", "")
-
-                wr = requests.post(
-                    f"http://127.0.0.1:{dst}/block_store",
-                    json={"block_id": block_id, "data": data},
-                    timeout=3,
-                )
-                if wr.status_code != 200:
-                    continue
-
-                with lock:
-                    real_meta = file_index.get(filename)
-                    if not real_meta:
-                        continue
-                    real_block = next(
-                        (bb for bb in real_meta["blocks"] if bb["id"] == block_id), None
-                    )
-                    if real_block and dst not in real_block["replicas"]:
-                        real_block["replicas"].append(dst)
-                        print(
-                            f"[MASTER] Re-replicated block {block_id} from {src} -> {dst}"
-                        )
 
-            except Exception as e:
-                print(f"[MASTER] Re-replication error for {block_id}: {e}")
+def _batch_repairs(job, alive, deferred):
+    # Moves queued replicated blocks that `src` holds and `dst` lacks into
+    # job's batch. Caller holds ns (read) and repl_lock.
+    _, _, src, dst, more = job
+    scanned = 0
+    while repl_queue and len(more) < REPAIR_BATCH - 1 and scanned < REPAIR_SCAN:
+        entry = heapq.heappop(repl_queue)
+        scanned += 1
+        block_id = entry[-1]
+        if block_id not in repl_queued:
+            continue
+        need = _replication_need(block_id, alive)
+        if need is None:
+            del repl_queued[block_id]
+            continue
+        filename, _, live = need
+        if (
+            file_index[filename].get("ec")
+            or src not in live
+            or dst in block_map[block_id]["replicas"]
+            or dst in _deleting_on(block_id)
+        ):
+            deferred.append(entry)
+            continue
+        del repl_queued[block_id]
+        more.append(block_id)
+
+
+def _replicate_batch(job, throttle):
+    filename, block_id, src, dst, more = job
+    block_ids = [block_id] + more
+    r = http_pool.post(
+        f"http://127.0.0.1:{dst}/replicate_batch",
+        json={"block_ids": block_ids, "source": src},
+        timeout=15 + len(block_ids),
+    )
+    if r.status_code != 200:
+        print(f"[MASTER] Re-replication of {len(block_ids)} blocks {src} -> {dst} failed: {r.text}")
+        return None
+    reply = r.json()
+    throttle(reply.get("bytes", 0))
+
+    with ns_lock.write():
+        done = []
+        for b in reply.get("stored", []):
+            owner = block_owner.get(b)
+            if owner is not None:
+                _log_edit({"op": "add_replica", "filename": owner, "block_id": b, "port": dst})
+                done.append(b)
+        print(f"[MASTER] Re-replicated {len(done)} blocks from {src} -> {dst}")
+        _enqueue_blocks(done)
+    failed = reply.get("failed", {})
+    for b, reason in failed.items():
+        print(f"[MASTER] Re-replication of {b} {src} -> {dst} failed: {reason}")
+    if not reply.get("stored"):
+        return None
+    with repl_lock:
+        for b in failed:
+            repl_retry[b] = time.time() + REPLICATION_RETRY_DELAY
+    return reply.get("bytes", 0)
+
+
+def _re_replicate(job, throttle):
+    # The target pulls the block from the source itself; the master only
+    # sends the command and records the new replica.
+    filename, block_id, src, dst, more = job
+    if more:
+        return _replicate_batch(job, throttle)
+    with ns_lock.read():
+        meta = file_index.get(filename)
+        ec = meta.get("ec") if meta and block_owner.get(block_id) == filename else None
+        if ec:
+            sources, _ = _stripe_sources(meta, block_map[block_id], set(_alive_nodes()))
+            index = block_map[block_id]["shard"]
+    if ec:
+        # the reserved source goes first; the target reads k of these
+        sources.sort(key=lambda s: s["port"] != src)
+        r = http_pool.post(
+            f"http://127.0.0.1:{dst}/rebuild_shard",
+            json={"block_id": block_id, "index": index, "k": ec["k"], "m": ec["m"], "sources": sources},
+            timeout=30,
+        )
+    else:
+        r = http_pool.post(
+            f"http://127.0.0.1:{dst}/replicate_from",
+            json={"block_id": block_id, "source": src},
+            timeout=15,
+        )
+    if r.status_code != 200:
+        print(f"[MASTER] Re-replication of {block_id} {src} -> {dst} failed: {r.text}")
+        return None
+    reply = r.json()
+    # a shard rebuild moves the k shards it reads, not the one it writes
+    copied = reply.get("bytes_read", reply.get("bytes", 0))
+    throttle(copied)
+
+    with ns_lock.write():
+        # a shared block may have changed owner since the job was picked
+        owner = block_owner.get(block_id)
+        if owner is not None:
+            _log_edit({"op": "add_replica", "filename": owner, "block_id": block_id, "port": dst})
+            print(f"[MASTER] Re-replicated block {block_id} from {src} -> {dst}")
+            # still short if RF - live was more than one
+            _enqueue_blocks([block_id])
+    return copied
+
+
+def _retry_later(job):
+    with repl_lock:
+        for block_id in [job[1]] + job[4]:
+            repl_retry[block_id] = time.time() + REPLICATION_RETRY_DELAY
+
+
+replicator = replication.ReplicationPool(
+    _next_repair,
+    _re_replicate,
+    _retry_later,
+    workers=REPLICATION_CFG.get("workers", 8),
+    per_source=REPLICATION_CFG.get("per_source", 2),
+    per_target=REPLICATION_CFG.get("per_target", 2),
+    bandwidth=REPLICATION_CFG.get("bandwidth_mb_s", 0) * 1e6,
+)
+
+
+@app.route("/replication_status", methods=["GET"])
+def replication_status():
+    with repl_lock:
+        out = {
+            "queued": len(repl_queued),
+            "stalled": len(repl_stalled),
+            "retrying": len(repl_retry),
+            "bad_replicas": bad_replicas,
+        }
+    out.update(replicator.stats())
+    return jsonify(out)
 
 
 def monitor_loop():
+    started = time.time()
+    initial_scan_done = False
     while True:
         time.sleep(MONITOR_INTERVAL)
         now = time.time()
-        with lock:
-            for port, info in list(nodes.items()):
-                if info["alive"] and (now - info["last_heartbeat"] > HEARTBEAT_TIMEOUT):
-                    info["alive"] = False
-                    print(f"[MASTER] Node {port} went DOWN")
+        # Only the nodes and clients whose deadline has passed are touched
+        with nodes_lock:
+            went_down = node_expiry.expire(now)
+            for port in went_down:
+                nodes[port]["alive"] = False
+                print(f"[MASTER] Node {port} went DOWN")
+            heartbeat_stats["nodes_expired"] += len(went_down)
+        if went_down:
+            _on_nodes_down(went_down)
+
+        with clients_lock:
+            heartbeat_stats["clients_expired"] += len(clients.expire(now))
 
-            dead_clients = [c for c, t in clients.items() if now - t > CLIENT_TIMEOUT]
-            for c in dead_clients:
-                del clients[c]
+        with repl_lock:
+            due = [b for b, t in repl_retry.items() if t <= now]
+            for block_id in due:
+                del repl_retry[block_id]
+        if due:
+            with ns_lock.read():
+                _enqueue_blocks(due)
 
-        alive_nodes, files_copy = _snapshot_state_for_replication()
-        _perform_re_replication(alive_nodes, files_copy)
+        # Nodes that never report after a restart produce no DOWN event, so
+        # look at every block once, when liveness has had time to settle.
+        if not initial_scan_done and now - started > HEARTBEAT_TIMEOUT:
+            _enqueue_all_under_replicated()
+            initial_scan_done = True
+
+
+def checkpoint_loop():
+    while True:
+        time.sleep(CHECKPOINT_INTERVAL)
+        if not editlog.edits_since_snapshot():
+            continue
+        try:
+            _checkpoint()
+        except Exception as e:
+            print(f"[MASTER] Checkpoint failed: {e}")
 
 
+_load_metadata()
 threading.Thread(target=monitor_loop, daemon=True).start()
+replicator.start()
+threading.Thread(target=checkpoint_loop, daemon=True).start()
 
 if __name__ == "__main__":
     print("[MASTER] Running at 4000 with block-based DFS")
-    app.run(port=4000)
+    http_pool.serve(app, 4000)
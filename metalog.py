@@ -0,0 +1,193 @@
+"""
+Durable master metadata: an append-only edit log plus periodic snapshots.
+
+Edits are JSON lines tagged with a sequence number. append() only queues a
+record (cheap enough to call under the master lock, which keeps log order
+equal to mutation order); a flusher thread writes everything queued so far
+and fsyncs once per batch (group commit), and wait() blocks until a given
+record is durable.
+
+Layout of the metadata directory:
+  fsimage.json          latest snapshot: {"seq": N, "state": {...}}
+  edits_<first>.log     log segments; roll() starts a new one so segments
+                        covered by a snapshot can be deleted whole
+"""
+
+import json
+import os
+import threading
+import time
+
+SNAPSHOT_NAME = "fsimage.json"
+
+
+class EditLog:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._pending = []
+        self._last_seq = 0
+        self._durable_seq = 0
+        self._snapshot_seq = 0
+        self._error = None
+        self._file = None
+
+        self.stats = {
+            "records": 0,
+            "fsyncs": 0,
+            "fsync_seconds": 0.0,
+            "max_batch": 0,
+            "load_seconds": 0.0,
+            "replayed": 0,
+            "snapshots": 0,
+            "snapshot_seconds": 0.0,
+        }
+
+    # ---------- startup ----------
+    def _segments(self):
+        segs = []
+        for name in os.listdir(self.directory):
+            if name.startswith("edits_") and name.endswith(".log"):
+                segs.append((int(name[6:-4]), os.path.join(self.directory, name)))
+        return sorted(segs)
+
+    def load(self):
+        """Return (state, records): the latest snapshot state (or None) and
+        the log records written after it, in order. Starts the flusher."""
+        started = time.time()
+        state = None
+        snap_path = os.path.join(self.directory, SNAPSHOT_NAME)
+        if os.path.exists(snap_path):
+            with open(snap_path, "r") as f:
+                snap = json.load(f)
+            self._snapshot_seq = snap["seq"]
+            state = snap["state"]
+
+        records = []
+        last_seq = self._snapshot_seq
+        for _, path in self._segments():
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # torn write at the tail of a crashed segment
+                        break
+                    if rec["seq"] > last_seq:
+                        records.append(rec)
+                        last_seq = rec["seq"]
+
+        self._last_seq = self._durable_seq = last_seq
+        self._open_segment(last_seq + 1)
+        self.stats["replayed"] = len(records)
+        self.stats["load_seconds"] = time.time() - started
+
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        return state, records
+
+    def _open_segment(self, first_seq):
+        path = os.path.join(self.directory, f"edits_{first_seq:012d}.log")
+        self._file = open(path, "a", encoding="utf-8")
+
+    # ---------- writing ----------
+    def append(self, record):
+        """Queue a record and return its sequence number."""
+        with self._cond:
+            self._last_seq += 1
+            record = dict(record, seq=self._last_seq)
+            self._pending.append(json.dumps(record, separators=(",", ":")) + "\n")
+            self._cond.notify_all()
+            return self._last_seq
+
+    def wait(self, seq):
+        """Block until record `seq` is on disk."""
+        with self._cond:
+            while self._durable_seq < seq:
+                if self._error:
+                    raise IOError(f"edit log write failed: {self._error}")
+                self._cond.wait()
+
+    def _write_batch(self):
+        # Caller holds _io_lock.
+        with self._cond:
+            batch, self._pending = self._pending, []
+            last = self._last_seq
+        if batch:
+            t0 = time.time()
+            self._file.write("".join(batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.stats["fsyncs"] += 1
+            self.stats["fsync_seconds"] += time.time() - t0
+            self.stats["records"] += len(batch)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        with self._cond:
+            self._durable_seq = last
+            self._cond.notify_all()
+        return last
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            try:
+                with self._io_lock:
+                    self._write_batch()
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                print(f"[METALOG] Flush failed: {e}")
+                return
+
+    # ---------- checkpointing ----------
+    def roll(self):
+        """Make everything queued so far durable and start a new segment.
+        Returns the last sequence number of the closed segment; call it under
+        the same lock that guards the state being snapshotted."""
+        with self._io_lock:
+            last = self._write_batch()
+            self._file.close()
+            self._open_segment(last + 1)
+        return last
+
+    def edits_since_snapshot(self):
+        with self._cond:
+            return self._last_seq - self._snapshot_seq
+
+    def write_snapshot(self, seq, state_json):
+        """Persist a snapshot covering records up to `seq` (state_json is the
+        already serialized state) and drop the segments it makes redundant."""
+        t0 = time.time()
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write('{"seq": %d, "state": %s}' % (seq, state_json))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+        for first, seg_path in self._segments():
+            if first <= seq:
+                os.remove(seg_path)
+
+        with self._cond:
+            self._snapshot_seq = seq
+        self.stats["snapshots"] += 1
+        self.stats["snapshot_seconds"] = time.time() - t0
+
+    def get_stats(self):
+        out = dict(self.stats)
+        out["avg_batch"] = out["records"] / out["fsyncs"] if out["fsyncs"] else 0.0
+        out["avg_fsync_ms"] = (
+            1000 * out["fsync_seconds"] / out["fsyncs"] if out["fsyncs"] else 0.0
+        )
+        with self._cond:
+            out["last_seq"] = self._last_seq
+            out["durable_seq"] = self._durable_seq
+            out["snapshot_seq"] = self._snapshot_seq
+        return out
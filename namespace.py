@@ -0,0 +1,131 @@
+"""
+Directory-aware index of the master's file names.
+
+Names are kept in one sorted list, so the files under a prefix are a
+contiguous run found with bisect, and listings page through it from a
+cursor (the last name or directory returned) without looking at anything
+before it. Directories are implied by "/" in names ("a/b/c.txt" lives in
+"a/b/", which lives in "a/", which lives in the root ""). Every directory
+keeps running totals of the files and bytes below it and of its direct
+entries, updated on add/remove in O(depth), so its counts are a lookup.
+
+A name insert is a list insert (a memmove of the pointer array); bulk
+loads sort once instead.
+"""
+
+import bisect
+
+SEP = "/"
+
+# The character right after SEP: every name inside directory "d/" sorts
+# before d + AFTER_SEP, so it is where a listing skips to past a directory
+AFTER_SEP = chr(ord(SEP) + 1)
+
+
+def dir_key(path):
+    """Normalize a directory path to its key: "" for the root, else with a
+    trailing SEP."""
+    path = path.strip(SEP)
+    return path + SEP if path else ""
+
+
+def parent_dirs(name):
+    parts = name.split(SEP)[:-1]
+    return [""] + [SEP.join(parts[:i]) + SEP for i in range(1, len(parts) + 1)]
+
+
+class Namespace:
+    def __init__(self):
+        self._names = []
+        self._sizes = {}
+        # dir key -> {"files", "bytes"} below it, "entries" directly in it
+        self._dirs = {"": {"files": 0, "bytes": 0, "entries": 0}}
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._sizes
+
+    def load(self, items):
+        """Replace the contents with (name, size) pairs."""
+        self._sizes = dict(items)
+        self._names = sorted(self._sizes)
+        self._dirs = {"": {"files": 0, "bytes": 0, "entries": 0}}
+        for name in self._names:
+            self._account(name, self._sizes[name], 1)
+
+    def add(self, name, size):
+        old = self._sizes.get(name)
+        if old is not None:
+            for d in parent_dirs(name):
+                self._dirs[d]["bytes"] += size - old
+        else:
+            bisect.insort(self._names, name)
+            self._account(name, size, 1)
+        self._sizes[name] = size
+
+    def remove(self, name):
+        size = self._sizes.pop(name, None)
+        if size is None:
+            return
+        del self._names[bisect.bisect_left(self._names, name)]
+        self._account(name, size, -1)
+
+    def _account(self, name, size, sign):
+        dirs = parent_dirs(name)
+        if sign > 0:
+            for parent, d in zip([None] + dirs, dirs):
+                stats = self._dirs.get(d)
+                if stats is None:
+                    stats = self._dirs[d] = {"files": 0, "bytes": 0, "entries": 0}
+                    self._dirs[parent]["entries"] += 1
+                stats["files"] += 1
+                stats["bytes"] += size
+            self._dirs[dirs[-1]]["entries"] += 1
+            return
+
+        self._dirs[dirs[-1]]["entries"] -= 1
+        for parent, d in reversed(list(zip([None] + dirs, dirs))):
+            stats = self._dirs[d]
+            stats["files"] -= 1
+            stats["bytes"] -= size
+            if d and not stats["files"]:
+                del self._dirs[d]
+                self._dirs[parent]["entries"] -= 1
+
+    def dir_stats(self, path):
+        """{"files", "bytes", "entries"} for a directory, or None if there
+        is no file under it."""
+        stats = self._dirs.get(dir_key(path))
+        return dict(stats) if stats is not None else None
+
+    def list(self, prefix="", cursor=None, limit=1000, dirs=False):
+        """Return (entries, next_cursor) for the names starting with prefix,
+        in order, after cursor. With dirs=True names below the next SEP
+        after the prefix are rolled up into one ("dir", "prefix.../")
+        entry; others are ("file", name). next_cursor is None on the last
+        page."""
+        names = self._names
+        i = bisect.bisect_left(names, prefix)
+        if cursor is not None and cursor >= prefix:
+            if dirs and cursor.endswith(SEP):
+                i = bisect.bisect_left(names, cursor[:-1] + AFTER_SEP)
+            else:
+                i = bisect.bisect_right(names, cursor)
+
+        out = []
+        while i < len(names) and len(out) < limit:
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            j = name.find(SEP, len(prefix)) if dirs else -1
+            if j >= 0:
+                d = name[:j + 1]
+                out.append(("dir", d))
+                i = bisect.bisect_left(names, d[:-1] + AFTER_SEP)
+            else:
+                out.append(("file", name))
+                i += 1
+        more = i < len(names) and names[i].startswith(prefix)
+        return out, (out[-1][1] if more and out else None)
@@ -1,5 +1,17 @@
-from flask import Flask, request, jsonify
-import os, threading, time, sys, requests
+from flask import Flask, request, jsonify, Response
+import os, threading, time, sys, shutil, json, zlib, hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import blockstore
+import cache
+import compression
+import erasure
+import framing
+import http_pool
+import liveness
+from blockstore import CorruptBlock
+from replication import TokenBucket
 
 app = Flask(__name__)
 
@@ -12,13 +24,230 @@ NODE_NUM = PORT[-1]  # assumes single digit 1..9
 STORAGE = f"storage/node{NODE_NUM}"
 MASTER = "http://127.0.0.1:4000"
 
+# Per-hop timeout when forwarding a chained write to the next replica
+FORWARD_TIMEOUT = 5
+
+# Timeout when pulling a block from another node for re-replication
+REPLICATE_TIMEOUT = 10
+
+# Storage engine (see blockstore.py), from the optional "storage" section of
+# config/config.json, e.g. {"engine": "segment", "segment_mb": 64}:
+#   "file"    - one <block_id>.blk file per block (default)
+#   "segment" - append-only segment files under STORAGE/segments; .blk files
+#               left from the file engine are moved in at startup
+# File blocks written before checksums existed have no header and are served
+# unverified until the scrubber adds one.
+STORAGE_ENGINE = "file"
+SEGMENT_MB = 64
+
+# How often the storage engine checkpoints its index / compacts (seconds)
+MAINTAIN_INTERVAL = 30
+
+# Full block reads are streamed from disk in STREAM_CHUNK pieces without
+# being checked here: the checksum header goes out with them, clients verify
+# it end to end and the scrubber re-verifies every block in the background.
+# A block read again within the last HOT_ADMIT_WINDOW streamed blocks is
+# verified once and kept in a HOT_CACHE_BYTES LRU instead.
+STREAM_CHUNK = 64 * 1024
+HOT_CACHE_BYTES = 64 * 1024 * 1024
+HOT_ADMIT_WINDOW = 4096
+
+# CRC32 of a block body as 8 hex digits, sent with stores and fetches so
+# corruption on the wire is caught too
+CHECKSUM_HEADER = "X-Checksum"
+
+# Content-addressed block ids (dedup uploads) are this prefix + the sha256
+# of the block, which is checked on store
+CAS_PREFIX = "cas_"
+
+# Sent by a client to the first node of a chained write to have that node
+# frame the block with the named codec (see compression.py) before storing
+# and forwarding it; the client's checksum covers the raw block
+COMPRESS_HEADER = "X-Compress"
+
+# Heartbeats go out every HEARTBEAT_INTERVAL seconds while the node is busy
+# (blocks changing, transfers running, deletes coming back) and back off,
+# doubling, to HEARTBEAT_MAX_INTERVAL while it is idle. The interval is sent
+# along so the master widens the node's timeout to match. A block change
+# brings the next heartbeat forward again.
+HEARTBEAT_INTERVAL = 1
+HEARTBEAT_MAX_INTERVAL = 3
+
+# Background scrubber: re-reads every block at most SCRUB_RATE bytes/s and
+# starts a new pass SCRUB_INTERVAL seconds after the previous one ended
+SCRUB_RATE = 4 * 1024 * 1024
+SCRUB_INTERVAL = 600
+
+_cfg_path = os.path.join("config", "config.json")
+if os.path.exists(_cfg_path):
+    with open(_cfg_path, "r") as f:
+        _storage_cfg = json.load(f).get("storage", {})
+    STORAGE_ENGINE = _storage_cfg.get("engine", STORAGE_ENGINE)
+    SEGMENT_MB = _storage_cfg.get("segment_mb", SEGMENT_MB)
+
 os.makedirs(STORAGE, exist_ok=True)
+if STORAGE_ENGINE == "segment":
+    store = blockstore.SegmentStore(
+        os.path.join(STORAGE, "segments"), int(SEGMENT_MB * 1024 * 1024)
+    )
+elif STORAGE_ENGINE == "file":
+    store = blockstore.FileStore(STORAGE)
+else:
+    print(f"Unknown storage engine {STORAGE_ENGINE!r} (have {sorted(blockstore.ENGINES)})")
+    sys.exit(1)
 running = True
 
+# Block changes not yet acknowledged by the master, sent with the next
+# heartbeat: block_id -> True (stored) / False (deleted)
+pending_changes = {}
+changes_lock = threading.Lock()
+changes_waiting = threading.Event()
+
+# Load figures sent with every heartbeat for the master's placement policy;
+# blocks/used_bytes are seeded from disk at startup and kept up to date by
+# _write_block/_delete_block
+load = {"blocks": 0, "used_bytes": 0, "active_transfers": 0}
+load_lock = threading.Lock()
+
+scrub_stats = {"passes": 0, "blocks": 0, "bytes": 0, "corrupt": 0, "last_pass": None}
+
+# block_id -> (data, crc) of the hottest blocks
+hot_blocks = cache.BlockCache(HOT_CACHE_BYTES)
+recent_reads = OrderedDict()  # block ids streamed lately, oldest first
+read_stats = {"streamed": 0, "streamed_bytes": 0}
+recent_lock = threading.Lock()  # recent_reads, read_stats
+
+
+def _checksum_ok(content, headers):
+    """Raises ValueError if the checksum header isn't hex."""
+    expected = headers.get(CHECKSUM_HEADER)
+    return expected is None or int(expected, 16) == zlib.crc32(content)
+
+
+def _note_change(block_id, present):
+    with changes_lock:
+        pending_changes[block_id] = present
+    changes_waiting.set()
+
+
+def _list_blocks():
+    return store.list()
+
+
+@contextmanager
+def _transfer():
+    with load_lock:
+        load["active_transfers"] += 1
+    try:
+        yield
+    finally:
+        with load_lock:
+            load["active_transfers"] -= 1
+
+
+def _scan_load():
+    blocks, used = store.usage()
+    with load_lock:
+        load["blocks"] = blocks
+        load["used_bytes"] = used
+
+
+def _upgrade_block_names():
+    # Block files written before ids were encoded on disk have "_" for the
+    # "/" of an id, which the listing (and so our block reports) can't undo.
+    # The master knows which ids those were; nothing is reported until they
+    # are renamed.
+    files = blockstore.FileStore(STORAGE)
+    names = files.legacy_names()
+    if not names:
+        return
+    while True:
+        try:
+            r = http_pool.post(
+                f"{MASTER}/legacy_block_ids", json={"names": names}, timeout=30
+            )
+            if r.status_code == 200:
+                break
+        except Exception:
+            pass
+        print(f"[NODE {PORT}] Waiting for the master to rename {len(names)} block files")
+        time.sleep(2)
+    real_ids = r.json()["ids"]
+    files.upgrade_names(real_ids)
+    print(f"[NODE {PORT}] Renamed {len(names)} block files ({len(real_ids)} ids with '/')")
+
+
+def _migrate_files():
+    # Moves blocks stored by the file engine into the segment store
+    old = blockstore.FileStore(STORAGE)
+    moved = 0
+    for block_id in old.list():
+        try:
+            found = old.get(block_id)
+        except CorruptBlock:
+            found = None
+        if found is not None:
+            store.put(block_id, found[0])
+            moved += 1
+        old.delete(block_id)
+    if moved:
+        store.checkpoint()
+        print(f"[NODE {PORT}] Moved {moved} block files into segments")
+
+
+def _load_report():
+    with load_lock:
+        out = dict(load)
+    out["free_bytes"] = shutil.disk_usage(STORAGE).free
+    return out
+
+
+def _write_block(block_id, content):
+    old_size = store.put(block_id, content)
+    hot_blocks.discard(block_id)
+    with load_lock:
+        if old_size is None:
+            load["blocks"] += 1
+            load["used_bytes"] += len(content)
+        else:
+            load["used_bytes"] += len(content) - old_size
+    _note_change(block_id, True)
+    print(f"[NODE {PORT}] Stored block {block_id} ({len(content)} bytes)")
 
-def block_path(block_id: str) -> str:
-    safe_id = block_id.replace("/", "_")
-    return os.path.join(STORAGE, f"{safe_id}.blk")
+
+def _read_block(block_id):
+    """Return (data, crc) for a stored block, or None if it isn't here.
+    crc is None for a legacy file without checksum; raises CorruptBlock if
+    the data doesn't match its checksum."""
+    return store.get(block_id)
+
+
+def _quarantine(block_id):
+    # A replica that failed its checksum must not be served or copied again:
+    # drop it and tell the master, which re-replicates from a good copy. The
+    # heartbeat delta from the delete covers a lost report.
+    scrub_stats["corrupt"] += 1
+    print(f"[NODE {PORT}] Checksum mismatch on block {block_id}, dropping replica")
+    _delete_block(block_id)
+    try:
+        http_pool.post(
+            f"{MASTER}/report_bad_block", json={"port": PORT, "block_id": block_id}, timeout=2
+        )
+    except Exception as e:
+        print(f"[NODE {PORT}] Could not report bad block {block_id}: {e}")
+
+
+def _delete_block(block_id):
+    hot_blocks.discard(block_id)
+    size = store.delete(block_id)
+    if size is None:
+        return False
+    with load_lock:
+        load["blocks"] -= 1
+        load["used_bytes"] -= size
+    _note_change(block_id, False)
+    print(f"[NODE {PORT}] Deleted block {block_id}")
+    return True
 
 
 @app.route("/block_store", methods=["POST"])
@@ -31,16 +260,223 @@ def block_store():
         return "missing block_id", 400
 
     try:
-        path = block_path(block_id)
-        with open(path, "w", encoding="utf-8", errors="ignore") as f:
-            f.write(content)
-        print(f"[NODE {PORT}] Stored block {block_id}")
+        with _transfer():
+            _write_block(block_id, content.encode("utf-8"))
         return "OK", 200
     except Exception as e:
         print(f"[NODE {PORT}] block_store error: {e}")
         return "Error", 500
 
 
+# Binary transport: the block travels as the raw request/response body and
+# block_id is passed in the query string. /block_store and /block_fetch stay
+# as the JSON compatibility path.
+@app.route("/block_store_raw", methods=["POST"])
+def block_store_raw():
+    block_id = request.args.get("block_id")
+    if not block_id:
+        return "missing block_id", 400
+
+    with _transfer():
+        content = request.get_data()
+        try:
+            checksum_ok = _checksum_ok(content, request.headers)
+        except ValueError:
+            return "bad checksum header", 400
+        if not checksum_ok:
+            print(f"[NODE {PORT}] Checksum mismatch receiving block {block_id}")
+            return "checksum mismatch", 400
+        codec = request.headers.get(COMPRESS_HEADER)
+        comp_stats = None
+        if codec:
+            try:
+                compression.check_codec(codec)
+            except ValueError as e:
+                return str(e), 400
+            content, comp_stats = compression.encode_block(codec, content)
+        if block_id.startswith(CAS_PREFIX) and (
+            hashlib.sha256(content).hexdigest() != block_id[len(CAS_PREFIX):]
+        ):
+            return "content does not match block id", 400
+        try:
+            _write_block(block_id, content)
+        except Exception as e:
+            print(f"[NODE {PORT}] block_store_raw error: {e}")
+            return "Error", 500
+
+    # Chained write: X-Pipeline lists the replicas still to be written. The
+    # block is forwarded to the next one and the acks of the rest of the chain
+    # are returned with ours.
+    if "X-Pipeline" not in request.headers and not comp_stats:
+        return "OK", 200
+    pipeline = [p for p in request.headers.get("X-Pipeline", "").split(",") if p]
+    ack = _forward_block(block_id, content, pipeline)
+    if comp_stats:
+        ack["compression"] = comp_stats
+    return jsonify(ack)
+
+
+@app.route("/block_store_batch", methods=["POST"])
+def block_store_batch():
+    # Many blocks in one framed body (see framing.py). Each record is checked
+    # and stored on its own; the reply says which ones made it.
+    stored, failed = [], {}
+    with _transfer():
+        try:
+            records = list(framing.unpack(request.get_data()))
+        except ValueError as e:
+            return f"bad batch: {e}", 400
+        if len(records) > framing.MAX_BATCH:
+            return f"batch of {len(records)} blocks is over {framing.MAX_BATCH}", 400
+        for block_id, _, content, crc in records:
+            if zlib.crc32(content) != crc:
+                print(f"[NODE {PORT}] Checksum mismatch receiving block {block_id}")
+                failed[block_id] = "checksum mismatch"
+                continue
+            if block_id.startswith(CAS_PREFIX) and (
+                hashlib.sha256(content).hexdigest() != block_id[len(CAS_PREFIX):]
+            ):
+                failed[block_id] = "content does not match block id"
+                continue
+            try:
+                _write_block(block_id, content)
+            except Exception as e:
+                print(f"[NODE {PORT}] block_store_batch error: {e}")
+                failed[block_id] = "Error"
+                continue
+            stored.append(block_id)
+    return jsonify({"stored": stored, "failed": failed})
+
+
+def _forward_block(block_id, content, pipeline):
+    stored, failed = [PORT], []
+    while pipeline:
+        nxt, rest = pipeline[0], pipeline[1:]
+        try:
+            rr = http_pool.post(
+                f"http://127.0.0.1:{nxt}/block_store_raw",
+                params={"block_id": block_id},
+                data=content,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "X-Pipeline": ",".join(rest),
+                    CHECKSUM_HEADER: f"{zlib.crc32(content):08x}",
+                },
+                timeout=FORWARD_TIMEOUT * len(pipeline),
+            )
+            if rr.status_code == 200:
+                ack = rr.json()
+                stored += ack.get("stored", [])
+                failed += ack.get("failed", [])
+                break
+            print(f"[NODE {PORT}] Forward of {block_id} to {nxt} failed: {rr.status_code}")
+        except Exception as e:
+            print(f"[NODE {PORT}] Forward of {block_id} to {nxt} failed: {e}")
+        # skip the broken hop and continue the chain with the rest
+        failed.append(nxt)
+        pipeline = rest
+    return {"stored": stored, "failed": failed}
+
+
+def _read_again(block_id):
+    # True if block_id was read recently enough to be worth caching
+    with recent_lock:
+        if recent_reads.pop(block_id, None) is not None:
+            return True
+        recent_reads[block_id] = True
+        if len(recent_reads) > HOT_ADMIT_WINDOW:
+            recent_reads.popitem(last=False)
+        return False
+
+
+def _stream_block(f, length):
+    with f, _transfer():
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(STREAM_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    with recent_lock:
+        read_stats["streamed"] += 1
+        read_stats["streamed_bytes"] += length - remaining
+
+
+@app.route("/block_fetch_raw", methods=["GET"])
+def block_fetch_raw():
+    block_id = request.args.get("block_id")
+    if not block_id:
+        return "missing block_id", 400
+    offset = request.args.get("offset", type=int)
+    length = request.args.get("length", type=int)
+    if (offset is not None and offset < 0) or (length is not None and length < 0):
+        return "bad range", 400
+
+    found = hot_blocks.get(block_id)
+    if found is None:
+        hot = _read_again(block_id)
+        if not hot and offset is None and length is None:
+            opened = store.open_block(block_id)
+            if opened is not None:
+                f, size, crc = opened
+                return Response(
+                    _stream_block(f, size),
+                    mimetype="application/octet-stream",
+                    headers={CHECKSUM_HEADER: f"{crc:08x}", "Content-Length": str(size)},
+                )
+        try:
+            with _transfer():
+                found = _read_block(block_id)
+        except CorruptBlock:
+            _quarantine(block_id)
+            return "checksum mismatch", 500
+        if found is None:
+            return "Not found", 404
+        if hot and found[1] is not None:
+            hot_blocks.put(block_id, found, len(found[0]))
+
+    content, crc = found
+    if offset is not None or length is not None:
+        # The whole block was checked on read; the checksum header covers
+        # just the bytes sent so the client can still verify them
+        start = offset or 0
+        end = len(content) if length is None else start + length
+        content = content[start:end]
+        crc = zlib.crc32(content)
+    headers = {CHECKSUM_HEADER: f"{crc:08x}"} if crc is not None else {}
+    return Response(content, mimetype="application/octet-stream", headers=headers)
+
+
+@app.route("/block_fetch_batch", methods=["POST"])
+def block_fetch_batch():
+    # Replies with one framed record per requested block, in request order;
+    # missing and corrupt blocks get a record with that status and no data
+    data = request.get_json(force=True)
+    block_ids = data.get("block_ids")
+    if not isinstance(block_ids, list):
+        return "missing block_ids", 400
+    if len(block_ids) > framing.MAX_BATCH:
+        return f"batch of {len(block_ids)} blocks is over {framing.MAX_BATCH}", 400
+
+    records = []
+    with _transfer():
+        for block_id in block_ids:
+            found = hot_blocks.get(block_id)
+            if found is None:
+                try:
+                    found = _read_block(block_id)
+                except CorruptBlock:
+                    _quarantine(block_id)
+                    records.append((block_id, b"", framing.CORRUPT, 0))
+                    continue
+            if found is None:
+                records.append((block_id, b"", framing.MISSING, 0))
+            else:
+                records.append((block_id, found[0], framing.OK, found[1]))
+    return Response(framing.pack(records), mimetype="application/octet-stream")
+
+
 @app.route("/block_fetch", methods=["POST"])
 def block_fetch():
     data = request.get_json(force=True)
@@ -48,13 +484,184 @@ def block_fetch():
     if not block_id:
         return "missing block_id", 400
 
-    path = block_path(block_id)
-    if not os.path.exists(path):
+    try:
+        found = _read_block(block_id)
+    except CorruptBlock:
+        _quarantine(block_id)
+        return "checksum mismatch", 500
+    if found is None:
         return "Not found", 404
+    return jsonify({"data": found[0].decode("utf-8", errors="ignore")})
 
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        content = f.read()
-    return jsonify({"data": content})
+
+@app.route("/check_block", methods=["POST"])
+def check_block():
+    # Sent by a reader whose copy of the block failed its checksum: the
+    # streamed read path doesn't verify, so check the stored replica here and
+    # drop it if it is the corrupt one rather than the transfer.
+    data = request.get_json(force=True)
+    block_id = data.get("block_id")
+    if not block_id:
+        return "missing block_id", 400
+
+    hot_blocks.discard(block_id)
+    try:
+        found = _read_block(block_id)
+    except CorruptBlock:
+        _quarantine(block_id)
+        return jsonify({"block_id": block_id, "present": True, "corrupt": True})
+    return jsonify({"block_id": block_id, "present": found is not None, "corrupt": False})
+
+
+def _report_bad_source(source, block_id):
+    try:
+        http_pool.post(
+            f"http://127.0.0.1:{source}/check_block", json={"block_id": block_id}, timeout=5
+        )
+    except Exception:
+        pass
+
+
+@app.route("/replicate_from", methods=["POST"])
+def replicate_from():
+    # Recovery copy: pull a block straight from another node so the data
+    # never passes through the master.
+    data = request.get_json(force=True)
+    block_id = data.get("block_id")
+    source = data.get("source")
+    if not block_id or not source:
+        return "missing block_id or source", 400
+
+    with _transfer():
+        try:
+            rr = http_pool.get(
+                f"http://127.0.0.1:{source}/block_fetch_raw",
+                params={"block_id": block_id},
+                timeout=REPLICATE_TIMEOUT,
+            )
+        except Exception as e:
+            return f"source {source} unreachable: {e}", 502
+        if rr.status_code != 200:
+            return f"source {source} returned {rr.status_code}", 502
+        try:
+            checksum_ok = _checksum_ok(rr.content, rr.headers)
+        except ValueError:
+            return f"bad checksum header from {source}", 502
+        if not checksum_ok:
+            _report_bad_source(source, block_id)
+            return f"checksum mismatch reading from {source}", 502
+
+        try:
+            _write_block(block_id, rr.content)
+        except Exception as e:
+            print(f"[NODE {PORT}] replicate_from error: {e}")
+            return "Error", 500
+    return jsonify({"block_id": block_id, "bytes": len(rr.content)})
+
+
+@app.route("/replicate_batch", methods=["POST"])
+def replicate_batch():
+    # replicate_from for many blocks held by the same source, in one fetch
+    data = request.get_json(force=True)
+    block_ids = data.get("block_ids")
+    source = data.get("source")
+    if not block_ids or not source:
+        return "missing block_ids or source", 400
+    if len(block_ids) > framing.MAX_BATCH:
+        return f"batch of {len(block_ids)} blocks is over {framing.MAX_BATCH}", 400
+
+    stored, failed, copied = [], {}, 0
+    with _transfer():
+        try:
+            rr = http_pool.post(
+                f"http://127.0.0.1:{source}/block_fetch_batch",
+                json={"block_ids": block_ids},
+                timeout=REPLICATE_TIMEOUT * 2,
+            )
+        except Exception as e:
+            return f"source {source} unreachable: {e}", 502
+        if rr.status_code != 200:
+            return f"source {source} returned {rr.status_code}", 502
+        try:
+            records = list(framing.unpack(rr.content))
+        except ValueError as e:
+            return f"bad batch from {source}: {e}", 502
+
+        for block_id, status, content, crc in records:
+            if status != framing.OK:
+                failed[block_id] = (
+                    "corrupt at source" if status == framing.CORRUPT else "missing at source"
+                )
+                continue
+            if zlib.crc32(content) != crc:
+                _report_bad_source(source, block_id)
+                failed[block_id] = f"checksum mismatch reading from {source}"
+                continue
+            try:
+                _write_block(block_id, content)
+            except Exception as e:
+                print(f"[NODE {PORT}] replicate_batch error: {e}")
+                failed[block_id] = "Error"
+                continue
+            stored.append(block_id)
+            copied += len(content)
+
+    print(f"[NODE {PORT}] Replicated {len(stored)} blocks from node {source}")
+    return jsonify({"stored": stored, "failed": failed, "bytes": copied})
+
+
+@app.route("/rebuild_shard", methods=["POST"])
+def rebuild_shard():
+    # Erasure-coded recovery: read k surviving shards of the stripe from
+    # their nodes and decode the lost one locally.
+    data = request.get_json(force=True)
+    block_id = data.get("block_id")
+    sources = data.get("sources", [])
+    try:
+        index, k, m = int(data["index"]), int(data["k"]), int(data["m"])
+        erasure.check_params(k, m)
+        erasure.require_numpy()
+    except (KeyError, TypeError, ValueError) as e:
+        return f"bad request: {e}", 400
+    except RuntimeError as e:
+        return str(e), 501
+    if not block_id:
+        return "missing block_id", 400
+
+    shards, bytes_read = {}, 0
+    with _transfer():
+        for src in sources:
+            if len(shards) >= k:
+                break
+            try:
+                rr = http_pool.get(
+                    f"http://127.0.0.1:{src['port']}/block_fetch_raw",
+                    params={"block_id": src["block_id"]},
+                    timeout=REPLICATE_TIMEOUT,
+                )
+            except Exception:
+                continue
+            if rr.status_code != 200:
+                continue
+            try:
+                checksum_ok = _checksum_ok(rr.content, rr.headers)
+            except ValueError:
+                continue
+            if not checksum_ok:
+                _report_bad_source(src["port"], src["block_id"])
+                continue
+            shards[int(src["index"])] = rr.content
+            bytes_read += len(rr.content)
+        if len(shards) < k:
+            return f"only {len(shards)} of {k} shards readable", 502
+
+        try:
+            content = erasure.reconstruct(shards, k, m, [index])[index]
+            _write_block(block_id, content)
+        except Exception as e:
+            print(f"[NODE {PORT}] rebuild_shard error: {e}")
+            return "Error", 500
+    return jsonify({"block_id": block_id, "bytes": len(content), "bytes_read": bytes_read})
 
 
 @app.route("/block_delete", methods=["POST"])
@@ -64,10 +671,7 @@ def block_delete():
     if not block_id:
         return "missing block_id", 400
 
-    path = block_path(block_id)
-    if os.path.exists(path):
-        os.remove(path)
-        print(f"[NODE {PORT}] Deleted block {block_id}")
+    if _delete_block(block_id):
         return "OK", 200
     return "Not found", 404
 
@@ -117,17 +721,139 @@ def shutdown():
     return "Shutting down", 200
 
 
+def scrub_loop():
+    # Re-verify every block in the background, rate limited so it doesn't
+    # compete with client traffic. Legacy blocks without a checksum get one.
+    bucket = TokenBucket(SCRUB_RATE)
+    while running:
+        for block_id in _list_blocks():
+            size = store.size(block_id)
+            if size is None:
+                continue
+            bucket.consume(size)
+            try:
+                found = _read_block(block_id)
+            except CorruptBlock:
+                _quarantine(block_id)
+                continue
+            if found is None:
+                continue
+            if found[1] is None:
+                _write_block(block_id, found[0])
+            scrub_stats["blocks"] += 1
+            scrub_stats["bytes"] += size
+        scrub_stats["passes"] += 1
+        scrub_stats["last_pass"] = time.time()
+        time.sleep(SCRUB_INTERVAL)
+
+
+@app.route("/scrub_status", methods=["GET"])
+def scrub_status():
+    return jsonify(scrub_stats)
+
+
+def maintain_loop():
+    # Index checkpoints and compaction for the segment engine
+    while running:
+        time.sleep(MAINTAIN_INTERVAL)
+        try:
+            store.maintain()
+        except Exception as e:
+            print(f"[NODE {PORT}] Storage maintenance failed: {e}")
+
+
+@app.route("/storage_status", methods=["GET"])
+def storage_status():
+    out = {"engine": STORAGE_ENGINE}
+    if hasattr(store, "stats"):
+        out.update(store.stats())
+    out["hot_cache"] = hot_blocks.stats()
+    with recent_lock:
+        out["reads"] = dict(read_stats)
+    return jsonify(out)
+
+
+def send_full_report():
+    # Changes queued so far are covered by the listing; later ones are sent
+    # as deltas again, which the master applies idempotently.
+    with changes_lock:
+        pending_changes.clear()
+    blocks = _list_blocks()
+    r = http_pool.post(
+        f"{MASTER}/block_report", json={"port": PORT, "blocks": blocks}, timeout=10
+    )
+    return r.status_code == 200
+
+
+def _send_heartbeat(interval, load_report):
+    with changes_lock:
+        changes = dict(pending_changes)
+        pending_changes.clear()
+        changes_waiting.clear()
+
+    try:
+        r = http_pool.post(
+            f"{MASTER}/heartbeat",
+            data=liveness.encode_heartbeat(
+                PORT,
+                interval,
+                load_report,
+                [b for b, present in changes.items() if present],
+                [b for b, present in changes.items() if not present],
+            ),
+            headers={"Content-Type": liveness.HEARTBEAT_TYPE},
+            timeout=1,
+        )
+        if r.status_code != 200:
+            raise RuntimeError(r.text)
+    except Exception:
+        # put back whatever wasn't superseded in the meantime
+        with changes_lock:
+            for block_id, present in changes.items():
+                pending_changes.setdefault(block_id, present)
+        raise
+    return liveness.decode_reply(r.content), bool(changes)
+
+
 def heartbeat():
+    need_full_report = True
+    interval = HEARTBEAT_INTERVAL
     while running:
+        busy = True
         try:
-            requests.post(f"{MASTER}/heartbeat", json={"port": PORT}, timeout=1)
+            if need_full_report:
+                need_full_report = not send_full_report()
+            load_report = _load_report()
+            # the next wait is at most double this one
+            reply, sent_changes = _send_heartbeat(
+                min(interval * 2, HEARTBEAT_MAX_INTERVAL), load_report
+            )
+            if reply["full_report"]:
+                need_full_report = True
+            for block_id in reply["delete"]:
+                _delete_block(block_id)
+            busy = (
+                sent_changes or reply["delete"] or need_full_report
+                or load_report["active_transfers"]
+            )
         except Exception:
             pass
-        time.sleep(1)
+        sent_at = time.time()
+        interval = HEARTBEAT_INTERVAL if busy else min(interval * 2, HEARTBEAT_MAX_INTERVAL)
+        if changes_waiting.wait(interval):
+            # a change came in: report it, but no sooner than the busy rate
+            time.sleep(max(0.0, sent_at + HEARTBEAT_INTERVAL - time.time()))
+    store.close()
     os._exit(0)
 
 
 if __name__ == "__main__":
-    print(f"[NODE {PORT}] Running, storage={STORAGE} (block-based)")
+    print(f"[NODE {PORT}] Running, storage={STORAGE} ({STORAGE_ENGINE} engine)")
+    _upgrade_block_names()
+    if STORAGE_ENGINE == "segment":
+        _migrate_files()
+    _scan_load()
     threading.Thread(target=heartbeat, daemon=True).start()
-    app.run(port=int(PORT))
+    threading.Thread(target=scrub_loop, daemon=True).start()
+    threading.Thread(target=maintain_loop, daemon=True).start()
+    http_pool.serve(app, int(PORT))
@@ -0,0 +1,58 @@
+"""
+Replica placement policies for the master.
+
+A policy picks `rf` distinct nodes for one block out of `candidates`, given
+`loads`: node_port -> the node's last heartbeat load figures
+
+  free_bytes        free space the block may use
+  blocks            blocks held
+  active_transfers  block reads/writes in progress on the node
+  pending           blocks the master placed on it since that heartbeat
+
+Candidates must already exclude dead and full nodes. Each choose() call
+looks at O(rf) nodes, independent of cluster size.
+"""
+
+import random
+
+
+def cost(load):
+    # Writes in flight per free byte: lower is better. A node that hasn't
+    # reported yet ranks below every node that has.
+    if not load:
+        return float("inf")
+    busy = 1 + load.get("active_transfers", 0) + load.get("pending", 0)
+    return busy / max(load.get("free_bytes", 0), 1)
+
+
+class RandomPlacement:
+    name = "random"
+
+    def choose(self, candidates, rf, loads):
+        return random.sample(candidates, rf)
+
+
+class PowerOfTwoChoices:
+    """For every replica draw two nodes at random and keep the cheaper one.
+    The 2*rf draws are distinct, so the picks are too."""
+
+    name = "p2c"
+
+    def choose(self, candidates, rf, loads):
+        drawn = random.sample(candidates, min(2 * rf, len(candidates)))
+        if len(drawn) < 2 * rf:
+            # small cluster: not enough nodes for disjoint pairs
+            return sorted(drawn, key=lambda p: cost(loads.get(p)))[:rf]
+        return [
+            min(drawn[i], drawn[rf + i], key=lambda p: cost(loads.get(p)))
+            for i in range(rf)
+        ]
+
+
+POLICIES = {p.name: p for p in (RandomPlacement, PowerOfTwoChoices)}
+
+
+def make_policy(name):
+    if name not in POLICIES:
+        raise ValueError(f"unknown placement policy {name!r} (have {sorted(POLICIES)})")
+    return POLICIES[name]()
@@ -0,0 +1,148 @@
+"""
+Re-replication worker pool for the master.
+
+Workers pull repair jobs (filename, block_id, src, dst, ...) from the master's
+under-replication queue and copy them concurrently, off the monitor thread,
+so failure detection keeps running while recovery is in progress.
+
+Limits:
+  per_source / per_target  concurrent copies reading from / writing to a node
+  bandwidth                global budget in bytes/s shared by all workers
+"""
+
+import collections
+import threading
+import time
+
+# How long an idle worker sleeps before looking at the queue again
+IDLE_WAIT = 1.0
+
+# Window (seconds) over which bytes_per_sec is measured
+RATE_WINDOW = 10.0
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else rate)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        # Blocks until n bytes fit in the budget. A request larger than the
+        # bucket goes through once the bucket is full and leaves it in debt.
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= min(n, self.capacity):
+                    self._tokens -= n
+                    return
+                wait = (min(n, self.capacity) - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ReplicationPool:
+    """`next_job(pool)` returns a job or None and must pick src/dst through
+    pool.reserve(); `copy_block(job, throttle)` performs the copy, calls
+    throttle(nbytes) for the data it moves and returns the byte count, or
+    None on failure; `on_failure(job)` is called for failed jobs."""
+
+    def __init__(self, next_job, copy_block, on_failure, workers=8,
+                 per_source=2, per_target=2, bandwidth=0):
+        self._next_job = next_job
+        self._copy_block = copy_block
+        self._on_failure = on_failure
+        self.workers = workers
+        self.per_source = per_source
+        self.per_target = per_target
+        self._bucket = TokenBucket(bandwidth)
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._src_load = collections.Counter()
+        self._dst_load = collections.Counter()
+        self._recent = collections.deque()
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def wake(self):
+        self._wake.set()
+
+    def reserve(self, sources, targets):
+        """Pick the least loaded source and target that are under their caps
+        and claim a slot on both. Returns (src, dst) or None."""
+        with self._lock:
+            srcs = [p for p in sources if self._src_load[p] < self.per_source]
+            dsts = [p for p in targets if self._dst_load[p] < self.per_target]
+            if not srcs or not dsts:
+                return None
+            src = min(srcs, key=lambda p: self._src_load[p])
+            dst = min(dsts, key=lambda p: self._dst_load[p])
+            self._src_load[src] += 1
+            self._dst_load[dst] += 1
+            self.in_flight += 1
+            return src, dst
+
+    def _release(self, src, dst, copied):
+        now = time.time()
+        with self._lock:
+            self._src_load[src] -= 1
+            self._dst_load[dst] -= 1
+            self.in_flight -= 1
+            if copied is None:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.bytes += copied
+                self._recent.append((now, copied))
+        # freed slots may unblock deferred jobs
+        self._wake.set()
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._next_job(self)
+            except Exception as e:
+                print(f"[MASTER] Replication scheduling error: {e}")
+                job = None
+            if job is None:
+                self._wake.wait(IDLE_WAIT)
+                self._wake.clear()
+                continue
+
+            src, dst = job[2], job[3]
+            copied = None
+            try:
+                copied = self._copy_block(job, self._bucket.consume)
+            except Exception as e:
+                print(f"[MASTER] Re-replication error for {job[1]}: {e}")
+            finally:
+                self._release(src, dst, copied)
+            if copied is None:
+                self._on_failure(job)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            while self._recent and now - self._recent[0][0] > RATE_WINDOW:
+                self._recent.popleft()
+            recent = sum(n for _, n in self._recent)
+            return {
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "bytes": self.bytes,
+                "bytes_per_sec": recent / RATE_WINDOW,
+            }
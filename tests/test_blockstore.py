@@ -0,0 +1,211 @@
+import os
+import random
+import threading
+
+import blockstore
+
+IDS = [
+    "plain.bin__g1__blk0",
+    "dir/sub/a.bin__g2__blk0",
+    "dir_sub_a.bin__g3__blk0",
+    "100%/x%2Fy__g4__blk1",
+]
+
+
+def test_file_store_lists_ids_after_restart(tmp_path):
+    store = blockstore.FileStore(str(tmp_path))
+    for i, block_id in enumerate(IDS):
+        store.put(block_id, bytes([i]) * 10)
+
+    # a restarted node reports what list() returns
+    store = blockstore.FileStore(str(tmp_path))
+    assert sorted(store.list()) == sorted(IDS)
+    for i, block_id in enumerate(IDS):
+        assert store.get(block_id)[0] == bytes([i]) * 10
+    assert store.delete("dir/sub/a.bin__g2__blk0") == 10
+    assert store.get("dir_sub_a.bin__g3__blk0") is not None
+
+
+def test_file_store_concurrent_puts_of_one_block(tmp_path):
+    store = blockstore.FileStore(str(tmp_path))
+    errors = []
+
+    def writer(i):
+        try:
+            for _ in range(50):
+                store.put("same__g1__blk0", bytes([i]) * 4096)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    data = store.get("same__g1__blk0")[0]
+    assert data == data[:1] * 4096
+    assert sorted(os.listdir(tmp_path)) == sorted(["same__g1__blk0.blk", blockstore.NAMES_MARKER])
+
+
+def test_legacy_names_are_upgraded(tmp_path):
+    # files as written before ids were encoded: "/" became "_", "%" kept
+    legacy = {
+        "dir_a.bin__g1__blk0": "dir/a.bin__g1__blk0",
+        "plain__g1__blk0": "plain__g1__blk0",
+        "50%__g1__blk0": "50%__g1__blk0",
+    }
+    staging = blockstore.FileStore(str(tmp_path / "staging"))
+    for name in legacy:
+        staging.put(name, name.encode())
+        os.replace(
+            os.path.join(staging.root, blockstore.encode_id(name) + ".blk"),
+            tmp_path / f"{name}.blk",
+        )
+
+    store = blockstore.FileStore(str(tmp_path))
+    assert sorted(store.legacy_names()) == sorted(legacy)
+    store.upgrade_names({"dir_a.bin__g1__blk0": "dir/a.bin__g1__blk0"})
+
+    store = blockstore.FileStore(str(tmp_path))
+    assert store.legacy_names() == []
+    assert sorted(store.list()) == sorted(legacy.values())
+    for name, block_id in legacy.items():
+        assert store.get(block_id)[0] == name.encode()
+
+
+def test_segment_migration_keeps_ids(tmp_path):
+    files = blockstore.FileStore(str(tmp_path))
+    for block_id in IDS:
+        files.put(block_id, block_id.encode())
+
+    segments = blockstore.SegmentStore(str(tmp_path / "segments"))
+    for block_id in files.list():
+        segments.put(block_id, files.get(block_id)[0])
+        files.delete(block_id)
+    segments.close()
+
+    segments = blockstore.SegmentStore(str(tmp_path / "segments"))
+    assert sorted(segments.list()) == sorted(IDS)
+    assert files.list() == []
+    segments.close()
+
+
+def _crash(store):
+    # stop without the checkpoint close() writes
+    os.close(store._fd)
+
+
+def _contents(store):
+    return {block_id: store.get(block_id)[0] for block_id in store.list()}
+
+
+def test_segment_reopen_after_delete(tmp_path):
+    store = blockstore.SegmentStore(str(tmp_path))
+    store.put("a", b"1" * 10)
+    store.put("b", b"2" * 10)
+    store.checkpoint()
+    assert store.delete("a") == 10
+    _crash(store)
+
+    store = blockstore.SegmentStore(str(tmp_path))
+    assert _contents(store) == {"b": b"2" * 10}
+    assert store.delete("b") == 10
+    store.close()
+
+    store = blockstore.SegmentStore(str(tmp_path))
+    assert store.list() == []
+    store.close()
+
+
+def test_segment_reopen_after_compaction(tmp_path):
+    store = blockstore.SegmentStore(str(tmp_path), segment_size=4096)
+    for i in range(40):
+        store.put(f"b{i}", bytes([i]) * 500)
+    for i in range(40):
+        if i % 4:
+            store.delete(f"b{i}")
+    assert store.compact()
+    expected = {f"b{i}": bytes([i]) * 500 for i in range(0, 40, 4)}
+    assert _contents(store) == expected
+    _crash(store)
+
+    store = blockstore.SegmentStore(str(tmp_path), segment_size=4096)
+    assert _contents(store) == expected
+    _crash(store)
+    os.remove(tmp_path / "index.json")
+
+    # a full replay of what compaction left must agree too
+    store = blockstore.SegmentStore(str(tmp_path), segment_size=4096)
+    assert _contents(store) == expected
+    store.close()
+
+
+def test_segment_compaction_drops_tombstones(tmp_path):
+    store = blockstore.SegmentStore(str(tmp_path), segment_size=16384)
+    # a sealed segment of live blocks that never gets compacted
+    for i in range(40):
+        store.put(f"keep{i}", b"k" * 500)
+    for r in range(40):
+        for i in range(100):
+            store.put(f"r{r}_{i}", b"x" * 500)
+        for i in range(100):
+            store.delete(f"r{r}_{i}")
+        store.compact()
+    # the puts went with their segments, so their tombstones did too
+    assert store.stats()["segments"] <= 3
+    store.close()
+
+    store = blockstore.SegmentStore(str(tmp_path), segment_size=16384)
+    assert sorted(store.list()) == sorted(f"keep{i}" for i in range(40))
+    store.close()
+
+
+def test_segment_torn_tail_is_cut(tmp_path):
+    store = blockstore.SegmentStore(str(tmp_path))
+    store.put("a", b"1" * 100)
+    store.checkpoint()
+    store.put("b", b"2" * 100)
+    _crash(store)
+    seg = store._seg_path(store._active)
+    size = os.path.getsize(seg)
+    os.truncate(seg, size - 30)
+
+    store = blockstore.SegmentStore(str(tmp_path))
+    assert _contents(store) == {"a": b"1" * 100}
+    store.put("c", b"3" * 100)
+    store.close()
+
+    store = blockstore.SegmentStore(str(tmp_path))
+    assert _contents(store) == {"a": b"1" * 100, "c": b"3" * 100}
+    store.close()
+
+
+def test_segment_random_operations_match_dict(tmp_path):
+    rnd = random.Random(7)
+    store = blockstore.SegmentStore(str(tmp_path), segment_size=8192)
+    expected = {}
+    for step in range(3000):
+        op = rnd.random()
+        block_id = f"blk{rnd.randrange(60)}"
+        if op < 0.5:
+            data = bytes([step % 256]) * rnd.randrange(1, 700)
+            store.put(block_id, data)
+            expected[block_id] = data
+        elif op < 0.85:
+            store.delete(block_id)
+            expected.pop(block_id, None)
+        elif op < 0.95:
+            store.compact()
+        elif op < 0.98:
+            store.close()
+            store = blockstore.SegmentStore(str(tmp_path), segment_size=8192)
+        else:
+            _crash(store)
+            store = blockstore.SegmentStore(str(tmp_path), segment_size=8192)
+        assert sorted(store.list()) == sorted(expected)
+    assert _contents(store) == expected
+    # compaction keeps the log bounded rather than carrying dead records
+    store.compact()
+    assert store.stats()["segments"] <= 12
+    store.close()